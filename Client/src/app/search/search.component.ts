@@ -3,7 +3,7 @@ import { CommonModule } from '@angular/common';
 import { Component } from '@angular/core';
 import {MatTabsModule} from '@angular/material/tabs';
 import { SearchResults } from '../interfaces/search-results';
-import { switchMap, map, forkJoin } from 'rxjs';
+import { switchMap, map } from 'rxjs';
 import { ImageService } from '../Services/image.service';
 import { MatButtonModule } from '@angular/material/button';
 import {MatCardModule} from '@angular/material/card';
@@ -17,37 +17,14 @@ import { MatIconModule } from '@angular/material/icon';
 })
 export class SearchComponent {
   Search() {
-    const likedDetails$ = Array.from(this.likedIds).map((filename) =>
-      this.imageService.getImageDetails(filename.filename)
-    );
-  
-    const leftoverDetails$ = this.results
-      .filter((result) => !this.likedIds.has(result))
-      .map((result) => this.imageService.getImageDetails(result.filename));
-  
-    // Combine Observables and subscribe to get results
-    forkJoin([...likedDetails$, ...leftoverDetails$]).subscribe({
-      next: (details) => {
-        // Split the details into liked and leftover arrays
-        const likedDetails = details.slice(0, likedDetails$.length);
-        const leftoverDetails = details.slice(likedDetails$.length);
-        // Create the characteristics object
-const characteristics = {
-  relevant: likedDetails.map((detail) => detail.image[0]), // Extract inner objects
-  irrelevant: leftoverDetails.map((detail) => detail.image[0]),
-};
-        this.getRes(this.image!.file,characteristics);
-
-  
-        console.log('Liked Details:', likedDetails);
-        console.log('Leftover Details:', leftoverDetails);
-  
-        // Proceed with further processing
-      },
-      error: (err) => {
-        console.error('Error fetching image details:', err);
-      },
-    });
+    // Feedback only references the images by filename, the search API looks up their descriptors
+    const characteristics = {
+      relevant: Array.from(this.likedIds).map((result) => result.filename),
+      irrelevant: this.results
+        .filter((result) => !this.likedIds.has(result))
+        .map((result) => result.filename),
+    };
+    this.getRes(this.image!.file,characteristics);
   }
   
   
@@ -0,0 +1,398 @@
+"""
+Approximate nearest-neighbour search over the weighted descriptor space.
+
+IVF-PQ implemented with NumPy: a k-means coarse quantizer splits the corpus
+into inverted lists and the residual of every image to its list centroid is
+product-quantized into one byte per sub-space. Sub-spaces never straddle two
+descriptor families, so the query-time weights (w1..w3, frame_weights,
+color_weights) are applied by scaling the per-family lookup tables. The best
+candidates are then re-ranked with the exact simple_search score.
+"""
+import logging
+import threading
+import time
+
+import numpy as np
+
+from search_index import (
+    DESCRIPTOR_FAMILIES, FAMILY_NAMES, evaluate_recall, family_coefficients, top_n_rows, flatten_descriptor
+)
+
+logger = logging.getLogger(__name__)
+
+# Number of PQ sub-spaces for every descriptor family
+PQ_SUBSPACES = {
+    "hu_moments": 1,
+    "edge_histogram": 4,
+    "color_histogram": 8,
+    "average_color": 1,
+    "dominant_colors": 1,
+    "texture_descriptors": 1,
+}
+
+DEFAULT_WEIGHTS = {"w1": 0.1, "w2": 0.8, "w3": 0.1, "frame_weights": (0.7, 0.3), "color_weights": (0.4, 0.1, 0.5)}
+
+
+def nearest_centroids(x, centroids, chunk=4096):
+    """Index of the closest centroid for every row of `x`."""
+    c_norms = np.einsum("ij,ij->i", centroids, centroids)
+    labels = np.empty(x.shape[0], dtype=np.int32)
+    for start in range(0, x.shape[0], chunk):
+        block = x[start:start + chunk]
+        labels[start:start + chunk] = np.argmin(c_norms - 2 * block @ centroids.T, axis=1)
+    return labels
+
+
+def kmeans(x, k, iterations=20, seed=0):
+    """
+    Plain Lloyd k-means with deterministic seeding.
+
+    Returns:
+        tuple: (centroids, labels)
+    """
+    rng = np.random.default_rng(seed)
+    n = x.shape[0]
+    k = min(k, n)
+    centroids = x[rng.choice(n, k, replace=False)].astype(np.float32)
+    labels = nearest_centroids(x, centroids)
+
+    for _ in range(iterations):
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, x)
+        counts = np.bincount(labels, minlength=k)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # Re-seed empty clusters on random points
+        if not filled.all():
+            centroids[~filled] = x[rng.choice(n, int((~filled).sum()), replace=False)]
+
+        new_labels = nearest_centroids(x, centroids)
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+
+    return centroids, labels
+
+
+class IvfPqState:
+    """
+    Trained quantizers and codes of one DescriptorIndex state.
+
+    Built off the request path and published by swapping a single reference,
+    so a query always reads the centroids, codes and inverted lists of the
+    same generation. Never modified once published.
+    """
+
+    def __init__(self, state, trained_on, scales, centroids, codebooks, assign, codes):
+        self.state = state
+        self.trained_on = trained_on
+        self.scales = scales
+        self.centroids = centroids
+        self.codebooks = codebooks
+        self.assign = assign
+        self.codes = codes
+        self.order = np.argsort(assign, kind="stable")
+        self.offsets = np.searchsorted(assign[self.order], np.arange(len(centroids) + 1))
+
+
+class AnnIndex:
+    """
+    IVF-PQ index kept in sync with a DescriptorIndex.
+
+    Training and encoding run in a background thread; queries are answered by
+    the exact index until the IVF-PQ structures match its current state.
+
+    Parameters:
+        index (DescriptorIndex): Exact index used for the corpus rows and the rerank.
+        nlist (int): Number of inverted lists (0 picks ~4*sqrt(N)).
+        nprobe (int): Default number of inverted lists visited per query.
+        rerank (int): Default number of candidates re-scored exactly.
+        train_size (int): Maximum number of images used to train the quantizers.
+        retrain_factor (float): Retrain when the corpus grows by this factor since training.
+        retry_interval (float): Seconds to wait after a failed build before building again.
+    """
+
+    def __init__(self, index, nlist=0, nprobe=8, rerank=100, train_size=50000,
+                 retrain_factor=2.0, seed=0, retry_interval=60.0):
+        self.index = index
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.train_size = train_size
+        self.retrain_factor = retrain_factor
+        self.seed = seed
+        self.retry_interval = retry_interval
+
+        # Column slices of every family in the concatenated vector
+        self.family_slices = {}
+        offset = 0
+        for name, width in DESCRIPTOR_FAMILIES:
+            self.family_slices[name] = slice(offset, offset + width)
+            offset += width
+        self.dim = offset
+
+        # (family, column slice) of every PQ sub-space
+        self.subspaces = []
+        for name, width in DESCRIPTOR_FAMILIES:
+            start = self.family_slices[name].start
+            for part in np.array_split(np.arange(width), PQ_SUBSPACES[name]):
+                self.subspaces.append((name, slice(start + part[0], start + part[-1] + 1)))
+
+        self.trained = None  # published IvfPqState
+        self.builds = 0
+        self.failures = 0
+        self.last_error = None
+        self._retry_at = 0.0
+        self._thread = None
+        self._weights = DEFAULT_WEIGHTS
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        """Whether the published IVF-PQ structures match the current DescriptorIndex state."""
+        trained = self.trained
+        return trained is not None and trained.state is self.index.state
+
+    def _vectors(self, state, rows, scales):
+        """Concatenated family vectors of `rows`, scaled into the training space."""
+        return np.hstack([
+            state.matrices[name][rows] * np.float32(scales[name]) for name in FAMILY_NAMES
+        ]).astype(np.float32, copy=False)
+
+    def train(self, state, weights):
+        """
+        Train the coarse quantizer and the PQ codebooks on a sample of `state`.
+
+        Returns:
+            tuple: (scales, centroids, codebooks)
+        """
+        n = len(state)
+        rng = np.random.default_rng(self.seed)
+        sample = np.sort(rng.choice(n, min(n, self.train_size), replace=False))
+
+        # Families are scaled by their weight in the global score at training time
+        scales = {name: max(abs(c), 1e-6) for name, c in family_coefficients(**weights).items()}
+        x = self._vectors(state, sample, scales)
+
+        nlist = self.nlist or int(np.clip(4 * np.sqrt(n), 1, 4096))
+        centroids, labels = kmeans(x, nlist, seed=self.seed)
+        residuals = x - centroids[labels]
+
+        codebooks = [
+            kmeans(np.ascontiguousarray(residuals[:, cols]), 256, seed=self.seed + m)[0]
+            for m, (_, cols) in enumerate(self.subspaces)
+        ]
+        return scales, centroids, codebooks
+
+    def _encode(self, state, rows, scales, centroids, codebooks, chunk=8192):
+        assign = np.empty(len(rows), dtype=np.int32)
+        codes = np.empty((len(rows), len(self.subspaces)), dtype=np.uint8)
+        for start in range(0, len(rows), chunk):
+            x = self._vectors(state, rows[start:start + chunk], scales)
+            labels = nearest_centroids(x, centroids)
+            residuals = x - centroids[labels]
+            assign[start:start + chunk] = labels
+            for m, (_, cols) in enumerate(self.subspaces):
+                codes[start:start + chunk, m] = nearest_centroids(
+                    np.ascontiguousarray(residuals[:, cols]), codebooks[m])
+        return assign, codes
+
+    def build(self, state, weights=None, previous=None):
+        """
+        IVF-PQ structures of `state`, or None for an empty state.
+
+        The quantizers of `previous` are reused, together with the codes of the
+        images it already encoded, unless the corpus grew by retrain_factor.
+        """
+        n = len(state)
+        if n == 0:
+            return None
+        if previous is None or n > self.retrain_factor * previous.trained_on:
+            scales, centroids, codebooks = self.train(state, weights or DEFAULT_WEIGHTS)
+            assign, codes = self._encode(state, np.arange(n), scales, centroids, codebooks)
+            return IvfPqState(state, n, scales, centroids, codebooks, assign, codes)
+
+        # Reuse the codes of images that were already encoded
+        old = previous.state
+        old_rows = np.fromiter((old.row_of.get(key, -1) for key in state.keys), dtype=np.int64, count=n)
+        reuse = old_rows >= 0
+        assign = np.empty(n, dtype=np.int32)
+        codes = np.empty((n, len(self.subspaces)), dtype=np.uint8)
+        assign[reuse] = previous.assign[old_rows[reuse]]
+        codes[reuse] = previous.codes[old_rows[reuse]]
+        new_rows = np.flatnonzero(~reuse)
+        if new_rows.size:
+            assign[new_rows], codes[new_rows] = self._encode(state, new_rows, previous.scales,
+                                                             previous.centroids, previous.codebooks)
+        return IvfPqState(state, previous.trained_on, previous.scales, previous.centroids, previous.codebooks,
+                          assign, codes)
+
+    def _run(self):
+        while True:
+            state = self.index.state
+            trained = self.trained
+            if trained is None or trained.state is not state:
+                try:
+                    self.trained = self.build(state, self._weights, trained)
+                    self.builds += 1
+                    self.last_error = None
+                except Exception as e:
+                    logger.exception("IVF-PQ build failed, retrying in %.0fs", self.retry_interval)
+                    with self._lock:
+                        # Queries stay exact until the retry, instead of starting a build each
+                        self.failures += 1
+                        self.last_error = f"{type(e).__name__}: {e}"
+                        self._retry_at = time.monotonic() + self.retry_interval
+                        self._thread = None
+                    return
+            with self._lock:
+                # Stop once caught up, checked under the lock sync() starts threads with
+                if self.index.state is state:
+                    self._thread = None
+                    return
+
+    def sync(self, weights=None, wait=False):
+        """
+        Bring the IVF-PQ structures in line with the DescriptorIndex.
+
+        Starts the background build when they are stale; with `wait`, blocks
+        until it finished (benchmarks, recall reports). No build is started
+        within retry_interval of a failed one.
+        """
+        if not self.ready:
+            with self._lock:
+                if weights is not None:
+                    self._weights = weights
+                if self._thread is None and time.monotonic() >= self._retry_at:
+                    self._thread = threading.Thread(target=self._run, name="ann-build", daemon=True)
+                    self._thread.start()
+                thread = self._thread
+            if wait and thread is not None:
+                thread.join()
+        return self.trained
+
+    def search_rows(self, query_descriptor, top_n=5, nprobe=None, rerank=None, categories=None, **weights):
+        """
+        Approximate top N rows for a query.
+
+        With `categories`, inverted-list entries outside their partitions are
+        skipped and more lists are probed until `rerank` candidates are found;
+        partitions smaller than the rerank depth are scored exactly.
+
+        Returns:
+            tuple: (state, rows, exact scores) of the top N images.
+        """
+        weights = {**DEFAULT_WEIGHTS, **weights}
+        trained = self.sync(weights)
+        if trained is None or trained.state is not self.index.state:
+            # Still training or catching up with the corpus: exact search meanwhile
+            return self.index.search_rows(query_descriptor, top_n, categories=categories, **weights)
+        state = trained.state
+        empty = np.empty(0, dtype=np.int64)
+
+        q = flatten_descriptor(query_descriptor)
+        if q is None:
+            raise ValueError("Query descriptor is missing descriptor families")
+        centroids, codebooks = trained.centroids, trained.codebooks
+        nprobe = max(1, min(nprobe or self.nprobe, len(centroids)))
+        rerank = max(rerank or self.rerank, top_n)
+
+        allowed = None
+        partition = state.category_rows(categories)
+        if partition is not None:
+            if len(partition) <= rerank:
+                scores = self.index.scores(query_descriptor, rows=partition, state=state, **weights)
+                best = top_n_rows(scores, top_n)
+                return state, partition[best], scores[best]
+            allowed = np.zeros(len(state), dtype=bool)
+            allowed[partition] = True
+
+        # Query weights relative to the training weights, squared for L2 tables
+        coefficients = family_coefficients(**weights)
+        ratio2 = {name: (coefficients[name] / trained.scales[name]) ** 2 for name in FAMILY_NAMES}
+        qv = np.concatenate([q[name] * np.float32(trained.scales[name]) for name in FAMILY_NAMES])
+
+        diff2 = (centroids - qv) ** 2
+        coarse = sum(diff2[:, self.family_slices[name]].sum(axis=1) * ratio2[name] for name in FAMILY_NAMES)
+        # Without a category filter exactly nprobe lists are visited; with one, further
+        # lists are probed until the partition yielded enough candidates to rerank
+        probe = np.argsort(coarse) if allowed is not None else np.argsort(coarse)[:nprobe]
+
+        candidates, approx = [], []
+        found = 0
+        m_range = np.arange(len(self.subspaces))
+        for probed, lst in enumerate(probe):
+            if probed >= nprobe and found >= rerank:
+                break
+            rows = trained.order[trained.offsets[lst]:trained.offsets[lst + 1]]
+            if allowed is not None:
+                rows = rows[allowed[rows]]
+            if not rows.size:
+                continue
+            found += rows.size
+            residual = qv - centroids[lst]
+            table = np.stack([
+                ((codebooks[m] - residual[cols]) ** 2).sum(axis=1) * ratio2[name]
+                for m, (name, cols) in enumerate(self.subspaces)
+            ])
+            candidates.append(rows)
+            approx.append(table[m_range, trained.codes[rows]].sum(axis=1))
+
+        if not candidates:
+            return state, empty, np.empty(0)
+        candidates = np.concatenate(candidates)
+        approx = np.concatenate(approx)
+
+        # Exact rerank of the best approximate candidates
+        candidates = candidates[top_n_rows(approx, rerank)]
+        scores = self.index.scores(query_descriptor, rows=candidates, state=state, **weights)
+        best = top_n_rows(scores, top_n)
+        return state, candidates[best], scores[best]
+
+    def search(self, query_descriptor, top_n=5, nprobe=None, rerank=None, categories=None, **weights):
+        """Approximate equivalent of DescriptorIndex.search."""
+        state, rows, scores = self.search_rows(query_descriptor, top_n, nprobe, rerank, categories, **weights)
+        return self.index.results(rows, scores, state=state)
+
+    def stats(self):
+        trained = self.trained
+        return {
+            "ready": self.ready,
+            "building": self._thread is not None,
+            "builds": self.builds,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "size": 0 if trained is None else len(trained.state),
+            "trained_on": 0 if trained is None else trained.trained_on,
+            "nlist": 0 if trained is None else len(trained.centroids),
+            "subspaces": len(self.subspaces),
+            "nprobe": self.nprobe,
+            "rerank": self.rerank,
+        }
+
+
+def recall_report(ann, configs, queries=50, top_k=10, seed=0, **weights):
+    """
+    Recall@k and latency of ANN configurations against the exact ranking.
+
+    Queries are sampled from the indexed images themselves.
+
+    Parameters:
+        ann (AnnIndex): Index to evaluate.
+        configs (list): (nprobe, rerank) pairs to evaluate.
+        queries (int): Number of sampled query images.
+        top_k (int): Depth of the compared rankings.
+
+    Returns:
+        dict: Exact latency and recall / latency for every configuration.
+    """
+    weights = {**DEFAULT_WEIGHTS, **weights}
+    if ann.sync(weights, wait=True) is None:
+        return {"queries": 0, "exact_ms": None, "configs": []}
+
+    def searcher(nprobe, rerank):
+        return lambda state, q, k: ann.search_rows(q, top_n=k, nprobe=nprobe, rerank=rerank, **weights)[1]
+
+    return evaluate_recall(ann.index, [({"nprobe": nprobe, "rerank": rerank}, searcher(nprobe, rerank))
+                                       for nprobe, rerank in configs],
+                           queries=queries, top_k=top_k, seed=seed, **weights)
@@ -0,0 +1,506 @@
+"""
+Reproducible performance benchmarks of the image service.
+
+Usage (from the api folder):
+
+    python benchmark.py [--suites descriptors,search,feedback,endpoints] [--sizes 1000,10000,100000]
+                        [--resolutions 256,1024,3000] [--modes exact,cascade] [--repeat 5]
+                        [--mongo-uri mongodb://localhost:27017] [--database image_benchmark]
+                        [--output benchmark-results.json] [--baseline baseline.json]
+                        [--tolerance 0.15] [--fail-on-regression]
+
+Everything runs offline. Without --mongo-uri the service runs on top of
+mongomock (pip install mongomock). With it, a dedicated database of a local
+mongod is used and dropped afterwards. Images are synthetic and seeded, so two
+runs on the same machine measure the same work.
+
+Suites:
+
+    descriptors  every descriptor helper, calculate_img_descriptors and
+                 describe_image_bytes, per image resolution
+    search       exact / cascade / ann / batch / category / near-duplicate
+                 search, the legacy simple_search and end-to-end /search, per
+                 corpus size
+    feedback     query_point_movement2, the indexed feedback lookup and
+                 /search with relevance feedback, per corpus size
+    endpoints    /calculate-descriptors and /transform, per image resolution
+
+Corpora are the descriptors of a pool of synthetic images, jittered up to the
+requested size. They are served from a memory-mapped snapshot, like a large
+deployment. Sizes up to --mongo-max are also stored in the collection to time
+the Mongo-backed index build. A 1M corpus needs about 4.2 GB of disk and page
+cache.
+
+Every benchmark reports min / median / mean milliseconds over --repeat runs,
+after one warm-up run. It also reports the peak traced allocation of one extra
+run (tracemalloc); the process max RSS is reported at the end. With
+--baseline, medians are compared with a previous result file, and benchmarks
+slower by more than --tolerance are listed.
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from dotenv import dotenv_values
+
+from descriptor_snapshot import DescriptorSnapshot, write_snapshot
+from descriptor_store import PACKED_FIELD, pack_descriptors
+from descriptors import (
+    DESCRIPTOR_MODE, calculate_average_color, calculate_color_histogram,
+    calculate_dominant_colors, calculate_edge_histogram, calculate_hu_moments, calculate_img_descriptors,
+    calculate_texture_descriptors, describe_image_bytes
+)
+from feedback import feedback_weights, resolve_norms
+from perceptual_hash import HASH_FIELD, image_hashes, parse_hashes, split_hashes
+from search_index import DESCRIPTOR_FAMILIES, FAMILY_NAMES, DescriptorIndex, IndexState, flatten_descriptor
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: max RSS is not reported there
+    resource = None
+
+
+SUITES = ("descriptors", "search", "feedback", "endpoints")
+DEFAULT_SIZES = (1000, 10000, 100000)
+DEFAULT_RESOLUTIONS = (256, 1024, 3000)
+CATEGORIES = 8
+FEEDBACK_IMAGES = 5
+BATCH_QUERIES = 16
+WEIGHTS = {"w1": 0.1, "w2": 0.8, "w3": 0.1, "frame_weights": (0.7, 0.3), "color_weights": (0.4, 0.1, 0.5)}
+
+
+def synthetic_image(side, seed):
+    """
+    Seeded 4:3 BGR test image whose longest side is `side` pixels.
+
+    A smooth color field with filled shapes and sensor-like noise, so that
+    contours, edges, texture and colors all have something to describe.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = side, max(1, side * 3 // 4)
+    field = rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)
+    image = cv2.resize(field, (width, height), interpolation=cv2.INTER_CUBIC)
+    for _ in range(6):
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        if rng.random() < 0.5:
+            cv2.circle(image, center, int(rng.integers(side // 20 + 1, side // 5 + 2)), color, -1)
+        else:
+            corner = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+            cv2.rectangle(image, center, corner, color, -1)
+    noise = rng.normal(0, 6, image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def encode_jpeg(image, quality=90):
+    return cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def measure(fn, repeat, trace_memory=True):
+    """Time `repeat` calls of `fn` after a warm-up call, then trace the allocations of one more."""
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    result = {
+        "repeat": repeat,
+        "min_ms": min(times) * 1000,
+        "median_ms": statistics.median(times) * 1000,
+        "mean_ms": statistics.fmean(times) * 1000,
+    }
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            fn()
+            result["peak_kb"] = tracemalloc.get_traced_memory()[1] / 1024
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def result_key(result):
+    """Identity of a benchmark across result files: name[param=value,...]."""
+    params = ",".join(f"{k}={v}" for k, v in sorted(result["params"].items()))
+    return f"{result['name']}[{params}]"
+
+
+class Runner:
+    """Runs benchmarks and collects their results; a failing benchmark is recorded, not fatal."""
+
+    def __init__(self, repeat, trace_memory=True):
+        self.repeat = repeat
+        self.trace_memory = trace_memory
+        self.results = []
+
+    def run(self, name, fn, repeat=None, **params):
+        result = {"name": name, "params": params}
+        try:
+            result.update(measure(fn, repeat or self.repeat, self.trace_memory))
+            peak = f", peak {result['peak_kb']:.0f} KB" if "peak_kb" in result else ""
+            print(f"{result_key(result):<60} {result['median_ms']:10.2f} ms  (min {result['min_ms']:.2f}{peak})",
+                  flush=True)
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+            print(f"{result_key(result):<60} failed: {result['error']}", flush=True)
+        self.results.append(result)
+        return result
+
+
+def expect_ok(response):
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code}: {response.get_data(as_text=True)[:200]}")
+    return response
+
+
+def upload(data, filename="query.jpg"):
+    return io.BytesIO(data), filename
+
+
+class Corpus:
+    """
+    Synthetic descriptor corpus: descriptors of a pool of real images, jittered per row.
+
+    Parameters:
+        pool (int): Number of synthetic images actually described.
+        side (int): Resolution of the pool images.
+    """
+
+    def __init__(self, pool=64, side=256, seed=0):
+        self.seed = seed
+        flats, hashes = [], []
+        for i in range(pool):
+            descriptor, image_hash = split_hashes(calculate_img_descriptors(synthetic_image(side, seed + i)))
+            flats.append(flatten_descriptor(descriptor))
+            hashes.append(parse_hashes(image_hash))
+        self.pool = {name: np.stack([flat[name] for flat in flats]) for name in FAMILY_NAMES}
+        self.hashes = np.array(hashes, dtype=np.uint64)
+
+    def state(self, size, chunk=65536):
+        """IndexState of `size` jittered rows (string keys, like a snapshot)."""
+        rng = np.random.default_rng(self.seed + size)
+        picks = rng.integers(0, len(self.hashes), size)
+        matrices = {}
+        for name, width in DESCRIPTOR_FAMILIES:
+            matrix = np.empty((size, width), dtype=np.float32)
+            for start in range(0, size, chunk):
+                block = self.pool[name][picks[start:start + chunk]]
+                matrix[start:start + chunk] = block * rng.uniform(0.9, 1.1, block.shape).astype(np.float32)
+            matrices[name] = matrix
+        # Every row is a one bit variant of its pool image: plenty of near duplicates
+        flips = np.left_shift(np.uint64(1), rng.integers(0, 64, size).astype(np.uint64))
+        hashes = self.hashes[picks].copy()
+        hashes[:, 0] ^= flips
+        return IndexState([f"{i:024x}" for i in range(size)],
+                          np.array([f"synthetic_{i}.jpg" for i in range(size)], dtype=object),
+                          np.array([f"category_{i % CATEGORIES}" for i in range(size)], dtype=object),
+                          matrices, hashes, np.ones(size, dtype=bool))
+
+
+def legacy_documents(state, rows):
+    """Image documents in the nested 'characteristics' format read by simple_search."""
+    return [{"filename": state.filenames[row],
+             "characteristics": {name: state.matrices[name][row].tolist() for name in FAMILY_NAMES}}
+            for row in rows]
+
+
+def store_documents(collection, state, batch_size=1000):
+    """Insert the rows of a state as packed image documents."""
+    collection.delete_many({})
+    for start in range(0, len(state), batch_size):
+        docs = []
+        for row in range(start, min(start + batch_size, len(state))):
+            phash, dhash = (int(h) for h in state.hashes[row])
+            docs.append({
+                "filename": state.filenames[row],
+                "category": state.categories[row],
+                PACKED_FIELD: pack_descriptors({name: state.matrices[name][row] for name in FAMILY_NAMES}),
+                HASH_FIELD: {"phash": f"{phash:016x}", "dhash": f"{dhash:016x}"},
+            })
+        collection.insert_many(docs)
+
+
+def descriptor_suite(runner, resolutions):
+    helpers = {
+        "color_histogram": calculate_color_histogram,
+        "dominant_colors": calculate_dominant_colors,
+        "texture_descriptors": calculate_texture_descriptors,
+        "hu_moments": calculate_hu_moments,
+        "average_color": calculate_average_color,
+        "edge_histogram": calculate_edge_histogram,
+        "perceptual_hash": image_hashes,
+    }
+    for side in resolutions:
+        image = synthetic_image(side, 1000 + side)
+        data = encode_jpeg(image)
+        for name, helper in helpers.items():
+            runner.run(f"descriptor.{name}", lambda: helper(image), resolution=side)
+        runner.run("descriptor.calculate_img_descriptors", lambda: calculate_img_descriptors(image), resolution=side)
+        runner.run("descriptor.describe_image_bytes", lambda: describe_image_bytes("image.jpg", data), resolution=side)
+
+
+def endpoint_suite(runner, client, resolutions, batch_images):
+    for side in resolutions:
+        payloads = [encode_jpeg(synthetic_image(side, 2000 + side + i)) for i in range(batch_images)]
+
+        def calculate_descriptors():
+            expect_ok(client.post("/calculate-descriptors", data={
+                "images": [upload(data, f"image_{i}.jpg") for i, data in enumerate(payloads)]
+            }))
+
+        def transform():
+            expect_ok(client.post("/transform", data={
+                "image": upload(payloads[0]), "resize_dims": f"{side // 2},{side * 3 // 8}", "rotate_angle": "15",
+            }))
+
+        runner.run("endpoint.calculate_descriptors", calculate_descriptors, resolution=side, images=batch_images)
+        runner.run("endpoint.transform", transform, resolution=side)
+
+
+def corpus_suites(runner, images, client, corpus, sizes, suites, modes, query_side, mongo_max, legacy_max):
+    """Search and feedback benchmarks, per corpus size (served from a snapshot)."""
+    query_image = synthetic_image(query_side, 3000)
+    query_data = encode_jpeg(query_image)
+    query = calculate_img_descriptors(query_image)
+    query_hashes = parse_hashes(split_hashes(query)[1])
+    batch = [calculate_img_descriptors(synthetic_image(256, 4000 + i)) for i in range(BATCH_QUERIES)]
+    index = images.search_index
+
+    with tempfile.TemporaryDirectory(prefix="image-benchmark-") as tmp:
+        for size in sizes:
+            state = corpus.state(size)
+            path = os.path.join(tmp, f"corpus-{size}.snapshot")
+            write_snapshot(path, state)
+            del state
+            runner.run("index.open_snapshot", lambda: DescriptorSnapshot(path).to_state(), size=size)
+            # The service index now serves this corpus
+            index.snapshot = DescriptorSnapshot(path)
+            index.refresh(force=True)
+            state = index.state
+
+            if size <= mongo_max:
+                store_documents(images.collection, state)
+                runner.run("index.build_mongo", lambda: DescriptorIndex(images.collection).refresh(force=True),
+                           repeat=min(runner.repeat, 3), size=size)
+
+            rng = np.random.default_rng(size)
+            feedback_rows = rng.choice(size, 2 * FEEDBACK_IMAGES, replace=False)
+            relevant = [state.filenames[row] for row in feedback_rows[:FEEDBACK_IMAGES]]
+            irrelevant = [state.filenames[row] for row in feedback_rows[FEEDBACK_IMAGES:]]
+
+            if "search" in suites:
+                if "exact" in modes:
+                    runner.run("search.exact", lambda: index.search(query, top_n=10, **WEIGHTS), size=size)
+                    runner.run("search.category", lambda: index.search(query, top_n=10, categories=("category_0",),
+                                                                       **WEIGHTS), size=size)
+                if "cascade" in modes:
+                    runner.run("search.cascade", lambda: index.cascade_search(query, top_n=10, **WEIGHTS), size=size)
+                if "ann" in modes:
+                    # Train the IVF-PQ index for this corpus before timing queries against it
+                    images.ann_index.sync(WEIGHTS, wait=True)
+                    runner.run("search.ann", lambda: images.ann_index.search(query, top_n=10, **WEIGHTS), size=size)
+                runner.run("search.batch", lambda: index.search_batch(batch, top_n=10, **WEIGHTS),
+                           size=size, queries=BATCH_QUERIES)
+                runner.run("search.duplicates", lambda: index.duplicate_rows(query_hashes), size=size)
+                if size <= legacy_max:
+                    docs = legacy_documents(state, range(size))
+                    runner.run("search.simple_search", lambda: images.simple_search(query, docs, top_n=10, **WEIGHTS),
+                               repeat=min(runner.repeat, 3), size=size)
+                    del docs
+                for mode in modes:
+                    runner.run("endpoint.search", lambda: expect_ok(client.post("/search", data={
+                        "image": upload(query_data), "mode": mode,
+                    })), size=size, mode=mode, resolution=query_side)
+
+            if "feedback" in suites:
+                def indexed_feedback():
+                    relevant_norms, _ = resolve_norms(index, images.collection, relevant)
+                    irrelevant_norms, _ = resolve_norms(index, images.collection, irrelevant)
+                    return feedback_weights(*images.load_weights(), relevant_norms, irrelevant_norms)
+
+                docs = legacy_documents(state, feedback_rows)
+                runner.run("feedback.query_point_movement2", lambda: images.query_point_movement2(
+                    *images.load_weights(), docs[:FEEDBACK_IMAGES], docs[FEEDBACK_IMAGES:]), size=size)
+                runner.run("feedback.indexed", indexed_feedback, size=size)
+                characteristics = json.dumps({"relevant": relevant, "irrelevant": irrelevant})
+                runner.run("endpoint.search_feedback", lambda: expect_ok(client.post("/search", data={
+                    "image": upload(query_data), "characteristics": characteristics, "session": "benchmark",
+                })), size=size, resolution=query_side)
+
+            del state
+            images.collection.delete_many({})
+
+
+def compare(results, baseline, tolerance):
+    """
+    Median ratios against a baseline result file.
+
+    Returns:
+        dict: Compared benchmarks, regressions (slower beyond tolerance) and improvements.
+    """
+    base = {result_key(r): r for r in baseline.get("results", []) if "median_ms" in r}
+    compared, regressions, improvements = [], [], []
+    for result in results:
+        key = result_key(result)
+        if key not in base or "median_ms" not in result:
+            continue
+        ratio = result["median_ms"] / max(base[key]["median_ms"], 1e-9)
+        entry = {"benchmark": key, "baseline_ms": base[key]["median_ms"], "median_ms": result["median_ms"],
+                 "ratio": ratio}
+        compared.append(entry)
+        if ratio > 1 + tolerance:
+            regressions.append(entry)
+        elif ratio < 1 - tolerance:
+            improvements.append(entry)
+    return {"tolerance": tolerance, "compared": compared, "regressions": regressions, "improvements": improvements}
+
+
+def environment_info(args, backend):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, timeout=5,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "backend": backend,
+        "descriptor_version": DESCRIPTOR_MODE.version,
+        "dominant_colors_tier": DESCRIPTOR_MODE.dominant_colors_tier,
+        "args": vars(args),
+    }
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark descriptor extraction, search and feedback.")
+    parser.add_argument("--suites", default=",".join(SUITES), help=f"Comma separated subset of {SUITES}")
+    parser.add_argument("--sizes", type=int_list, default=list(DEFAULT_SIZES), help="Corpus sizes (descriptors)")
+    parser.add_argument("--resolutions", type=int_list, default=list(DEFAULT_RESOLUTIONS),
+                        help="Longest side of the synthetic images, in pixels")
+    parser.add_argument("--query-resolution", type=int, default=1024, help="Longest side of the /search query image")
+    parser.add_argument("--modes", default="exact,cascade", help="Search modes: exact, cascade, ann")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per benchmark (after one warm-up)")
+    parser.add_argument("--pool", type=int, default=64, help="Distinct images behind the synthetic corpora")
+    parser.add_argument("--batch-images", type=int, default=4, help="Images per /calculate-descriptors request")
+    parser.add_argument("--mongo-max", type=int, default=10000,
+                        help="Largest corpus also stored in the collection (index build from MongoDB)")
+    parser.add_argument("--legacy-max", type=int, default=10000, help="Largest corpus timed with simple_search")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc peak memory runs")
+    parser.add_argument("--mongo-uri", default=None, help="Local mongod to use instead of mongomock")
+    parser.add_argument("--database", default="image_benchmark", help="Database used (and dropped) with --mongo-uri")
+    parser.add_argument("--output", default="benchmark-results.json", help="Result file")
+    parser.add_argument("--baseline", default=None, help="Previous result file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Relative median change reported")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 on regressions")
+    args = parser.parse_args()
+
+    suites = [s for s in args.suites.split(",") if s]
+    unknown = [s for s in suites if s not in SUITES]
+    modes = [m for m in args.modes.split(",") if m]
+    if unknown or any(m not in ("exact", "cascade", "ann") for m in modes):
+        parser.error(f"Unknown suites {unknown} or modes {modes}")
+
+    # The service reads its configuration at import time: point it at a throwaway
+    # database, and disable the caches and background work that would skew timings
+    if args.database == dotenv_values().get("DATABASE_NAME"):
+        parser.error("--database must not be the database of the service (.env DATABASE_NAME)")
+    os.environ["DATABASE_NAME"] = args.database
+    os.environ["COLLECTION_NAME"] = "images"
+    os.environ.pop("DESCRIPTOR_SNAPSHOT", None)
+    os.environ.setdefault("DESCRIPTOR_WORKERS", "1")
+    os.environ.setdefault("QUERY_CACHE_MB", "0")
+    os.environ.setdefault("WEIGHTS_FLUSH_INTERVAL", "3600")
+    os.environ.setdefault("INDEX_REFRESH_INTERVAL", "3600")
+
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+        backend = "mongodb"
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("mongomock is required to run offline (pip install mongomock), or pass --mongo-uri")
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+        backend = "mongomock"
+
+    import images
+    images.create_app()
+
+    runner = Runner(args.repeat, trace_memory=not args.no_memory)
+    client = images.app.test_client()
+    start = time.perf_counter()
+    try:
+        if "descriptors" in suites:
+            descriptor_suite(runner, args.resolutions)
+        if "search" in suites or "feedback" in suites:
+            corpus = Corpus(pool=args.pool)
+            corpus_suites(runner, images, client, corpus, args.sizes, suites, modes,
+                          args.query_resolution, args.mongo_max, args.legacy_max)
+        if "endpoints" in suites:
+            endpoint_suite(runner, client, args.resolutions, args.batch_images)
+    finally:
+        if args.mongo_uri:
+            images.client.drop_database(args.database)
+
+    output = {"environment": environment_info(args, backend), "seconds": time.perf_counter() - start,
+              "results": runner.results}
+    if resource is not None:
+        # Kilobytes on Linux, bytes on macOS
+        output["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f"max RSS: {output['max_rss']}")
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        output["comparison"] = compare(runner.results, baseline, args.tolerance)
+        comparison = output["comparison"]
+        # Same benchmark names, different work: the ratios are meaningless
+        base_env = baseline.get("environment", {})
+        for key in ("descriptor_version", "dominant_colors_tier", "backend"):
+            if base_env.get(key) != output["environment"][key]:
+                print(f"warning: {key} differs from the baseline ({base_env.get(key)} != {output['environment'][key]})")
+        if base_env.get("args", {}).get("pool") != args.pool:
+            print("warning: the baseline corpora were built from a different --pool")
+        print(f"compared {len(comparison['compared'])} benchmarks with {args.baseline}: "
+              f"{len(comparison['regressions'])} slower, {len(comparison['improvements'])} faster "
+              f"(tolerance {args.tolerance:.0%})")
+        for label, entries in (("slower", comparison["regressions"]), ("faster", comparison["improvements"])):
+            for entry in entries:
+                print(f"  {label:<7}{entry['benchmark']:<60} {entry['baseline_ms']:10.2f} -> "
+                      f"{entry['median_ms']:10.2f} ms (x{entry['ratio']:.2f})")
+        if comparison["regressions"] and args.fail_on_regression:
+            status = 1
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(output, f, indent=2, default=str)
+    print(f"results written to {args.output}")
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
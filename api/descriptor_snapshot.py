@@ -0,0 +1,342 @@
+"""
+Memory-mapped on-disk snapshot of the descriptor corpus.
+
+One file holds every descriptor family as a contiguous float32 block plus the
+id / filename / category table, so any number of search workers can open it
+read-only with np.memmap and share the OS page cache:
+
+    [0, 4096)       magic b'IDXSNAP1' | header length (u64) | header JSON
+    family blocks   capacity x width float32 per family, 64 byte aligned
+    tombstones      capacity x u8, 1 for rows whose document was deleted
+    table           JSON list of [id, filename, category, phash, dhash], always last
+                    (hex hashes, null for unhashed rows; older files have 3 columns)
+
+Rows are appended into the spare capacity in place (the header row count is
+written last, so readers never see half written rows). Deletions are never
+left as tombstones by append: it compacts instead, rewriting the file without
+the deleted rows and atomically replacing it, so workers keep serving straight
+from the mapped pages. Documents rewritten in place (their UPDATED_FIELD moved
+past the newest value recorded in the header) are re-fetched the same way.
+
+Usage (from the api folder, with the same .env as images.py):
+
+    python descriptor_snapshot.py export  [--path descriptors.snapshot]
+    python descriptor_snapshot.py append  [--path descriptors.snapshot]
+    python descriptor_snapshot.py compact [--path descriptors.snapshot]
+"""
+import argparse
+import datetime
+import json
+import os
+import struct
+import time
+
+import numpy as np
+from bson import ObjectId
+
+from perceptual_hash import parse_hashes
+from search_index import (
+    DESCRIPTOR_FAMILIES, INDEX_PROJECTION, UPDATED_FIELD, DescriptorIndex, IndexState, build_state
+)
+
+
+MAGIC = b"IDXSNAP1"
+SNAPSHOT_VERSION = 1
+HEADER_SIZE = 4096
+ALIGNMENT = 64
+DEFAULT_SNAPSHOT_PATH = "descriptors.snapshot"
+
+
+def _align(offset):
+    return offset + (-offset % ALIGNMENT)
+
+
+def _layout(capacity):
+    """Byte offsets of every block for a given row capacity."""
+    offset = HEADER_SIZE
+    families = []
+    for name, width in DESCRIPTOR_FAMILIES:
+        families.append([name, width, offset])
+        offset = _align(offset + capacity * width * 4)
+    tombstones_offset = offset
+    table_offset = _align(tombstones_offset + capacity)
+    return families, tombstones_offset, table_offset
+
+
+def _read_header(f):
+    f.seek(0)
+    raw = f.read(HEADER_SIZE)
+    if raw[:8] != MAGIC:
+        raise ValueError("Not a descriptor snapshot")
+    (length,) = struct.unpack_from("<Q", raw, 8)
+    header = json.loads(raw[16:16 + length])
+    if header["version"] != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version {header['version']}")
+    return header
+
+
+def _write_header(f, header):
+    encoded = json.dumps(header).encode("utf-8")
+    if 16 + len(encoded) > HEADER_SIZE:
+        raise ValueError("Snapshot header too large")
+    f.seek(0)
+    f.write(MAGIC + struct.pack("<Q", len(encoded)) + encoded)
+
+
+def _table_rows(state):
+    """Table entries of the rows of an index state."""
+    return [[str(key), filename, category] + ([f"{phash:016x}", f"{dhash:016x}"] if hashed else [None, None])
+            for key, filename, category, (phash, dhash), hashed in zip(
+                state.keys, state.filenames.tolist(), state.categories.tolist(),
+                state.hashes.tolist(), state.hashed.tolist())]
+
+
+def _write_table(f, header, table):
+    f.seek(header["table_offset"])
+    encoded = json.dumps(table).encode("utf-8")
+    f.write(encoded)
+    f.truncate()
+    header["table_length"] = len(encoded)
+
+
+def write_snapshot(path, state, capacity=None, max_updated=None):
+    """
+    Write an index state to a new snapshot file, atomically replacing `path`.
+
+    :param state: IndexState holding the rows to export.
+    :param capacity: Row capacity, defaults to 25% spare room for appends.
+    :param max_updated: Newest UPDATED_FIELD value (ISO format) reflected in `state`.
+    """
+    rows = len(state)
+    capacity = max(capacity or int(rows * 1.25) + 1024, rows)
+    families, tombstones_offset, table_offset = _layout(capacity)
+    header = {
+        "version": SNAPSHOT_VERSION,
+        "rows": rows,
+        "capacity": capacity,
+        "families": families,
+        "tombstones_offset": tombstones_offset,
+        "table_offset": table_offset,
+        "table_length": 0,
+        "max_id": max(map(str, state.keys)) if rows else None,
+        "max_updated": max_updated,
+        "generation": 0,
+    }
+    table = _table_rows(state)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.truncate(table_offset)
+        for name, width, offset in families:
+            f.seek(offset)
+            f.write(np.ascontiguousarray(state.matrices[name], dtype=np.float32).tobytes())
+        _write_table(f, header, table)
+        _write_header(f, header)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return header
+
+
+class DescriptorSnapshot:
+    """
+    Read-only view of a snapshot file.
+
+    The family matrices are np.memmap views, nothing is copied unless the file
+    holds tombstoned rows (only files written by older versions of append).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.open()
+
+    def _stat(self):
+        st = os.stat(self.path)
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def open(self):
+        self.stat = self._stat()
+        with open(self.path, "rb") as f:
+            self.header = _read_header(f)
+            f.seek(self.header["table_offset"])
+            self.table = json.loads(f.read(self.header["table_length"]))
+
+        rows = self.header["rows"]
+        self.matrices = {}
+        for name, width, offset in self.header["families"]:
+            if rows:
+                self.matrices[name] = np.memmap(self.path, dtype=np.float32, mode="r",
+                                                offset=offset, shape=(rows, width))
+            else:
+                self.matrices[name] = np.empty((0, width), dtype=np.float32)
+        self.tombstones = (np.memmap(self.path, dtype=np.uint8, mode="r",
+                                     offset=self.header["tombstones_offset"], shape=(rows,))
+                           if rows else np.empty(0, dtype=np.uint8))
+
+    def changed(self):
+        """True when the file was appended to or replaced since it was opened."""
+        try:
+            return self._stat() != self.stat
+        except FileNotFoundError:
+            return False
+
+    def to_state(self):
+        """Index state backed by the memory-mapped matrices."""
+        rows = self.header["rows"]
+        table = self.table[:rows]
+        hashes = [parse_hashes({"phash": entry[3], "dhash": entry[4]}) if len(entry) > 4 else None
+                  for entry in table]
+        state = IndexState([entry[0] for entry in table],
+                           np.array([entry[1] for entry in table], dtype=object),
+                           np.array([entry[2] for entry in table], dtype=object),
+                           self.matrices,
+                           np.array([h or (0, 0) for h in hashes], dtype=np.uint64).reshape(rows, 2),
+                           np.array([h is not None for h in hashes], dtype=bool))
+
+        live = self.tombstones == 0
+        if not live.all():
+            # Copies the rows; append compacts instead of leaving tombstones behind
+            state = state.select(live)
+        return state
+
+
+def append_snapshot(path, collection):
+    """
+    Append documents inserted since the snapshot was written.
+
+    Falls back to a compaction when documents were deleted (tombstoned rows
+    would make every worker copy the live rows out of the mapping) or updated
+    in place, or when the spare capacity is exhausted.
+
+    :return: Dict with the number of appended, deleted and updated rows.
+    """
+    # Read before the changes, so documents updated meanwhile are caught by the next append
+    max_updated = _max_updated(collection)
+    with open(path, "r+b") as f:
+        header = _read_header(f)
+        f.seek(header["table_offset"])
+        table = json.loads(f.read(header["table_length"]))
+
+        new_state = _newer_documents(collection, header["max_id"])
+        rows, added = header["rows"], len(new_state)
+
+        live_ids = _live_ids(collection)
+        deleted = [row for row, entry in enumerate(table[:rows]) if entry[0] not in live_ids]
+        updated_ids = _updated_ids(collection, header.get("max_updated"))
+        updated = [row for row, entry in enumerate(table[:rows]) if entry[0] in updated_ids]
+
+        if deleted or updated or rows + added > header["capacity"]:
+            f.close()
+            compact_snapshot(path, collection)
+            return {"appended": added, "deleted": len(deleted), "updated": len(updated), "compacted": True}
+
+        if added:
+            for name, width, offset in header["families"]:
+                block = np.memmap(f, dtype=np.float32, mode="r+", offset=offset, shape=(header["capacity"], width))
+                block[rows:rows + added] = new_state.matrices[name]
+                block.flush()
+            table = table[:rows] + _table_rows(new_state)
+            _write_table(f, header, table)
+            header["max_id"] = max(str(key) for key in new_state.keys)
+
+        # Row count last: readers only ever look at committed rows
+        header["rows"] = rows + added
+        header["max_updated"] = max_updated
+        header["generation"] += 1
+        _write_header(f, header)
+        f.flush()
+        os.fsync(f.fileno())
+
+    return {"appended": added, "deleted": 0, "updated": 0, "compacted": False}
+
+
+def _newer_documents(collection, max_id):
+    """Index state of the documents inserted after `max_id`."""
+    query = {"_id": {"$gt": ObjectId(max_id)}} if max_id else {}
+    return build_state(collection.find(query, INDEX_PROJECTION))[0]
+
+
+def _live_ids(collection):
+    return {str(doc["_id"]) for doc in collection.find({}, {"_id": 1})}
+
+
+def _max_updated(collection):
+    """Newest UPDATED_FIELD value of the collection, in ISO format (None if no document has one)."""
+    doc = collection.find_one({UPDATED_FIELD: {"$exists": True}}, {UPDATED_FIELD: 1}, sort=[(UPDATED_FIELD, -1)])
+    return doc[UPDATED_FIELD].isoformat() if doc else None
+
+
+def _updated_query(max_updated):
+    """Documents updated after `max_updated` (every updated document for older snapshots without it)."""
+    if max_updated is None:
+        return {UPDATED_FIELD: {"$exists": True}}
+    return {UPDATED_FIELD: {"$gt": datetime.datetime.fromisoformat(max_updated)}}
+
+
+def _updated_ids(collection, max_updated):
+    return {str(doc["_id"]) for doc in collection.find(_updated_query(max_updated), {"_id": 1})}
+
+
+def compact_snapshot(path, collection=None):
+    """
+    Rewrite the snapshot without tombstoned rows.
+
+    When a collection is given, documents deleted from it are dropped, the rows
+    of documents updated in place are re-fetched and newer documents are added,
+    so this also works when the spare capacity is full.
+    """
+    snapshot = DescriptorSnapshot(path)
+    state = snapshot.to_state()
+    max_updated = snapshot.header.get("max_updated")
+    if collection is not None:
+        latest_updated = _max_updated(collection)
+        live_ids = _live_ids(collection)
+        newer = _newer_documents(collection, snapshot.header["max_id"])
+        newer_ids = {str(key) for key in newer.keys}
+        updated = build_state(doc for doc in collection.find(_updated_query(max_updated), INDEX_PROJECTION)
+                              if str(doc["_id"]) not in newer_ids)[0]
+        updated_ids = {str(key) for key in updated.keys}
+        state = state.select(np.array([key in live_ids and key not in updated_ids for key in state.keys],
+                                      dtype=bool))
+        state = state.concat(updated).concat(newer)
+        max_updated = latest_updated
+
+    # Materialize the rows before the mapped file is replaced
+    state = IndexState([str(key) for key in state.keys], state.filenames, state.categories,
+                       {name: np.array(m) for name, m in state.matrices.items()}, state.hashes, state.hashed)
+    return write_snapshot(path, state, max_updated=max_updated)
+
+
+def export_snapshot(path, collection):
+    """Export every indexed document of `collection` to a new snapshot."""
+    max_updated = _max_updated(collection)
+    index = DescriptorIndex(collection)
+    index.refresh(force=True)
+    return write_snapshot(path, index.state, max_updated=max_updated)
+
+
+def main():
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Manage the memory-mapped descriptor snapshot.")
+    parser.add_argument("command", choices=["export", "append", "compact"])
+    parser.add_argument("--path", default=os.getenv('DESCRIPTOR_SNAPSHOT', DEFAULT_SNAPSHOT_PATH))
+    args = parser.parse_args()
+
+    load_dotenv()
+    client = MongoClient(os.getenv('MONGO_URI'))
+    collection = client[os.getenv('DATABASE_NAME')][os.getenv('COLLECTION_NAME')]
+
+    start = time.perf_counter()
+    if args.command == "export":
+        result = export_snapshot(args.path, collection)
+    elif args.command == "append":
+        result = append_snapshot(args.path, collection)
+    else:
+        result = compact_snapshot(args.path, collection)
+    print(f"{args.command}: {result} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
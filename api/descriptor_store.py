@@ -0,0 +1,117 @@
+"""
+Packed binary storage of image descriptors.
+
+Instead of nested BSON arrays of doubles, a packed document stores all its
+descriptors in one BSON Binary blob:
+
+    magic b'IDSC' | format version (u8) | dtype code (u8) | field count (u16)
+    for every field: name length (u8) | name | ndim (u8) | dims (u16 each)
+    zero padding up to an 8 byte boundary
+    the values of every field, concatenated in header order
+
+Loading is a single np.frombuffer over the blob, with no per-element Python objects.
+"""
+import struct
+
+import numpy as np
+from bson.binary import Binary, USER_DEFINED_SUBTYPE
+
+
+# Document field holding the packed blob
+PACKED_FIELD = "packed_descriptors"
+
+MAGIC = b"IDSC"
+FORMAT_VERSION = 1
+DTYPE_CODES = {"float32": 1, "float16": 2}
+CODE_DTYPES = {1: np.dtype("<f4"), 2: np.dtype("<f2")}
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+_HEADER = struct.Struct("<4sBBH")
+
+
+def pack_descriptors(descriptor, dtype="float32"):
+    """
+    Pack a descriptor dict into a versioned binary blob.
+
+    :param descriptor: Dict of descriptor name -> (nested) list or array of numbers.
+    :param dtype: 'float32' or 'float16'.
+    :return: bson Binary blob.
+    :raises ValueError: If a value does not fit in float16.
+    """
+    if dtype not in DTYPE_CODES:
+        raise ValueError(f"Unsupported dtype '{dtype}', expected one of {list(DTYPE_CODES)}")
+    np_dtype = CODE_DTYPES[DTYPE_CODES[dtype]]
+
+    arrays = {name: np.asarray(values, dtype=np.float64) for name, values in descriptor.items()}
+    if dtype == "float16":
+        too_large = [name for name, a in arrays.items() if a.size and np.abs(a).max() > FLOAT16_MAX]
+        if too_large:
+            raise ValueError(f"Values of {too_large} overflow float16")
+
+    header = bytearray(_HEADER.pack(MAGIC, FORMAT_VERSION, DTYPE_CODES[dtype], len(arrays)))
+    for name, a in arrays.items():
+        encoded = name.encode("utf-8")
+        header += struct.pack("<B", len(encoded)) + encoded
+        header += struct.pack(f"<B{a.ndim}H", a.ndim, *a.shape)
+    header += b"\0" * (-len(header) % 8)
+
+    values = b"".join(a.astype(np_dtype).tobytes() for a in arrays.values())
+    return Binary(bytes(header) + values, USER_DEFINED_SUBTYPE)
+
+
+def read_layout(blob):
+    """
+    Parse the header of a packed blob.
+
+    :return: Tuple (dtype, [(name, shape)], data offset).
+    """
+    magic, version, dtype_code, count = _HEADER.unpack_from(blob, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a packed descriptor blob")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported packed descriptor version {version}")
+
+    offset = _HEADER.size
+    fields = []
+    for _ in range(count):
+        (length,) = struct.unpack_from("<B", blob, offset)
+        name = bytes(blob[offset + 1:offset + 1 + length]).decode("utf-8")
+        offset += 1 + length
+        (ndim,) = struct.unpack_from("<B", blob, offset)
+        shape = struct.unpack_from(f"<{ndim}H", blob, offset + 1)
+        offset += 1 + 2 * ndim
+        fields.append((name, shape))
+    offset += -offset % 8
+    return CODE_DTYPES[dtype_code], fields, offset
+
+
+def unpack_descriptors(blob):
+    """
+    Zero-copy view of a packed blob.
+
+    :return: Dict of descriptor name -> read-only numpy array (float32 or float16).
+    """
+    dtype, fields, offset = read_layout(blob)
+    flat = np.frombuffer(blob, dtype=dtype, offset=offset)
+    descriptor = {}
+    start = 0
+    for name, shape in fields:
+        size = int(np.prod(shape))
+        descriptor[name] = flat[start:start + size].reshape(shape)
+        start += size
+    return descriptor
+
+
+def read_descriptors(doc):
+    """
+    Descriptors of an image document in either storage format.
+
+    Packed documents are preferred; documents that were not migrated yet fall
+    back to the legacy nested 'characteristics' arrays.
+
+    :return: Descriptor dict, or None if the document has no descriptors.
+    """
+    blob = doc.get(PACKED_FIELD)
+    if blob is not None:
+        return unpack_descriptors(blob)
+    return doc.get("characteristics")
@@ -0,0 +1,536 @@
+"""
+Image descriptor helpers.
+
+Kept free of Flask / MongoDB setup so worker processes can import them cheaply.
+"""
+import functools
+import os
+import time
+
+import struct
+
+import cv2
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from perceptual_hash import HASH_FIELD, image_hashes
+
+
+# Helper functions to calculate descriptors
+def calculate_color_histogram(image, normalize=False):
+    """Calculate color histogram for an image (bin fractions instead of pixel counts when `normalize`)."""
+    histogram = []
+    pixels = image.shape[0] * image.shape[1]
+    for i in range(3):  # Loop over color channels (B, G, R)
+        hist = cv2.calcHist([image], [i], None, [256], [0, 256])
+        if normalize:
+            hist /= max(pixels, 1)
+        histogram.append(hist.flatten().tolist())
+    return histogram
+
+# Seed shared by every dominant color engine so re-indexing an image is reproducible
+DOMINANT_COLORS_SEED = 0
+# Maximum number of pixels clustered by the subsampling engines
+DOMINANT_COLORS_SAMPLE = 20000
+# Quality tier used when calculate_dominant_colors is called without one
+DOMINANT_COLORS_TIER = os.getenv('DOMINANT_COLORS_TIER', 'high')
+# Largest number of dominant colors the report endpoint accepts
+MAX_DOMINANT_COLORS = 32
+
+
+def _nearest_color(pixels, centers, chunk=262144):
+    """Index of the closest center for every pixel."""
+    labels = np.empty(len(pixels), dtype=np.int64)
+    for start in range(0, len(pixels), chunk):
+        block = pixels[start:start + chunk]
+        d = ((block[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        labels[start:start + chunk] = np.argmin(d, axis=1)
+    return labels
+
+
+def _subsample(pixels, max_pixels=DOMINANT_COLORS_SAMPLE):
+    """Deterministic strided subsample of at most `max_pixels` pixels."""
+    step = max(1, int(np.ceil(len(pixels) / max_pixels)))
+    return pixels[::step]
+
+
+def _histogram_bins(pixels, levels=16):
+    """Quantize pixels into levels**3 color bins; returns (mean color, count) of non-empty bins."""
+    q = (pixels.astype(np.int32) * levels) // 256
+    bins = (q[:, 0] * levels + q[:, 1]) * levels + q[:, 2]
+    counts = np.bincount(bins, minlength=levels ** 3)
+    filled = np.flatnonzero(counts)
+    sums = np.stack([np.bincount(bins, weights=pixels[:, c], minlength=levels ** 3) for c in range(3)], axis=1)
+    return (sums[filled] / counts[filled, None]).astype(np.float32), counts[filled].astype(np.float64)
+
+
+def _histogram_seeds(colors, weights, k):
+    """
+    Deterministic k-means++ style seeds: the most populated bin first, then the bins
+    maximizing count * squared distance to the already chosen seeds.
+
+    Always k seeds: once every distinct bin is chosen, the most populated one is repeated.
+    """
+    seeds = [int(np.argmax(weights))]
+    min_d2 = ((colors - colors[seeds[0]]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        score = weights * min_d2
+        seeds.append(int(np.argmax(score)) if score.max() > 0 else seeds[0])
+        min_d2 = np.minimum(min_d2, ((colors - colors[seeds[-1]]) ** 2).sum(axis=1))
+    return colors[seeds].copy()
+
+
+def _dominant_colors_kmeans(pixels, k):
+    """Reference engine: cv2.kmeans over every pixel, 10 attempts, seeded RNG."""
+    cv2.setRNGSeed(DOMINANT_COLORS_SEED)
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 0.2)
+    _, labels, centers = cv2.kmeans(np.float32(pixels), k, None, criteria, 10, cv2.KMEANS_RANDOM_CENTERS)
+    return centers, np.bincount(labels.flatten())
+
+
+def _dominant_colors_subsample(pixels, k):
+    """cv2.kmeans++ over a strided pixel subsample, counts taken over every pixel."""
+    cv2.setRNGSeed(DOMINANT_COLORS_SEED)
+    sample = np.float32(_subsample(pixels))
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 0.2)
+    _, _, centers = cv2.kmeans(sample, k, None, criteria, 3, cv2.KMEANS_PP_CENTERS)
+    labels = _nearest_color(np.float32(pixels), centers)
+    return centers, np.bincount(labels, minlength=k)
+
+
+def _dominant_colors_minibatch(pixels, k, batch_size=1024, iterations=100):
+    """Mini-batch k-means seeded from the color histogram."""
+    rng = np.random.default_rng(DOMINANT_COLORS_SEED)
+    x = np.float32(pixels)
+    centers = _histogram_seeds(*_histogram_bins(pixels), k)
+    seen = np.zeros(len(centers))
+    for _ in range(iterations):
+        batch = x[rng.integers(0, len(x), batch_size)]
+        labels = _nearest_color(batch, centers)
+        counts = np.bincount(labels, minlength=len(centers))
+        hit = counts > 0
+        seen[hit] += counts[hit]
+        means = np.stack([np.bincount(labels, weights=batch[:, c], minlength=len(centers)) for c in range(3)], axis=1)
+        means[hit] /= counts[hit, None]
+        # Per-center learning rate 1 / (points seen so far)
+        rate = np.where(hit, counts / np.maximum(seen, 1), 0)[:, None]
+        centers = centers + rate * (means - centers)
+    labels = _nearest_color(x, centers)
+    return centers, np.bincount(labels, minlength=len(centers))
+
+
+def _dominant_colors_histogram(pixels, k, iterations=20):
+    """Weighted k-means over a 16x16x16 color histogram, seeded deterministically."""
+    colors, weights = _histogram_bins(_subsample(pixels, 4 * DOMINANT_COLORS_SAMPLE))
+    centers = _histogram_seeds(colors, weights, k)
+    for _ in range(iterations):
+        labels = _nearest_color(colors, centers)
+        mass = np.bincount(labels, weights=weights, minlength=len(centers))
+        hit = mass > 0
+        sums = np.stack([np.bincount(labels, weights=weights * colors[:, c], minlength=len(centers)) for c in range(3)], axis=1)
+        new_centers = centers.copy()
+        new_centers[hit] = sums[hit] / mass[hit, None]
+        if np.allclose(new_centers, centers):
+            break
+        centers = new_centers
+    return centers, mass
+
+
+# Pluggable dominant color engines: name -> fn(rgb pixels (N, 3) uint8, k) -> (centers, counts)
+DOMINANT_COLOR_ENGINES = {
+    "kmeans": _dominant_colors_kmeans,
+    "subsample": _dominant_colors_subsample,
+    "minibatch": _dominant_colors_minibatch,
+    "histogram": _dominant_colors_histogram,
+}
+
+# Quality tiers, from the reference output to the cheapest approximation
+DOMINANT_COLOR_TIERS = {
+    "exact": "kmeans",
+    "high": "subsample",
+    "balanced": "minibatch",
+    "fast": "histogram",
+}
+
+
+def calculate_dominant_colors(image, k=3, tier=None):
+    """
+    Calculate dominant colors using k-means clustering.
+
+    :param image: BGR image.
+    :param k: Number of dominant colors.
+    :param tier: Quality tier ('exact', 'high', 'balanced', 'fast'), defaults to DOMINANT_COLORS_TIER.
+    :return: List of k RGB colors, most frequent first.
+    """
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    pixels = image.reshape((-1, 3))
+    return _dominant_colors_from_pixels(pixels, k, tier)
+
+
+def _dominant_colors_from_pixels(pixels, k, tier=None):
+    engine = DOMINANT_COLOR_ENGINES[DOMINANT_COLOR_TIERS[tier or DOMINANT_COLORS_TIER]]
+    if len(pixels) < k:
+        # cv2.kmeans needs at least k samples: every pixel is its own center,
+        # the most frequent one repeated up to k
+        colors, counts = np.unique(pixels, axis=0, return_counts=True)
+        heaviest = int(np.argmax(counts))
+        padding = k - len(colors)
+        centers = np.vstack([colors, np.repeat(colors[heaviest:heaviest + 1], padding, axis=0)])
+        counts = np.concatenate([counts, np.zeros(padding, dtype=counts.dtype)])
+    else:
+        centers, counts = engine(pixels, k)
+
+    centers = np.uint8(centers)
+    dominant_colors = [centers[i].tolist() for i in np.argsort(-counts, kind='stable')]
+    return dominant_colors
+
+
+def dominant_colors_report(image, k=5, tiers=None):
+    """
+    Time every quality tier and measure its accuracy against the 'exact' tier.
+
+    The error is the mean RGB distance between the colors of a tier and the
+    reference colors, after matching them with the best permutation.
+
+    :param image: BGR image.
+    :param k: Number of dominant colors.
+    :param tiers: Tiers to evaluate, defaults to all of them.
+    :return: {tier: {"ms", "mean_error", "max_error", "colors"}}
+    """
+    report = {}
+    reference = None
+    for tier in ["exact"] + [t for t in (tiers or DOMINANT_COLOR_TIERS) if t != "exact"]:
+        start = time.perf_counter()
+        colors = calculate_dominant_colors(image, k=k, tier=tier)
+        elapsed = (time.perf_counter() - start) * 1000
+        if reference is None:
+            reference = np.float64(colors)
+        errors = _matched_color_errors(reference, np.float64(colors))
+        report[tier] = {
+            "ms": elapsed,
+            "mean_error": float(errors.mean()) if errors.size else 0.0,
+            "max_error": float(errors.max()) if errors.size else 0.0,
+            "colors": colors,
+        }
+    return report
+
+
+def _matched_color_errors(reference, colors):
+    """Per-color RGB distances under the permutation of `colors` closest to `reference`."""
+    n = min(len(reference), len(colors))
+    if n == 0:
+        return np.empty(0)
+    d = np.sqrt(((reference[:n, None, :] - colors[None, :n, :]) ** 2).sum(axis=2))
+    rows, best = linear_sum_assignment(d)
+    return d[rows, best]
+
+@functools.lru_cache(maxsize=None)
+def gabor_kernel_bank():
+    """Gabor kernels of the texture descriptor, built once per process."""
+    return tuple(
+        cv2.getGaborKernel((21, 21), 5.0, theta, 10.0, 0.5, 0, ktype=cv2.CV_32F)
+        for theta in [0, np.pi / 4, np.pi / 2, 3 * np.pi / 4]
+    )
+
+def calculate_texture_descriptors(image):
+    """Calculate texture descriptors using Gabor filters."""
+    return _texture_from_gray(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+
+def _texture_from_gray(gray):
+    gabor_filters = []
+    for kernel in gabor_kernel_bank():
+        filtered = cv2.filter2D(gray, cv2.CV_8UC3, kernel)
+        gabor_filters.append(np.mean(filtered))
+    return gabor_filters
+
+def calculate_hu_moments(image):
+    """Calculate Hu Moments for an image."""
+    return _hu_moments_from_gray(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+
+def _hu_moments_from_gray(gray):
+    contours, _ = cv2.findContours(gray, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if contours:
+        largest_contour = max(contours, key=cv2.contourArea)
+        moments = cv2.moments(largest_contour)
+        hu_moments = cv2.HuMoments(moments).flatten().tolist()
+        return hu_moments
+    return []
+
+def calculate_average_color(image):
+    average_color = cv2.mean(image)[:3]  # Excludes alpha if present
+    return list(map(int, average_color))  # Convert to integers
+
+def calculate_edge_histogram(image, normalize=False):
+    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    edges = cv2.Canny(gray_image, 100, 200)  # Edge detection
+    return _edge_histogram_from_edges(edges, normalize)
+
+def _edge_histogram_from_edges(edges, normalize=False):
+    histogram = cv2.calcHist([edges], [0], None, [256], [0, 256])
+    if normalize:
+        histogram /= max(edges.size, 1)
+    return histogram.flatten().tolist()
+
+
+def image_dimensions(data):
+    """
+    (width, height) read from the header of JPEG, PNG, GIF, BMP or WebP bytes,
+    without decoding the pixels. None for other or truncated data.
+    """
+    try:
+        if data[:8] == b"\x89PNG\r\n\x1a\n":
+            return struct.unpack(">II", data[16:24])
+        if data[:4] == b"GIF8":
+            return struct.unpack("<HH", data[6:10])
+        if data[:2] == b"BM":
+            width, height = struct.unpack("<ii", data[18:26])
+            return width, abs(height)
+        if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+            chunk = data[12:16]
+            if chunk == b"VP8 ":
+                width, height = struct.unpack("<HH", data[26:30])
+                return width & 0x3FFF, height & 0x3FFF
+            if chunk == b"VP8L":
+                (bits,) = struct.unpack("<I", data[21:25])
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            if chunk == b"VP8X":
+                return (int.from_bytes(data[24:27], "little") + 1,
+                        int.from_bytes(data[27:30], "little") + 1)
+            return None
+        if data[:2] == b"\xff\xd8":
+            i = 2
+            while i + 9 < len(data):
+                if data[i] != 0xFF:
+                    return None
+                marker = data[i + 1]
+                if marker == 0xFF:
+                    i += 1
+                    continue
+                if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                    i += 2
+                    continue
+                # Start of frame markers, except DHT (C4), JPG (C8) and DAC (CC)
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack(">HH", data[i + 5:i + 9])
+                    return width, height
+                (length,) = struct.unpack(">H", data[i + 2:i + 4])
+                i += 2 + length
+    except struct.error:
+        return None
+    return None
+
+
+# JPEG decoding at 1/8, 1/4 or 1/2 scale (DCT scaling, the full image is never materialized)
+REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                        (2, cv2.IMREAD_REDUCED_COLOR_2))
+# Version of the descriptors computed at native resolution with raw histogram counts
+# and the reference (exact) dominant colors
+NATIVE_DESCRIPTOR_VERSION = "1"
+
+
+class DescriptorMode:
+    """
+    How uploads are decoded and scaled before description.
+
+    Parameters:
+        max_side (int): Canonical maximum image side; larger images are decoded at a
+            reduced size (JPEG) and downscaled to it. None keeps the native resolution.
+        normalize_histograms (bool): Emit color and edge histograms as bin fractions
+            instead of pixel counts, so the image size does not weigh on the distances.
+        dominant_colors_tier (str): Dominant color quality tier, defaults to DOMINANT_COLORS_TIER.
+    """
+
+    def __init__(self, max_side=None, normalize_histograms=False, dominant_colors_tier=None):
+        tier = dominant_colors_tier or DOMINANT_COLORS_TIER
+        if tier not in DOMINANT_COLOR_TIERS:
+            raise ValueError(f"Unknown dominant colors tier {tier!r}, expected {list(DOMINANT_COLOR_TIERS)}")
+        self.max_side = max_side or None
+        self.normalize_histograms = normalize_histograms
+        self.dominant_colors_tier = tier
+
+    @classmethod
+    def from_env(cls):
+        """Mode configured by DESCRIPTOR_MAX_SIDE (0 = native), DESCRIPTOR_NORMALIZE and DOMINANT_COLORS_TIER."""
+        return cls(int(os.getenv('DESCRIPTOR_MAX_SIDE', 0)),
+                   os.getenv('DESCRIPTOR_NORMALIZE', '0').lower() in ('1', 'true', 'yes'),
+                   DOMINANT_COLORS_TIER)
+
+    @property
+    def version(self):
+        """Version recorded on every document as descriptor_version."""
+        exact = self.dominant_colors_tier == "exact"
+        if self.max_side is None and not self.normalize_histograms and exact:
+            return NATIVE_DESCRIPTOR_VERSION
+        version = f"2-s{self.max_side}" if self.max_side else "2-native"
+        if self.normalize_histograms:
+            version += "-n"
+        # Approximate dominant colors differ from the exact ones, so the tier is part of the version
+        return version if exact else f"{version}-c{self.dominant_colors_tier}"
+
+    def decode(self, data):
+        """Decode image bytes, at a reduced size when the image exceeds max_side. None if invalid."""
+        flag = cv2.IMREAD_COLOR
+        if self.max_side and data[:2] == b"\xff\xd8":
+            size = image_dimensions(data)
+            if size:
+                longest = max(size)
+                flag = next((f for factor, f in REDUCED_DECODE_FLAGS if longest / factor >= self.max_side), flag)
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+        return None if image is None else self.prepare(image)
+
+    def prepare(self, image):
+        """Downscale a decoded image so its longest side is at most max_side."""
+        h, w = image.shape[:2]
+        if not self.max_side or max(h, w) <= self.max_side:
+            return image
+        scale = self.max_side / max(h, w)
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+# Mode used by the service for every upload and query (they must match the stored corpus)
+DESCRIPTOR_MODE = DescriptorMode.from_env()
+
+
+class DescriptorContext:
+    """
+    Intermediates of one image shared by the descriptor stages.
+
+    Each intermediate is computed on first use, so a stage subset only pays
+    for what it needs.
+    """
+
+    def __init__(self, image, dominant_colors_k=5, dominant_colors_tier=None, normalize_histograms=False):
+        self.image = image
+        self.dominant_colors_k = dominant_colors_k
+        self.dominant_colors_tier = dominant_colors_tier
+        self.normalize_histograms = normalize_histograms
+
+    @functools.cached_property
+    def gray(self):
+        return cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+
+    @functools.cached_property
+    def rgb_pixels(self):
+        return cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB).reshape((-1, 3))
+
+    @functools.cached_property
+    def edges(self):
+        return cv2.Canny(self.gray, 100, 200)
+
+
+# Registry of descriptor stages: name -> fn(DescriptorContext), in output order
+DESCRIPTOR_STAGES = {}
+
+
+def descriptor_stage(name):
+    """Register a descriptor stage under `name`."""
+    def register(fn):
+        DESCRIPTOR_STAGES[name] = fn
+        return fn
+    return register
+
+
+@descriptor_stage("color_histogram")
+def _color_histogram_stage(ctx):
+    return calculate_color_histogram(ctx.image, ctx.normalize_histograms)
+
+@descriptor_stage("dominant_colors")
+def _dominant_colors_stage(ctx):
+    return _dominant_colors_from_pixels(ctx.rgb_pixels, ctx.dominant_colors_k, ctx.dominant_colors_tier)
+
+@descriptor_stage("texture_descriptors")
+def _texture_stage(ctx):
+    return _texture_from_gray(ctx.gray)
+
+@descriptor_stage("hu_moments")
+def _hu_moments_stage(ctx):
+    return _hu_moments_from_gray(ctx.gray)
+
+@descriptor_stage("average_color")
+def _average_color_stage(ctx):
+    return calculate_average_color(ctx.image)
+
+@descriptor_stage("edge_histogram")
+def _edge_histogram_stage(ctx):
+    return _edge_histogram_from_edges(ctx.edges, ctx.normalize_histograms)
+
+# Not a search descriptor: {"phash", "dhash"} hex strings, stored apart from the
+# numeric descriptors (see perceptual_hash.split_hashes)
+@descriptor_stage(HASH_FIELD)
+def _perceptual_hash_stage(ctx):
+    return image_hashes(ctx.gray)
+
+
+class DescriptorPipeline:
+    """
+    Run a selection of descriptor stages over an image.
+
+    Parameters:
+        stages (list): Names of the stages to run, defaults to every registered stage.
+        dominant_colors_k (int): Number of dominant colors.
+        dominant_colors_tier (str): Dominant color quality tier, defaults to DOMINANT_COLORS_TIER.
+        normalize_histograms (bool): Emit histograms as bin fractions instead of pixel counts.
+    """
+
+    def __init__(self, stages=None, dominant_colors_k=5, dominant_colors_tier=None, normalize_histograms=False):
+        unknown = [name for name in stages or [] if name not in DESCRIPTOR_STAGES]
+        if unknown:
+            raise ValueError(f"Unknown descriptor stages {unknown}, expected {list(DESCRIPTOR_STAGES)}")
+        # Keep the registry order so the output dict layout never changes
+        self.stages = [name for name in DESCRIPTOR_STAGES if stages is None or name in stages]
+        self.dominant_colors_k = dominant_colors_k
+        self.dominant_colors_tier = dominant_colors_tier
+        self.normalize_histograms = normalize_histograms
+
+    def run(self, image, timer=None):
+        """
+        Calculate the selected descriptors of a BGR image.
+
+        :param timer: Optional callable, stage name -> context manager timing that stage.
+        """
+        ctx = DescriptorContext(image, self.dominant_colors_k, self.dominant_colors_tier, self.normalize_histograms)
+        if timer is None:
+            return {name: DESCRIPTOR_STAGES[name](ctx) for name in self.stages}
+
+        descriptor = {}
+        for name in self.stages:
+            with timer(name):
+                descriptor[name] = DESCRIPTOR_STAGES[name](ctx)
+        return descriptor
+
+
+def calculate_img_descriptors(image, stages=None, timer=None, mode=None):
+    """
+    Calculate every descriptor of an image (or only the requested `stages`).
+
+    Grayscale, RGB pixels and Canny edges are computed once and shared by the stages.
+    The image is first scaled according to `mode` (DESCRIPTOR_MODE by default).
+    """
+    mode = mode or DESCRIPTOR_MODE
+    pipeline = DescriptorPipeline(stages, dominant_colors_tier=mode.dominant_colors_tier,
+                                  normalize_histograms=mode.normalize_histograms)
+    return pipeline.run(mode.prepare(image), timer)
+
+
+def describe_image_bytes(filename, data, stages=None, mode=None):
+    """
+    Decode an encoded image and calculate its descriptors.
+
+    Used as the unit of work of the descriptor process pool, so it never raises:
+    failures are reported as {"error": ...} like in the sequential path.
+
+    :param filename: Name of the uploaded file, returned unchanged.
+    :param data: Encoded image bytes.
+    :param stages: Optional subset of descriptor stages.
+    :param mode: DescriptorMode, DESCRIPTOR_MODE by default.
+    :return: Tuple (filename, descriptors or error dict).
+    """
+    mode = mode or DESCRIPTOR_MODE
+    image = mode.decode(data)
+    if image is None:
+        return filename, {"error": "Invalid image format"}
+    try:
+        return filename, calculate_img_descriptors(image, stages, mode=mode)
+    except Exception as e:
+        return filename, {"error": f"Error calculating descriptors: {str(e)}"}
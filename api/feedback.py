@@ -0,0 +1,155 @@
+"""
+Relevance feedback on the search weights.
+
+Feedback images are referenced by filename or _id. Their per-family
+descriptor norms come from the resident index (computed once per indexed
+row), so a weight update is a mean over a (k, families) matrix, whatever the
+descriptor sizes.
+"""
+import numpy as np
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from descriptor_store import read_descriptors
+from search_index import FAMILY_NAMES, INDEX_PROJECTION, flatten_descriptor
+
+
+# Column of every family in a norms matrix
+FAMILY_COLUMNS = {name: i for i, name in enumerate(FAMILY_NAMES)}
+FRAME_COLUMNS = [FAMILY_COLUMNS["hu_moments"], FAMILY_COLUMNS["edge_histogram"]]
+COLOR_COLUMNS = [FAMILY_COLUMNS["color_histogram"], FAMILY_COLUMNS["average_color"], FAMILY_COLUMNS["dominant_colors"]]
+TEXTURE_COLUMN = FAMILY_COLUMNS["texture_descriptors"]
+
+
+def descriptor_norms(descriptor):
+    """L2 norm of every descriptor family, in FAMILY_NAMES order (None if unusable)."""
+    flat = flatten_descriptor(descriptor)
+    if flat is None:
+        return None
+    return np.array([np.linalg.norm(flat[name].astype(np.float64)) for name in FAMILY_NAMES])
+
+
+def _object_id(value):
+    if isinstance(value, ObjectId):
+        return value
+    if isinstance(value, dict) and "$oid" in value:
+        value = value["$oid"]
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        return None
+
+
+def _parse_reference(entry):
+    """
+    Normalize a feedback entry to (filename, _id, embedded descriptor).
+
+    Entries are a filename or _id string, a {"filename": ...} / {"_id": ...}
+    object, or (legacy clients) a whole image document with its descriptors.
+    """
+    if isinstance(entry, str):
+        return entry, _object_id(entry), None
+    if isinstance(entry, dict):
+        descriptor = read_descriptors(entry)
+        return entry.get("filename"), _object_id(entry.get("_id")), descriptor
+    raise ValueError("Feedback entries must be filenames, _ids or image objects")
+
+
+def resolve_norms(index, collection, entries):
+    """
+    Per-family descriptor norms of the referenced images.
+
+    References are looked up in the resident index first; images that are not
+    indexed (yet) are fetched from the collection in one query.
+
+    :param index: DescriptorIndex.
+    :param collection: Mongo collection holding the image documents.
+    :param entries: List of feedback entries (see _parse_reference).
+    :return: Tuple (norms array of shape (k, len(FAMILY_NAMES)), list of unresolved entries).
+    """
+    state = index.state
+    norms_matrix = state.family_norms
+    rows, norms, pending = [], [], []
+    for entry in entries:
+        filename, key, descriptor = _parse_reference(entry)
+        row = None
+        if key is not None:
+            row = state.row_of.get(key)
+            if row is None:
+                # Snapshot-backed states use string keys
+                row = state.row_of.get(str(key))
+        if row is None and filename is not None:
+            row = state.row_of_filename.get(filename)
+        if row is not None:
+            rows.append(row)
+        elif descriptor is not None and descriptor_norms(descriptor) is not None:
+            norms.append(descriptor_norms(descriptor))
+        else:
+            pending.append((entry, filename, key))
+
+    unresolved = []
+    if pending:
+        ids = [key for _, _, key in pending if key is not None]
+        filenames = [filename for _, filename, _ in pending if filename is not None]
+        found_ids, found_filenames = {}, {}
+        for doc in collection.find({"$or": [{"_id": {"$in": ids}}, {"filename": {"$in": filenames}}]},
+                                   INDEX_PROJECTION):
+            doc_norms = descriptor_norms(read_descriptors(doc))
+            if doc_norms is None:
+                continue
+            found_ids[doc["_id"]] = doc_norms
+            found_filenames.setdefault(doc.get("filename"), doc_norms)
+        for entry, filename, key in pending:
+            doc_norms = found_ids.get(key)
+            if doc_norms is None:
+                doc_norms = found_filenames.get(filename)
+            if doc_norms is None:
+                unresolved.append(entry)
+            else:
+                norms.append(doc_norms)
+
+    resolved = norms_matrix[rows] if rows else np.empty((0, len(FAMILY_NAMES)))
+    if norms:
+        resolved = np.vstack([resolved, np.array(norms)])
+    return resolved, unresolved
+
+
+def feedback_weights(w1, w2, w3, frame_weights, color_weights, relevant_norms, irrelevant_norms,
+                     alpha=1, beta=0.001, gamma=0.001):
+    """
+    Move the weights towards the relevant images and away from the irrelevant ones.
+
+    Same update as query_point_movement2, computed from per-family norms. An
+    empty relevant or irrelevant set contributes nothing to the update.
+
+    Parameters:
+        w1, w2, w3: Current weights for frame, color, and texture groups.
+        frame_weights (tuple): Current weights for hu_moments and edge_histogram.
+        color_weights (tuple): Current weights for color_histogram, average_color, and dominant_colors.
+        relevant_norms: (k, families) array of descriptor norms of the relevant images.
+        irrelevant_norms: (m, families) array of descriptor norms of the irrelevant images.
+        alpha: Weight increment for relevance feedback.
+        beta: Weight increment for relevance feedback.
+        gamma: Weight decrement for irrelevance feedback.
+
+    Returns:
+        Updated weights (w1, w2, w3, frame_weights, color_weights).
+    """
+    def mean(norms):
+        norms = np.asarray(norms, dtype=np.float64).reshape(-1, len(FAMILY_NAMES))
+        return norms.mean(axis=0) if len(norms) else np.zeros(len(FAMILY_NAMES))
+
+    relevant, irrelevant = mean(relevant_norms), mean(irrelevant_norms)
+    frame = np.asarray(frame_weights, dtype=np.float64)
+    color = np.asarray(color_weights, dtype=np.float64)
+
+    # Group weights: frame and color scores are the family norms weighted like the search
+    groups = np.array([w1, w2, w3], dtype=np.float64)
+    relevant_groups = np.array([frame @ relevant[FRAME_COLUMNS], color @ relevant[COLOR_COLUMNS], relevant[TEXTURE_COLUMN]])
+    irrelevant_groups = np.array([frame @ irrelevant[FRAME_COLUMNS], color @ irrelevant[COLOR_COLUMNS],
+                                  irrelevant[TEXTURE_COLUMN]])
+    w1_new, w2_new, w3_new = (alpha * groups + beta * relevant_groups - gamma * irrelevant_groups).tolist()
+
+    frame_new = alpha * frame + beta * relevant[FRAME_COLUMNS] - gamma * irrelevant[FRAME_COLUMNS]
+    color_new = alpha * color + beta * relevant[COLOR_COLUMNS] - gamma * irrelevant[COLOR_COLUMNS]
+    return w1_new, w2_new, w3_new, tuple(frame_new.tolist()), tuple(color_new.tolist())
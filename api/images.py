@@ -1,8 +1,10 @@
 import os
 import cv2
 import numpy as np
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, g
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from bson import ObjectId
 from flask_restful import Api, Resource
 from rich import _console
 from werkzeug.utils import secure_filename
@@ -11,6 +13,29 @@ from dotenv import load_dotenv
 from flask_cors import CORS
 import random
 import json
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from descriptors import (
+    calculate_color_histogram, calculate_dominant_colors, calculate_texture_descriptors,
+    calculate_hu_moments, calculate_average_color, calculate_edge_histogram,
+    calculate_img_descriptors, describe_image_bytes, dominant_colors_report, DOMINANT_COLOR_TIERS,
+    DESCRIPTOR_STAGES, DESCRIPTOR_MODE, NATIVE_DESCRIPTOR_VERSION, MAX_DOMINANT_COLORS
+)
+from descriptor_store import read_descriptors
+from search_index import (
+    DescriptorIndex, cascade_recall_report, collapse_duplicate_rows, CASCADE_K, DUPLICATE_RADIUS, UPDATED_FIELD,
+)
+from descriptor_snapshot import DescriptorSnapshot
+from query_cache import QueryCache, content_hash
+from ann_index import AnnIndex, recall_report
+from metrics import Metrics
+from feedback import descriptor_norms, feedback_weights, resolve_norms
+from weight_store import WeightStore, MAX_SESSION_ID_LENGTH
+from perceptual_hash import image_hashes, parse_hashes
+from transforms import decode_image, encode_image, transform_array, parse_transform_spec, apply_spec, zip_outputs
 load_dotenv()
 
 # MongoDB Configuration
@@ -18,139 +43,137 @@ MONGO_URI =  os.getenv('MONGO_URI')
 DATABASE_NAME = os.getenv('DATABASE_NAME')
 COLLECTION_NAME =os.getenv('COLLECTION_NAME')
 
-# Directory to store uploaded images
-UPLOAD_FOLDER = '../uploaded_images'
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+# Services, created by create_app() so that importing this module has no side effects:
+# descriptor pool workers re-import it as their __main__
+client = None
+db = None
+collection = None
+w_collection = None
+snapshot = None
+search_index = None
+ann_index = None
+weight_store = None
 
 
-client = MongoClient(MONGO_URI)
-db = client[DATABASE_NAME]
-collection = db[COLLECTION_NAME]
-w_collection = db['weights']
+def ensure_collection_indexes():
+    """Create the Mongo indexes used by category-scoped queries and index refreshes (off the startup path)."""
+    try:
+        collection.create_index("category")
+        collection.create_index(UPDATED_FIELD)
+    except PyMongoError:
+        pass
 
 
+# Process pool used to describe multi-image uploads in parallel (1 = sequential)
+DESCRIPTOR_WORKERS = int(os.getenv('DESCRIPTOR_WORKERS', os.cpu_count() or 1))
+_descriptor_pool = None
+_descriptor_pool_lock = threading.Lock()
+
+# Per-stage latency metrics, exported on /metrics and in Server-Timing headers
+metrics = Metrics(enabled=os.getenv('METRICS_ENABLED', '1').lower() not in ('0', 'false', 'no'))
+
+# Optional memory-mapped descriptor snapshot shared by every worker process
+# (written by `python descriptor_snapshot.py export|append|compact`)
+DESCRIPTOR_SNAPSHOT = os.getenv('DESCRIPTOR_SNAPSHOT')
+
+# Cascade mode: compact-descriptor prefilter keeping CASCADE_K candidates, then exact rerank
+CASCADE_K = int(os.getenv('CASCADE_K', CASCADE_K))
+SEARCH_MODES = ('exact', 'ann', 'cascade')
+
+# Near duplicates (perceptual hash distance): default radius, candidates fetched per result
+# when collapsing them in search results, and whether exact duplicate queries skip the full scan
+DUPLICATE_RADIUS = int(os.getenv('DUPLICATE_RADIUS', DUPLICATE_RADIUS))
+DUPLICATE_OVERFETCH = int(os.getenv('DUPLICATE_OVERFETCH', 3))
+DUPLICATE_EARLY_EXIT = os.getenv('DUPLICATE_EARLY_EXIT', '0')
+
+# Query descriptor / result cache for repeated queries (QUERY_CACHE_MB budget)
+query_cache = QueryCache(int(float(os.getenv('QUERY_CACHE_MB', 64)) * 2 ** 20))
+
+
+def create_app():
+    """
+    Connect to MongoDB and start the search services, once per process.
+
+    Run the API with `python images.py`, or under a WSGI server with the
+    `images:create_app()` factory.
+
+    :return: The Flask app.
+    """
+    global client, db, collection, w_collection, snapshot, search_index, ann_index, weight_store
+    if client is not None:
+        return app
+
+    client = MongoClient(MONGO_URI)
+    db = client[DATABASE_NAME]
+    collection = db[COLLECTION_NAME]
+    w_collection = db['weights']
+    threading.Thread(target=ensure_collection_indexes, name="ensure-indexes", daemon=True).start()
+
+    if DESCRIPTOR_SNAPSHOT and os.path.exists(DESCRIPTOR_SNAPSHOT):
+        snapshot = DescriptorSnapshot(DESCRIPTOR_SNAPSHOT)
+
+    # Resident descriptor index, refreshed incrementally when images are added or removed
+    search_index = DescriptorIndex(
+        collection,
+        refresh_interval=float(os.getenv('INDEX_REFRESH_INTERVAL', 1.0)),
+        snapshot=snapshot,
+        timer=lambda stage: metrics.time(f"search.{stage}")
+    )
+
+    # Opt-in approximate (IVF-PQ) search mode over the same index
+    ann_index = AnnIndex(
+        search_index,
+        nlist=int(os.getenv('ANN_NLIST', 0)),
+        nprobe=int(os.getenv('ANN_NPROBE', 8)),
+        rerank=int(os.getenv('ANN_RERANK', 100)),
+        retry_interval=float(os.getenv('ANN_RETRY_INTERVAL', 60)),
+    )
+
+    # Search weights per feedback session, persisted to the weights collection by a write-behind flusher
+    weight_store = WeightStore(
+        w_collection,
+        session_ttl=float(os.getenv('WEIGHTS_SESSION_TTL', 3600)),
+        flush_interval=float(os.getenv('WEIGHTS_FLUSH_INTERVAL', 1.0)),
+        global_updates=os.getenv('WEIGHTS_GLOBAL_UPDATES', '1').lower() not in ('0', 'false', 'no'),
+    ).start()
+
+    metrics.gauge("corpus_size", lambda: len(search_index))
+    metrics.gauge("index_version", lambda: search_index.version)
+    metrics.gauge("ann_index_size", lambda: ann_index.stats()["size"])
+    metrics.gauge("weight_sessions", lambda: weight_store.stats()["sessions"])
+    metrics.gauge("query_cache_bytes",
+                  lambda: query_cache.descriptors.current_bytes + query_cache.results.current_bytes)
+    return app
+
 app = Flask(__name__)
 api = Api(app)
 CORS(app)
 
 
-def transform_image(image_path, crop_coords=None, resize_dims=None, flip=None, rotate_angle=None):
-    """
-    Transform an image using cropping, resizing, flipping, and rotation.
-
-    :param image_path: Path to the input image.
-    :param crop_coords: Tuple (x, y, w, h) for cropping (x, y are the top-left corner, w is width, h is height).
-    :param resize_dims: Tuple (width, height) for resizing.
-    :param flip: Integer indicating flip mode (0 for vertical, 1 for horizontal, -1 for both axes).
-    :param rotate_angle: Angle in degrees to rotate the image.
-    :return: Transformed image as binary data.
-    """
-    # Load the image
-    image = cv2.imread(image_path)
-    if image is None:
-        raise FileNotFoundError(f"Image not found at {image_path}")
-
-    # Crop the image
-    if crop_coords:
-        x, y, w, h = crop_coords
-        image = image[y:y+h, x:x+w]
-
-    # Resize the image
-    if resize_dims:
-        image = cv2.resize(image, resize_dims, interpolation=cv2.INTER_LINEAR)
-
-    # Flip the image
-    if flip is not None:
-        image = cv2.flip(image, flip)
-
-    # Rotate the image
-    if rotate_angle:
-        (h, w) = image.shape[:2]
-        center = (w // 2, h // 2)
-        rotation_matrix = cv2.getRotationMatrix2D(center, rotate_angle, 1.0)
-        image = cv2.warpAffine(image, rotation_matrix, (w, h))
-
-    # Encode the image as a JPEG in memory
-    _, buffer = cv2.imencode('.jpg', image)
-
-    # Return the binary data
-    return buffer.tobytes()
-
-
-# Helper functions to calculate descriptors
-def calculate_color_histogram(image):
-    """Calculate color histogram for an image."""
-    histogram = []
-    for i in range(3):  # Loop over color channels (B, G, R)
-        hist = cv2.calcHist([image], [i], None, [256], [0, 256])
-        histogram.append(hist.flatten().tolist())
-    return histogram
-
-def calculate_dominant_colors(image, k=3):
-    """Calculate dominant colors using k-means clustering."""
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    pixels = image.reshape((-1, 3))
-    pixels = np.float32(pixels)
-
-    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 0.2)
-    _, labels, centers = cv2.kmeans(pixels, k, None, criteria, 10, cv2.KMEANS_RANDOM_CENTERS)
-
-    centers = np.uint8(centers)
-    counts = np.bincount(labels.flatten())
-
-    dominant_colors = [centers[i].tolist() for i in np.argsort(-counts)]
-    return dominant_colors
-
-def calculate_texture_descriptors(image):
-    """Calculate texture descriptors using Gabor filters."""
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    gabor_filters = []
-    for theta in [0, np.pi / 4, np.pi / 2, 3 * np.pi / 4]:
-        kernel = cv2.getGaborKernel((21, 21), 5.0, theta, 10.0, 0.5, 0, ktype=cv2.CV_32F)
-        filtered = cv2.filter2D(gray, cv2.CV_8UC3, kernel)
-        gabor_filters.append(np.mean(filtered))
-    return gabor_filters
-
-def calculate_hu_moments(image):
-    """Calculate Hu Moments for an image."""
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    contours, _ = cv2.findContours(gray, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    if contours:
-        largest_contour = max(contours, key=cv2.contourArea)
-        moments = cv2.moments(largest_contour)
-        hu_moments = cv2.HuMoments(moments).flatten().tolist()
-        return hu_moments
-    return []
-
-def calculate_average_color(image):
-    average_color = cv2.mean(image)[:3]  # Excludes alpha if present
-    return list(map(int, average_color))  # Convert to integers
-
-def calculate_edge_histogram(image):
-    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    edges = cv2.Canny(gray_image, 100, 200)  # Edge detection
-    histogram = cv2.calcHist([edges], [0], None, [256], [0, 256])
-    return histogram.flatten().tolist()
-
-
-def calculate_img_descriptors(image):
-    """Combine all descriptors into a global score."""
-    color_histogram = calculate_color_histogram(image)
-    dominant_colors = calculate_dominant_colors(image, k=5)
-    texture_descriptors = calculate_texture_descriptors(image)
-    hu_moments = calculate_hu_moments(image)
-    average_color = calculate_average_color(image)
-    edge_histogram = calculate_edge_histogram(image)
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    metrics.begin_request()
 
-    return {
-        "color_histogram": color_histogram,
-        "dominant_colors": dominant_colors,
-        "texture_descriptors": texture_descriptors,
-        "hu_moments": hu_moments,
-        "average_color": average_color,
-        "edge_histogram": edge_histogram
-    }
+
+@app.after_request
+def add_server_timing(response):
+    """Record the request duration and emit the per-stage Server-Timing header."""
+    timings = metrics.end_request()
+    if not metrics.enabled or 'request_start' not in g:
+        return response
+
+    total = time.perf_counter() - g.request_start
+    rule = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.observe(f"request:{rule}", total)
+    metrics.inc("requests_total", (("endpoint", rule), ("status", response.status_code)))
+    response.headers['Server-Timing'] = metrics.server_timing(timings + [("total", total)])
+    return response
+
+
+def descriptor_timer(stage):
+    """Time a descriptor stage of the in-process pipeline."""
+    return metrics.time(f"descriptor.{stage}")
 
 
 def simple_search(img_descriptor, descriptors2, top_n=5,  w1=0.1, w2=0.8, w3=0.1,
@@ -214,101 +237,229 @@ def query_point_movement2(w1, w2, w3, frame_weights, color_weights, relevant_des
         frame_weights (tuple): Current weights for hu_moments and edge_histogram.
         color_weights (tuple): Current weights for color_histogram, average_color, and dominant_colors.
         # texture_weight (float): Current weight for texture_descriptors.
-        relevant_descriptors: List of descriptors for relevant images.
-        irrelevant_descriptors: List of descriptors for irrelevant images.
+        relevant_descriptors: List of image documents for relevant images (legacy or packed descriptors).
+        irrelevant_descriptors: List of image documents for irrelevant images (legacy or packed descriptors).
         alpha: Weight increment for relevance feedback.
         beta: Weight increment for relevance feedback.
         gamma: Weight decrement for irrelevance feedback.
 
     Returns:
         Updated weights (w1, w2, w3, frame_weights, color_weights, texture_weight).
+
+    Empty relevant or irrelevant lists contribute nothing to the update.
     """
-    # print('input : ',w1, w2, w3, frame_weights, color_weights)
-    # Calculate group-level feedback scores for relevant and irrelevant images
-    relevant_frame_score = sum([
-        frame_weights[0] * np.linalg.norm(d['characteristics']["hu_moments"]) +
-        frame_weights[1] * np.linalg.norm(d['characteristics']["edge_histogram"])
-        for d in relevant_descriptors
-    ]) / len(relevant_descriptors)
-
-    relevant_color_score = sum([
-        color_weights[0] * np.linalg.norm(np.ravel(d['characteristics']["color_histogram"])) +
-        color_weights[1] * np.linalg.norm(np.ravel(d['characteristics']["average_color"])) +
-        color_weights[2] * np.linalg.norm(np.ravel(d['characteristics']["dominant_colors"]))
-        for d in relevant_descriptors
-    ]) / len(relevant_descriptors)
-
-    relevant_texture_score = sum([np.linalg.norm(d['characteristics']["texture_descriptors"]) for d in relevant_descriptors]) / len(relevant_descriptors)
-
-    irrelevant_frame_score = sum([
-        frame_weights[0] * np.linalg.norm(d['characteristics']["hu_moments"]) +
-        frame_weights[1] * np.linalg.norm(d['characteristics']["edge_histogram"])
-        for d in irrelevant_descriptors
-    ]) / len(irrelevant_descriptors)
-
-    irrelevant_color_score = sum([
-        color_weights[0] * np.linalg.norm(np.ravel(d['characteristics']["color_histogram"])) +
-        color_weights[1] * np.linalg.norm(np.ravel(d['characteristics']["average_color"])) +
-        color_weights[2] * np.linalg.norm(np.ravel(d['characteristics']["dominant_colors"]))
-        for d in irrelevant_descriptors
-    ]) / len(irrelevant_descriptors)
-
-    irrelevant_texture_score = sum([np.linalg.norm(d['characteristics']["texture_descriptors"]) for d in irrelevant_descriptors]) / len(irrelevant_descriptors)
-
-    # Update group weights
-    w1_new = alpha * w1 + beta * relevant_frame_score - gamma * irrelevant_frame_score
-    w2_new = alpha * w2 + beta * relevant_color_score - gamma * irrelevant_color_score
-    w3_new = alpha * w3 + beta * relevant_texture_score - gamma * irrelevant_texture_score
-
-    # Update frame weights
-    frame_weights_new = (
-        alpha * frame_weights[0] + beta * sum([
-            np.linalg.norm(d['characteristics']["hu_moments"]) for d in relevant_descriptors
-        ]) / len(relevant_descriptors) - 
-        gamma * sum([
-            np.linalg.norm(d['characteristics']["hu_moments"]) for d in irrelevant_descriptors
-        ]) / len(irrelevant_descriptors),
-
-        alpha * frame_weights[1] + beta * sum([
-            np.linalg.norm(d['characteristics']["edge_histogram"]) for d in relevant_descriptors
-        ]) / len(relevant_descriptors) -
-        gamma * sum([
-            np.linalg.norm(d['characteristics']["edge_histogram"]) for d in irrelevant_descriptors
-        ]) / len(irrelevant_descriptors)
-    )
+    def norms(docs):
+        return [n for n in (descriptor_norms(read_descriptors(d)) for d in docs) if n is not None]
 
-    # Update color weights
-    color_weights_new = (
-        alpha * color_weights[0] + beta * sum([
-            np.linalg.norm(np.ravel(d['characteristics']["color_histogram"])) for d in relevant_descriptors
-        ]) / len(relevant_descriptors) -
-        gamma * sum([
-            np.linalg.norm(np.ravel(d['characteristics']["color_histogram"])) for d in irrelevant_descriptors
-        ]) / len(irrelevant_descriptors),
-
-        alpha * color_weights[1] + beta * sum([
-            np.linalg.norm(np.ravel(d['characteristics']["average_color"])) for d in relevant_descriptors
-        ]) / len(relevant_descriptors) -
-        gamma * sum([
-            np.linalg.norm(np.ravel(d['characteristics']["average_color"])) for d in irrelevant_descriptors
-        ]) / len(irrelevant_descriptors),
-
-        alpha * color_weights[2] + beta * sum([
-            np.linalg.norm(np.ravel(d['characteristics']["dominant_colors"])) for d in relevant_descriptors
-        ]) / len(relevant_descriptors) -
-        gamma * sum([
-            np.linalg.norm(np.ravel(d['characteristics']["dominant_colors"])) for d in irrelevant_descriptors
-        ]) / len(irrelevant_descriptors)
-    )
+    return feedback_weights(w1, w2, w3, frame_weights, color_weights,
+                            norms(relevant_descriptors), norms(irrelevant_descriptors),
+                            alpha=alpha, beta=beta, gamma=gamma)
+
+
+def get_descriptor_pool():
+    """
+    Lazily create the bounded process pool used for descriptor extraction.
+
+    Workers are started from a forkserver (spawn where unavailable): forking
+    this process directly would copy the state of its running threads.
+    """
+    global _descriptor_pool
+    with _descriptor_pool_lock:
+        if _descriptor_pool is None:
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["descriptors"])
+            else:
+                context = multiprocessing.get_context("spawn")
+            _descriptor_pool = ProcessPoolExecutor(max_workers=DESCRIPTOR_WORKERS, mp_context=context)
+        return _descriptor_pool
+
+
+def reset_descriptor_pool(pool):
+    """Drop a broken pool (a worker died), so the next call to get_descriptor_pool starts a new one."""
+    global _descriptor_pool
+    with _descriptor_pool_lock:
+        if _descriptor_pool is pool:
+            _descriptor_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def describe_images(payloads, stages=None):
+    """
+    Calculate descriptors for several encoded images, yielding results as they complete.
+
+    :param payloads: List of (filename, image bytes) tuples.
+    :param stages: Optional subset of descriptor stages.
+    :return: Generator of (filename, descriptors or error dict) tuples, in completion order.
+    """
+    if DESCRIPTOR_WORKERS <= 1 or len(payloads) <= 1:
+        for filename, data in payloads:
+            yield describe_image_bytes(filename, data, stages)
+        return
+
+    # Images not described yet are retried once on a new pool when a worker dies
+    pending = dict(enumerate(payloads))
+    for _ in range(2):
+        pool = get_descriptor_pool()
+        try:
+            futures = {pool.submit(describe_image_bytes, filename, data, stages): i
+                       for i, (filename, data) in pending.items()}
+            for future in as_completed(futures):
+                result = future.result()
+                del pending[futures[future]]
+                yield result
+            return
+        except BrokenProcessPool:
+            reset_descriptor_pool(pool)
+    for filename, _ in pending.values():
+        yield filename, {"error": "Error calculating descriptors: descriptor worker crashed"}
+
+
+def feedback_session():
+    """
+    Feedback session of the current request, from the 'session' form field or
+    the X-Feedback-Session header (None for the global weights).
+    """
+    session = request.form.get('session') or request.headers.get('X-Feedback-Session') or None
+    if session is not None and not WeightStore.valid_session(session):
+        raise ValueError(f"Feedback session ids are at most {MAX_SESSION_ID_LENGTH} characters")
+    return session
 
-    # # Normalize weights to ensure their sum is 1 (optional)
-    # total_weight = w1_new + w2_new + w3_new
-    # w1_new /= total_weight
-    # w2_new /= total_weight
-    # w3_new /= total_weight
-    
-    # print('output : ', w1_new, w2_new, w3_new, frame_weights_new, color_weights_new)
-    return w1_new, w2_new, w3_new, frame_weights_new, color_weights_new
+
+def feedback_reference(entry):
+    """Filename or _id a feedback entry refers to, as reported back to the client."""
+    if isinstance(entry, dict):
+        return entry.get("filename") or str(entry.get("_id"))
+    return entry
+
+
+def load_weights(session=None):
+    """
+    Current search weights of a feedback session (in memory, never waits on MongoDB).
+
+    Returns:
+        tuple: (w1, w2, w3, frame_weights, color_weights)
+    """
+    return weight_store.get(session)
+
+
+def descriptor_versions():
+    """Stored documents per descriptor_version (documents without one predate the field: version 1)."""
+    counts = {}
+    for group in collection.aggregate([{"$group": {"_id": "$descriptor_version", "count": {"$sum": 1}}}]):
+        version = group["_id"] or NATIVE_DESCRIPTOR_VERSION
+        counts[version] = counts.get(version, 0) + group["count"]
+    return {
+        "current": DESCRIPTOR_MODE.version,
+        "versions": counts,
+        "mixed": len(counts) > 1 or any(version != DESCRIPTOR_MODE.version for version in counts),
+    }
+
+
+def search_categories(options):
+    """Categories a search is restricted to ('category' fields, comma separated or repeated), or None."""
+    categories = {c.strip() for value in options.getlist('category') for c in value.split(',') if c.strip()}
+    return tuple(sorted(categories)) or None
+
+
+def flag(value):
+    """Truthiness of a form / query string flag."""
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+def search_corpus(query_descriptor, options, top_n=10, **weights):
+    """
+    Run a search against the resident index in the mode requested by the client.
+
+    Results are cached per (query, weights, corpus version, options).
+
+    :param query_descriptor: Descriptors of the query image.
+    :param options: Request form/args holding the optional 'mode', 'nprobe', 'rerank', 'cascade_k',
+                    'category', 'collapse_duplicates', 'duplicate_radius' and 'early_exit' fields.
+    :param top_n: Number of results to return.
+    :param weights: w1, w2, w3, frame_weights and color_weights used for the score.
+    :return: Top N similar images as dictionaries with 'filename', 'score' and 'category'.
+             Collapsed results also list the 'duplicates' folded into them, and results of
+             an early exit are flagged 'exact_duplicate'.
+    """
+    mode = options.get('mode', 'exact')
+    nprobe = options.get('nprobe', type=int)
+    rerank = options.get('rerank', type=int)
+    cascade_k = options.get('cascade_k', CASCADE_K, type=int)
+    categories = search_categories(options)
+    collapse = flag(options.get('collapse_duplicates', ''))
+    radius = options.get('duplicate_radius', DUPLICATE_RADIUS, type=int)
+    early_exit = flag(options.get('early_exit', DUPLICATE_EARLY_EXIT))
+
+    cache_key = query_cache.results_key(query_descriptor, weights, search_index.version, top_n, mode, nprobe, rerank,
+                                        cascade_k if mode == 'cascade' else None, categories,
+                                        radius if collapse else None, early_exit)
+    results = query_cache.get_results(cache_key)
+    if results is not None:
+        return results
+
+    rows = []
+    if early_exit:
+        # The query is already stored: only its exact duplicates are scored
+        state, rows, scores = search_index.exact_duplicate_rows(query_descriptor, categories=categories, **weights)
+    exact_duplicate = len(rows) > 0
+
+    if not exact_duplicate:
+        # Extra candidates so that enough distinct images remain once duplicates are folded
+        fetch = top_n * max(DUPLICATE_OVERFETCH, 1) if collapse else top_n
+        if mode == 'ann':
+            with metrics.time("search.ann"):
+                state, rows, scores = ann_index.search_rows(query_descriptor, top_n=fetch, nprobe=nprobe,
+                                                            rerank=rerank, categories=categories, **weights)
+        elif mode == 'cascade':
+            with metrics.time("search.cascade"):
+                state, rows, scores = search_index.cascade_rows(query_descriptor, top_n=fetch, cascade_k=cascade_k,
+                                                                categories=categories, **weights)
+        else:
+            state, rows, scores = search_index.search_rows(query_descriptor, top_n=fetch, categories=categories,
+                                                           **weights)
+
+    if collapse:
+        rows, scores, folded = collapse_duplicate_rows(state, rows, scores, radius)
+        results = search_index.results(rows[:top_n], scores[:top_n], state=state)
+        for result, duplicates in zip(results, folded):
+            result["duplicates"] = [state.filenames[row] for row in duplicates]
+    else:
+        results = search_index.results(rows[:top_n], scores[:top_n], state=state)
+    if exact_duplicate:
+        for result in results:
+            result["exact_duplicate"] = True
+
+    query_cache.put_results(cache_key, results)
+    return results
+
+
+def duplicates_response(hashes, options, exclude_row=None):
+    """
+    Near duplicate lookup response for an image hash.
+
+    :param hashes: (phash, dhash) integers of the image.
+    :param options: Request form/args holding the optional 'radius', 'limit' and 'category' fields.
+    :param exclude_row: Index row of the image itself, left out of the results.
+    """
+    radius = options.get('radius', DUPLICATE_RADIUS, type=int)
+    limit = options.get('limit', 50, type=int)
+    state, rows, distances, exact = search_index.duplicate_rows(hashes, radius=radius,
+                                                                categories=search_categories(options))
+    if exclude_row is not None:
+        keep = rows != exclude_row
+        rows, distances, exact = rows[keep], distances[keep], exact[keep]
+    duplicates = [
+        {"filename": state.filenames[row], "category": state.categories[row],
+         "distance": int(distance), "exact": bool(is_exact)}
+        for row, distance, is_exact in zip(rows[:limit], distances[:limit], exact[:limit])
+    ]
+    return {
+        "hash": {"phash": f"{hashes[0]:016x}", "dhash": f"{hashes[1]:016x}"},
+        "radius": radius,
+        "total": len(rows),
+        "duplicates": duplicates,
+    }
 
 
 # Resource classes for API
@@ -317,12 +468,17 @@ class TransformService(Resource):
         """
         Apply transformations to an uploaded image and return the result.
 
+        The upload is decoded in memory and all the geometric operations are
+        applied in a single pass; nothing is written to disk.
+
         Request Parameters:
         - image: The image file to be transformed (multipart/form-data).
         - crop_coords: Optional tuple (x, y, w, h) for cropping.
         - resize_dims: Optional tuple (width, height) for resizing.
         - flip: Optional integer for flipping (0: vertical, 1: horizontal, -1: both).
         - rotate_angle: Optional angle in degrees for rotation.
+        - format: Optional output format, 'jpg' (default), 'png' or 'webp'.
+        - quality: Optional jpg / webp quality (1-100).
 
         Response:
         - The transformed image as a binary file.
@@ -334,70 +490,202 @@ class TransformService(Resource):
         if image_file.filename == '':
             return {"message": "No file selected for upload"}, 400
 
-        # Save uploaded image temporarily
-        input_path = os.path.join(UPLOAD_FOLDER, secure_filename(image_file.filename))
-        image_file.save(input_path)
-
-        # Parse transformation parameters
-        crop_coords = request.form.get('crop_coords')
-        if crop_coords:
-            crop_coords = tuple(map(int, crop_coords.split(',')))
-
-        resize_dims = request.form.get('resize_dims')
-        if resize_dims:
-            resize_dims = tuple(map(int, resize_dims.split(',')))
-
-        flip = request.form.get('flip')
-        if flip:
-            flip = int(flip)
+        try:
+            spec = parse_transform_spec(request.form)
+        except (TypeError, ValueError) as e:
+            return {"message": str(e)}, 400
 
-        rotate_angle = request.form.get('rotate_angle')
-        if rotate_angle:
-            rotate_angle = float(rotate_angle)
+        with metrics.time("transform.decode"):
+            try:
+                image = decode_image(image_file.read())
+            except ValueError as e:
+                return {"message": str(e)}, 400
 
         try:
             # Perform the transformation and get the binary image data
-            transformed_image = transform_image(
-                image_path=input_path,
-                crop_coords=crop_coords,
-                resize_dims=resize_dims,
-                flip=flip,
-                rotate_angle=rotate_angle
-            )
+            with metrics.time("transform.apply"):
+                transformed = transform_array(image, spec["crop_coords"], spec["resize_dims"],
+                                              spec["flip"], spec["rotate_angle"])
+            with metrics.time("transform.encode"):
+                transformed_image, mimetype = encode_image(transformed, spec["format"], spec["quality"])
+        except ValueError as e:
+            return {"message": str(e)}, 400
         except Exception as e:
             return {"message": f"Error during transformation: {str(e)}"}, 500
-        finally:
-            # Clean up temporary file
-            os.remove(input_path)
 
         # Return the transformed image as a response
-        return Response(transformed_image, mimetype='image/jpeg')
+        return Response(transformed_image, mimetype=mimetype)
+
+
+class TransformBatchService(Resource):
+    def post(self):
+        """
+        Apply transformations to many images, or many transformations to one image.
+
+        Request Parameters:
+        - images: One or more image files (multipart/form-data).
+        - specs: Optional JSON list of transform specs (objects with the /transform
+          parameters). Without it, one spec is read from the form fields, as for /transform.
+          Every spec is applied to every image.
+
+        Response:
+        - A zip archive with one entry per (image, spec) pair, named
+          '<image>.<ext>' for a single spec and '<image>_<spec index>.<ext>' otherwise.
+          Images or specs that failed are listed in 'errors.json'.
+        """
+        files = request.files.getlist('images') or request.files.getlist('image')
+        files = [f for f in files if f.filename]
+        if not files:
+            return {"message": "No images provided"}, 400
+
+        try:
+            raw_specs = request.form.get('specs')
+            if raw_specs:
+                raw_specs = json.loads(raw_specs)
+                if isinstance(raw_specs, dict):
+                    raw_specs = [raw_specs]
+                if not isinstance(raw_specs, list) or not all(isinstance(s, dict) for s in raw_specs):
+                    raise ValueError("specs must be a JSON list of objects")
+                specs = [parse_transform_spec(s) for s in raw_specs]
+            else:
+                specs = [parse_transform_spec(request.form)]
+        except (TypeError, ValueError) as e:
+            return {"message": f"Invalid specs: {str(e)}"}, 400
+        if not specs:
+            return {"message": "No transform specs provided"}, 400
+
+        outputs, errors, stems = [], [], set()
+        for image_file in files:
+            stem = os.path.splitext(secure_filename(image_file.filename))[0] or 'image'
+            # Uploads sharing a filename must not overwrite each other in the archive
+            unique, n = stem, 1
+            while unique in stems:
+                unique, n = f"{stem}-{n}", n + 1
+            stem = unique
+            stems.add(stem)
+            with metrics.time("transform.decode"):
+                try:
+                    image = decode_image(image_file.read())
+                except ValueError as e:
+                    errors.append({"filename": image_file.filename, "error": str(e)})
+                    continue
+
+            for i, spec in enumerate(specs):
+                name = stem if len(specs) == 1 else f"{stem}_{i}"
+                try:
+                    with metrics.time("transform.apply"):
+                        data, mimetype = apply_spec(image, spec)
+                except Exception as e:
+                    errors.append({"filename": image_file.filename, "spec": i, "error": str(e)})
+                    continue
+                extension = 'jpg' if mimetype == 'image/jpeg' else mimetype.split('/')[1]
+                outputs.append((f"{name}.{extension}", data))
+
+        if not outputs:
+            return {"message": "No image could be transformed", "errors": errors}, 400
+
+        with metrics.time("transform.zip"):
+            archive = zip_outputs(outputs, errors)
+        return Response(archive, mimetype='application/zip',
+                        headers={'Content-Disposition': 'attachment; filename=transformed.zip'})
 
 
 class DescriptorService(Resource):
     def post(self):
-        """Calculate descriptors for an uploaded image or set of images."""
+        """
+        Calculate descriptors for an uploaded image or set of images.
+
+        Images are described in parallel by a bounded process pool (DESCRIPTOR_WORKERS).
+
+        Request Parameters:
+        - images: The image files (multipart/form-data).
+        - descriptors: Optional comma separated subset of descriptors to calculate.
+        - stream: Optional flag; when set (or when the client accepts application/x-ndjson)
+          results are streamed as one {"filename", "result"} JSON line per image, in
+          completion order.
+
+        Response:
+        - {"message", "descriptor_version", "results": {filename: descriptors or {"error": ...}}},
+          or NDJSON lines. The descriptor version (DESCRIPTOR_MODE) is also sent in the
+          X-Descriptor-Version header and must be stored with the descriptors.
+          The 'perceptual_hash' entry of the descriptors ({"phash", "dhash"}) is stored
+          in its own document field, it feeds the near-duplicate lookup.
+        """
         if 'images' not in request.files:
             return {"message": "No images provided"}, 400
 
-        images = request.files.getlist('images')
-        results = {}
+        stages = request.values.get('descriptors')
+        stages = stages.split(',') if stages else None
+        unknown = [name for name in stages or [] if name not in DESCRIPTOR_STAGES]
+        if unknown:
+            return {"message": f"Unknown descriptors {unknown}, expected {list(DESCRIPTOR_STAGES)}"}, 400
+
+        # Read every upload before handing them to the pool / the streaming generator
+        payloads = [(image_file.filename, image_file.read()) for image_file in request.files.getlist('images')]
+
+        stream = (request.values.get('stream', '').lower() in ('1', 'true', 'yes')
+                  or request.accept_mimetypes.best == 'application/x-ndjson')
+        if stream:
+            def generate():
+                for filename, result in describe_images(payloads, stages):
+                    yield json.dumps({"filename": filename, "result": result}) + "\n"
+
+            return Response(generate(), mimetype='application/x-ndjson',
+                            headers={'X-Descriptor-Version': DESCRIPTOR_MODE.version})
 
-        for image_file in images:
-            # Read image using OpenCV
-            image_bytes = np.frombuffer(image_file.read(), np.uint8)
-            image = cv2.imdecode(image_bytes, cv2.IMREAD_COLOR)
+        with metrics.time("describe_batch"):
+            results = dict(describe_images(payloads, stages))
+        # Keep the upload order in the response
+        results = {filename: results[filename] for filename, _ in payloads}
 
-            # Convert the image from BGR to RGB
+        response = jsonify({"message": "Descriptors calculated", "descriptor_version": DESCRIPTOR_MODE.version,
+                            "results": results})
+        response.headers['X-Descriptor-Version'] = DESCRIPTOR_MODE.version
+        return response
 
+
+class DominantColorReportService(Resource):
+    def post(self):
+        """
+        Compare the dominant color engines on uploaded images.
+
+        Request Parameters:
+        - images: The image files (multipart/form-data).
+        - k: Optional number of dominant colors (default 5, at most MAX_DOMINANT_COLORS).
+        - tiers: Optional comma separated list of quality tiers.
+
+        Response:
+        - Per image and averaged time / error of every tier against the 'exact' tier.
+        """
+        if 'images' not in request.files:
+            return {"message": "No images provided"}, 400
+
+        k = request.form.get('k', 5, type=int)
+        if k is None or not 1 <= k <= MAX_DOMINANT_COLORS:
+            return {"message": f"k must be an integer between 1 and {MAX_DOMINANT_COLORS}"}, 400
+        tiers = request.form.get('tiers')
+        tiers = tiers.split(',') if tiers else list(DOMINANT_COLOR_TIERS)
+        unknown = [tier for tier in tiers if tier not in DOMINANT_COLOR_TIERS]
+        if unknown:
+            return {"message": f"Unknown tiers {unknown}, expected {list(DOMINANT_COLOR_TIERS)}"}, 400
+
+        results = {}
+        for image_file in request.files.getlist('images'):
+            image = cv2.imdecode(np.frombuffer(image_file.read(), np.uint8), cv2.IMREAD_COLOR)
             if image is None:
                 results[image_file.filename] = {"error": "Invalid image format"}
                 continue
+            results[image_file.filename] = dominant_colors_report(image, k=k, tiers=tiers)
 
-            # Store results
-            results[image_file.filename] = calculate_img_descriptors(image)
-
-        return jsonify({"message": "Descriptors calculated", "results": results})
+        reports = [r for r in results.values() if "error" not in r]
+        summary = {
+            tier: {
+                "ms": float(np.mean([r[tier]["ms"] for r in reports])),
+                "mean_error": float(np.mean([r[tier]["mean_error"] for r in reports])),
+            }
+            for tier in (reports[0] if reports else {})
+        }
+        return jsonify({"summary": summary, "results": results})
 
 
 class SearchService(Resource):
@@ -407,80 +695,90 @@ class SearchService(Resource):
             if "image" not in request.files:
                 return {"error": "Image file is required"}, 400
 
+            if request.form.get("mode", "exact") not in SEARCH_MODES:
+                return {"error": f"Unknown search mode, expected one of {SEARCH_MODES}"}, 400
+
             # Read the image from the request
             file = request.files["image"]
-            image = cv2.imdecode(np.frombuffer(file.read(), np.uint8), cv2.IMREAD_COLOR)
+            data = file.read()
 
-            if image is None:
-                return {"error": "Invalid image file"}, 400
+            # Calculate descriptors for the uploaded image, unless the same bytes were seen before
+            cache_key = content_hash(data, DESCRIPTOR_MODE.version)
+            query_descriptor = query_cache.get_descriptor(cache_key)
+            if query_descriptor is None:
+                # Decoded (and scaled) in the descriptor mode of the corpus
+                with metrics.time("decode"):
+                    image = DESCRIPTOR_MODE.decode(data)
 
-            # Calculate descriptors for the uploaded image
-            query_descriptor = calculate_img_descriptors(image)
+                if image is None:
+                    return {"error": "Invalid image file"}, 400
 
-            # Fetch all descriptors from MongoDB
-            descriptors2 = list(collection.find({}))  # Exclude _id field for simplicity
+                query_descriptor = calculate_img_descriptors(image, timer=descriptor_timer)
+                query_cache.put_descriptor(cache_key, query_descriptor)
 
-            # Fetch weights from MongoDB
-            weights_doc = w_collection.find_one({"type": "weights"})
-
-            if not weights_doc:
-                # Initialize consistent default weights if not found
-                w1, w2, w3 = 0.1, 0.8, 0.1  # Updated based on your preferred values
-                frame_weights = (0.7, 0.3)  # Tuple format as per `simple_search` specification
-                color_weights = (0.4, 0.1, 0.5)  # Tuple format as per `simple_search` specification
-            else:
-                w1 = weights_doc.get("w1", 0.1)
-                w2 = weights_doc.get("w2", 0.5)
-                w3 = weights_doc.get("w3", 0.4)
-                frame_weights = weights_doc.get("frame_weights", (0.7, 0.3))
-                color_weights = weights_doc.get("color_weights", (0.4, 0.1, 0.5))
+            # Sync the resident index with MongoDB (only fetches added documents)
+            with metrics.time("index_refresh"):
+                search_index.refresh()
 
+            # Weights of the feedback session, held in memory
+            try:
+                session = feedback_session()
+            except ValueError as e:
+                return {"error": str(e)}, 400
+            w1, w2, w3, frame_weights, color_weights = load_weights(session)
 
             if "characteristics" in request.form:
-                # Extract relevant and irrelevant descriptors from the request
+                # Relevant and irrelevant images, referenced by filename or _id
+                # (whole image documents from older clients are still accepted)
                 characteristics = json.loads( request.form.get("characteristics"))
-                relevant_descriptors = characteristics.get("relevant", [])
-                irrelevant_descriptors = characteristics.get("irrelevant", [])
-
-                # Recalculate weights using query_point_movement2
                 try:
-                    w1_new, w2_new, w3_new, frame_weights_new, color_weights_new = query_point_movement2(
-                        w1, w2, w3, frame_weights, color_weights,
-                        relevant_descriptors, irrelevant_descriptors,
-                        alpha=1, beta=0.001, gamma=0.001
+                    with metrics.time("feedback_lookup"):
+                        relevant_norms, unresolved_relevant = resolve_norms(
+                            search_index, collection, characteristics.get("relevant", []))
+                        irrelevant_norms, unresolved_irrelevant = resolve_norms(
+                            search_index, collection, characteristics.get("irrelevant", []))
+                except ValueError as e:
+                    return {"error": str(e)}, 400
+
+                # Feedback on unknown images is rejected before any weight is updated
+                if unresolved_relevant or unresolved_irrelevant:
+                    return {
+                        "error": "Feedback references images without descriptors",
+                        "unresolved": {
+                            "relevant": [feedback_reference(entry) for entry in unresolved_relevant],
+                            "irrelevant": [feedback_reference(entry) for entry in unresolved_irrelevant],
+                        },
+                    }, 404
+
+                # Recalculate weights from the precomputed descriptor norms; the update is
+                # applied atomically to the session and persisted by the write-behind flusher
+                try:
+                    w1_new, w2_new, w3_new, frame_weights_new, color_weights_new = weight_store.update(
+                        session,
+                        lambda current: feedback_weights(
+                            *current, relevant_norms, irrelevant_norms,
+                            alpha=1, beta=0.001, gamma=0.001
+                        )
                     )
                 except Exception as e: 
                     return {"error calculating new_weights": str(e)}, 500
 
                 # Perform the search with recalculated weights
-                top_similar = simple_search(
-                    query_descriptor, descriptors2, top_n=10,
+                top_similar = search_corpus(
+                    query_descriptor, request.form, top_n=10,
                     w1=w1_new, w2=w2_new, w3=w3_new,
                     frame_weights=frame_weights_new, color_weights=color_weights_new
                 )
-
-                # Save new weights to the database
-                w_collection.update_one(
-                    {"type": "weights"},
-                    {"$set": {
-                        "w1": w1_new ,
-                        "w2":w2_new,
-                        "w3": w3_new,
-                        "frame_weights": frame_weights_new,
-                        "color_weights": color_weights_new
-                    }},
-                    upsert=True  # Create the document if it doesn't exist
-                )
             else:
                 # Perform the search with existing weights
                 try:
-                    top_similar = simple_search(
-                        query_descriptor, descriptors2, top_n=10,
+                    top_similar = search_corpus(
+                        query_descriptor, request.form, top_n=10,
                         w1=w1, w2=w2, w3=w3,
                         frame_weights=frame_weights, color_weights=color_weights
                     )
                 except Exception as e:
-                     return {"error calculating top similiar": str(e) , "value descriptors" :str(descriptors2) }, 500
+                     return {"error calculating top similiar": str(e), "index": search_index.stats()}, 500
 
             # Return results
             return top_similar, 200
@@ -489,10 +787,235 @@ class SearchService(Resource):
             return {"error": str(e)}, 500
 
 
+class BatchSearchService(Resource):
+    def post(self):
+        """
+        Search for many query images in one request.
+
+        Query descriptors are calculated in parallel and the whole query x corpus
+        distance block is scored with matrix operations (exact scores, current weights).
+
+        Request Parameters:
+        - images: Query image files (multipart/form-data), or
+        - descriptors: JSON list of precomputed descriptor dicts (JSON body or form field).
+        - top_n: Optional number of results per query (default 10).
+
+        Response:
+        - {"results": [{"query": filename or position, "results": [...]} or {"query", "error"}]}
+        """
+        try:
+            body = request.get_json(silent=True)
+            body = body if isinstance(body, dict) else {}
+            try:
+                top_n = int(body.get('top_n', request.form.get('top_n', 10)))
+                if top_n < 1:
+                    raise ValueError
+            except (TypeError, ValueError):
+                return {"error": "top_n must be a positive integer"}, 400
+
+            if 'images' in request.files:
+                payloads = [(image_file.filename, image_file.read()) for image_file in request.files.getlist('images')]
+                described = dict(describe_images(payloads))
+                queries = [(filename, described[filename]) for filename, _ in payloads]
+            elif 'descriptors' in body or 'descriptors' in request.form:
+                try:
+                    descriptors = body['descriptors'] if 'descriptors' in body else json.loads(request.form['descriptors'])
+                except ValueError:
+                    return {"error": "descriptors must be a JSON list"}, 400
+                if not isinstance(descriptors, list) or not descriptors:
+                    return {"error": "descriptors must be a non-empty JSON list"}, 400
+                queries = list(enumerate(descriptors))
+            else:
+                return {"error": "Query images or descriptors are required"}, 400
+
+            search_index.refresh()
+            w1, w2, w3, frame_weights, color_weights = load_weights(feedback_session())
+            top_similar = search_index.search_batch(
+                [descriptor for _, descriptor in queries], top_n=top_n,
+                w1=w1, w2=w2, w3=w3, frame_weights=frame_weights, color_weights=color_weights
+            )
+
+            results = []
+            for (query, descriptor), top in zip(queries, top_similar):
+                if top is None:
+                    error = descriptor.get("error") if isinstance(descriptor, dict) else None
+                    results.append({"query": query, "error": error or "Invalid descriptors"})
+                else:
+                    results.append({"query": query, "results": top})
+            return {"results": results}, 200
+
+        except Exception as e:
+            return {"error": str(e)}, 500
+
+
+class DuplicatesService(Resource):
+    def get(self):
+        """
+        Near duplicates of an indexed image.
+
+        Query Parameters:
+        - filename or id: The indexed image.
+        - radius: Optional maximum pHash Hamming distance (default DUPLICATE_RADIUS).
+        - limit: Optional maximum number of duplicates returned (default 50).
+        - category: Optional categories the lookup is restricted to.
+
+        Response:
+        - {"hash", "radius", "total", "duplicates": [{"filename", "category", "distance", "exact"}]},
+          closest first. Exact duplicates have equal pHash and dHash.
+        """
+        search_index.refresh()
+        state = search_index.state
+        if request.args.get('id'):
+            key = request.args['id']
+            # Snapshot-backed states use string keys
+            row = state.row_of.get(key)
+            if row is None and ObjectId.is_valid(key):
+                row = state.row_of.get(ObjectId(key))
+        elif request.args.get('filename'):
+            row = state.row_of_filename.get(request.args['filename'])
+        else:
+            return {"error": "A filename or id is required"}, 400
+
+        if row is None:
+            return {"error": "Image not found in the index"}, 404
+        if not state.hashed[row]:
+            return {"error": "Image has no perceptual hash, re-ingest it to compute one"}, 409
+        hashes = tuple(int(h) for h in state.hashes[row])
+        return duplicates_response(hashes, request.args, exclude_row=row), 200
+
+    def post(self):
+        """
+        Near duplicates of an uploaded image; only its perceptual hash is computed.
+
+        Request Parameters:
+        - image: The image file (multipart/form-data).
+        - radius, limit, category: As for GET.
+        """
+        if "image" not in request.files:
+            return {"error": "Image file is required"}, 400
+
+        with metrics.time("decode"):
+            image = DESCRIPTOR_MODE.decode(request.files["image"].read())
+        if image is None:
+            return {"error": "Invalid image file"}, 400
+        with metrics.time("descriptor.perceptual_hash"):
+            hashes = parse_hashes(image_hashes(image))
+        search_index.refresh()
+        return duplicates_response(hashes, request.form), 200
+
+
+class CacheService(Resource):
+    def get(self):
+        """Return hit/miss counters and memory use of the query caches."""
+        return query_cache.stats(), 200
+
+    def delete(self):
+        """Empty the query caches."""
+        query_cache.clear()
+        return {"message": "Query cache cleared"}, 200
+
+
+class MetricsService(Resource):
+    def get(self):
+        """Per-stage latency quantiles, counters and corpus gauges in Prometheus text format."""
+        return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+class WeightsService(Resource):
+    def get(self):
+        """Weights of a feedback session (?session= or X-Feedback-Session) and write-behind stats."""
+        session = request.args.get('session') or request.headers.get('X-Feedback-Session') or None
+        w1, w2, w3, frame_weights, color_weights = load_weights(session)
+        return {
+            "session": session,
+            "weights": {"w1": w1, "w2": w2, "w3": w3,
+                        "frame_weights": list(frame_weights), "color_weights": list(color_weights)},
+            "store": weight_store.stats(),
+        }, 200
+
+
+class IndexService(Resource):
+    def get(self):
+        """
+        Return the size, version and per-category partition sizes of the resident search index,
+        and the number of stored documents per descriptor_version. A mixed corpus (several
+        versions, or a version other than the current mode) needs re-indexing.
+        """
+        return {**search_index.stats(), "descriptors": descriptor_versions()}, 200
+
+    def post(self):
+        """Force the resident search index to re-sync with MongoDB."""
+        changed = search_index.refresh(force=True)
+        return {"changed": changed, **search_index.stats()}, 200
+
+
+class SearchRecallService(Resource):
+    def get(self):
+        """
+        Report the recall of an approximate search mode against the exact ranking.
+
+        Query Parameters:
+        - mode: Approximate search mode to evaluate ('ann' or 'cascade').
+        - nprobe: Optional comma separated list of nprobe values (ann).
+        - rerank: Optional comma separated list of rerank depths (ann).
+        - cascade_k: Optional comma separated list of first pass candidate counts (cascade).
+        - queries: Number of indexed images sampled as queries (default 50).
+        - k: Depth of the compared rankings (default 10).
+
+        Response:
+        - Exact latency plus recall@k and latency for every (nprobe, rerank) pair or cascade_k.
+        """
+        mode = request.args.get('mode', 'ann')
+        if mode not in ('ann', 'cascade'):
+            return {"error": f"Recall is only reported for approximate modes, got '{mode}'"}, 400
+
+        if mode == 'cascade':
+            try:
+                cascade_ks = [int(v) for v in request.args.get('cascade_k', str(CASCADE_K)).split(',')]
+            except ValueError:
+                return {"error": "cascade_k must be comma separated integers"}, 400
+
+            search_index.refresh()
+            w1, w2, w3, frame_weights, color_weights = load_weights(request.args.get('session'))
+            report = cascade_recall_report(
+                search_index, cascade_ks,
+                queries=request.args.get('queries', 50, type=int),
+                top_k=request.args.get('k', 10, type=int),
+                w1=w1, w2=w2, w3=w3, frame_weights=frame_weights, color_weights=color_weights
+            )
+            return {"mode": mode, "index": search_index.stats(), **report}, 200
+
+        try:
+            nprobes = [int(v) for v in request.args.get('nprobe', str(ann_index.nprobe)).split(',')]
+            reranks = [int(v) for v in request.args.get('rerank', str(ann_index.rerank)).split(',')]
+        except ValueError:
+            return {"error": "nprobe and rerank must be comma separated integers"}, 400
+
+        search_index.refresh()
+        w1, w2, w3, frame_weights, color_weights = load_weights(request.args.get('session'))
+        report = recall_report(
+            ann_index,
+            [(nprobe, rerank) for nprobe in nprobes for rerank in reranks],
+            queries=request.args.get('queries', 50, type=int),
+            top_k=request.args.get('k', 10, type=int),
+            w1=w1, w2=w2, w3=w3, frame_weights=frame_weights, color_weights=color_weights
+        )
+        return {"mode": mode, "index": ann_index.stats(), **report}, 200
+
+
 # Register API Endpoints
 api.add_resource(DescriptorService, '/calculate-descriptors')
 api.add_resource(TransformService, '/transform')
+api.add_resource(TransformBatchService, '/transform/batch')
+api.add_resource(DominantColorReportService, '/dominant-colors/report')
 api.add_resource(SearchService, '/search')
+api.add_resource(BatchSearchService, '/search/batch')
+api.add_resource(SearchRecallService, '/search/recall')
+api.add_resource(IndexService, '/index')
+api.add_resource(DuplicatesService, '/duplicates')
+api.add_resource(WeightsService, '/weights')
+api.add_resource(CacheService, '/cache')
+api.add_resource(MetricsService, '/metrics')
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,253 @@
+"""
+Bulk ingestion of an image directory tree into the image collection.
+
+Usage (from the api folder, with the same .env as images.py):
+
+    python ingest.py /data/images [--workers 8] [--batch-size 500] [--checkpoint PATH]
+                     [--copy-to ../api/uploaded_images] [--dtype float32|float16] [--no-legacy]
+                     [--retry-failed]
+
+The category of an image is its first subfolder under the root (images
+directly in the root get --category, none by default). Category trees reuse
+file names, so an image is stored (and copied) under its path relative to the
+root with the folders joined by '__' (cats/img_0.png -> cats__img_0.png).
+Documents are upserted by that filename, with the fields of the Node upload
+route plus the packed descriptor blob, the descriptor_version of the current
+DESCRIPTOR_MODE and the perceptual hashes used by the near-duplicate lookup.
+
+Progress is appended to a checkpoint file (one JSON line per image) after
+every batch is written, so an interrupted run resumes where it stopped.
+Images that failed to decode are not retried unless --retry-failed is given.
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+
+from descriptor_store import PACKED_FIELD, pack_descriptors
+from descriptors import DESCRIPTOR_MODE, describe_image_bytes
+from perceptual_hash import HASH_FIELD, split_hashes
+from search_index import UPDATED_FIELD
+
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp", ".tif", ".tiff"}
+
+
+def walk_images(root, extensions=IMAGE_EXTENSIONS):
+    """Relative paths of every image under `root`, in a stable order."""
+    for directory, subdirs, files in os.walk(root):
+        subdirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in extensions:
+                yield os.path.relpath(os.path.join(directory, name), root)
+
+
+def stored_filename(relpath):
+    """Flat, unique filename of an image: its relative path with the folders joined by '__'."""
+    return "__".join(relpath.replace(os.sep, "/").split("/"))
+
+
+def category_of(relpath, default=None):
+    """Category of an image: its first folder under the ingestion root."""
+    parts = relpath.replace(os.sep, "/").split("/")
+    return parts[0] if len(parts) > 1 else default
+
+
+def read_checkpoint(path):
+    """Status of every image recorded in a checkpoint file: relpath -> 'ok' | 'error'."""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Torn last line of a crashed run
+                continue
+            done[entry["path"]] = entry["status"]
+    return done
+
+
+def _ends_with_newline(path):
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def describe_file(root, relpath, copy_to=None):
+    """
+    Worker task: read, describe and optionally copy one image.
+
+    :return: Tuple (relpath, descriptors or {"error": ...}).
+    """
+    try:
+        with open(os.path.join(root, relpath), "rb") as f:
+            data = f.read()
+    except OSError as e:
+        return relpath, {"error": f"Could not read image: {e}"}
+
+    filename = stored_filename(relpath)
+    _, descriptor = describe_image_bytes(filename, data)
+    if copy_to and "error" not in descriptor:
+        with open(os.path.join(copy_to, filename), "wb") as f:
+            f.write(data)
+    return relpath, descriptor
+
+
+def image_update(descriptor, category, dtype="float32", legacy=True):
+    """Upsert of the image document of one described image."""
+    descriptor, hashes = split_hashes(descriptor)
+    try:
+        blob = pack_descriptors(descriptor, dtype)
+    except ValueError:
+        # Raw histogram counts overflow float16
+        blob = pack_descriptors(descriptor, "float32")
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    # Re-ingesting a file rewrites its descriptors in place, UPDATED_FIELD makes the index re-fetch it
+    fields = {"category": category, PACKED_FIELD: blob, "descriptor_version": DESCRIPTOR_MODE.version,
+              HASH_FIELD: hashes, UPDATED_FIELD: now}
+    if legacy:
+        fields["characteristics"] = descriptor
+    return {"$set": fields, "$setOnInsert": {"uploadDate": now}}
+
+
+class Progress:
+    """Throughput report printed every `interval` seconds."""
+
+    def __init__(self, total, interval=5.0, stream=sys.stdout):
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.start = self.last = time.perf_counter()
+        self.last_count = 0
+        self.count = 0
+        self.failed = 0
+
+    def update(self, count, failed=0, force=False):
+        self.count += count
+        self.failed += failed
+        now = time.perf_counter()
+        if not force and now - self.last < self.interval:
+            return
+        rate = (self.count - self.last_count) / max(now - self.last, 1e-9)
+        average = self.count / max(now - self.start, 1e-9)
+        print(f"{self.count}/{self.total} images ({self.failed} failed) "
+              f"{rate:.1f} images/s, {average:.1f} images/s average", file=self.stream, flush=True)
+        self.last, self.last_count = now, self.count
+
+
+def ingest(collection, root, checkpoint, workers=None, batch_size=500, copy_to=None, dtype="float32",
+           legacy=True, default_category=None, retry_failed=False, report_interval=5.0):
+    """
+    Describe every image under `root` and upsert it into `collection`.
+
+    :return: Dict of counters (written, failed, skipped, seconds).
+    """
+    done = read_checkpoint(checkpoint)
+    paths = list(walk_images(root))
+    pending = [p for p in paths if p not in done or (retry_failed and done[p] == "error")]
+    stats = {"written": 0, "failed": 0, "skipped": len(paths) - len(pending)}
+    if copy_to:
+        os.makedirs(copy_to, exist_ok=True)
+
+    progress = Progress(len(pending), report_interval)
+    ops, entries = [], []
+
+    def flush(log):
+        if ops:
+            collection.bulk_write(ops, ordered=False)
+        # Checkpointed only once the batch is stored
+        for entry in entries:
+            log.write(json.dumps(entry) + "\n")
+        log.flush()
+        os.fsync(log.fileno())
+        ops.clear()
+        entries.clear()
+
+    def handle(relpath, descriptor):
+        if "error" in descriptor:
+            entries.append({"path": relpath, "status": "error", "error": descriptor["error"]})
+            stats["failed"] += 1
+            progress.update(1, failed=1)
+            return
+        filename = stored_filename(relpath)
+        update = image_update(descriptor, category_of(relpath, default_category), dtype, legacy)
+        ops.append(UpdateOne({"filename": filename}, update, upsert=True))
+        entries.append({"path": relpath, "status": "ok"})
+        stats["written"] += 1
+        progress.update(1)
+
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    with open(checkpoint, "a", encoding="utf-8") as log:
+        if log.tell() and not _ends_with_newline(checkpoint):
+            # Terminate the torn last line of a crashed run, or it would swallow the next entry
+            log.write("\n")
+        if workers <= 1:
+            for relpath in pending:
+                handle(*describe_file(root, relpath, copy_to))
+                if len(entries) >= batch_size:
+                    flush(log)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                # Bounded number of in-flight images, so memory does not grow with the tree
+                queue = iter(pending)
+                in_flight = set()
+                while True:
+                    for relpath in queue:
+                        in_flight.add(pool.submit(describe_file, root, relpath, copy_to))
+                        if len(in_flight) >= workers * 4:
+                            break
+                    if not in_flight:
+                        break
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        handle(*future.result())
+                    if len(entries) >= batch_size:
+                        flush(log)
+        flush(log)
+
+    progress.update(0, force=True)
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index an image directory tree (category = first subfolder).")
+    parser.add_argument("root", help="Directory holding the images")
+    parser.add_argument("--workers", type=int, default=None, help="Descriptor worker processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=500, help="Documents per bulk_write")
+    parser.add_argument("--checkpoint", default=None,
+                        help="Progress file (default: <root folder name>.ingest-checkpoint)")
+    parser.add_argument("--copy-to", default=None,
+                        help="Also copy the images here (e.g. the Node uploaded_images folder) so they can be downloaded")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32",
+                        help="Precision of the packed descriptors")
+    parser.add_argument("--no-legacy", action="store_true", help="Only store the packed descriptors")
+    parser.add_argument("--category", default=None, help="Category of the images directly in the root")
+    parser.add_argument("--retry-failed", action="store_true", help="Retry images that failed in a previous run")
+    args = parser.parse_args()
+
+    load_dotenv()
+    client = MongoClient(os.getenv('MONGO_URI'))
+    collection = client[os.getenv('DATABASE_NAME')][os.getenv('COLLECTION_NAME')]
+
+    root = os.path.abspath(args.root)
+    checkpoint = args.checkpoint or f"{os.path.basename(root.rstrip(os.sep))}.ingest-checkpoint"
+    stats = ingest(collection, root, checkpoint, workers=args.workers, batch_size=args.batch_size,
+                   copy_to=args.copy_to, dtype=args.dtype, legacy=not args.no_legacy,
+                   default_category=args.category, retry_failed=args.retry_failed)
+    rate = stats["written"] / max(stats["seconds"], 1e-9)
+    print(f"{stats} ({rate:.1f} images/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Per-stage latency instrumentation for the image service.
+
+Stages are timed with `metrics.time(name)`. Every duration lands in a
+fixed-bucket histogram (log spaced, 1us to 100s, so recording is one bisect
+and no allocation) and in the timings of the current request, which are
+emitted as a Server-Timing header. `render_prometheus()` exposes p50 / p95 /
+p99 per stage, request counters and gauges in Prometheus text format.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Histogram bucket upper bounds in seconds: 10 buckets per decade from 1us to 100s
+BUCKET_BOUNDS = [1e-6 * 10 ** (i / 10) for i in range(81)]
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class StageHistogram:
+    """Latency histogram of one stage."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating inside the bucket that contains it."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            if n and seen + n >= rank:
+                low = BUCKET_BOUNDS[i - 1] if i > 0 else 0.0
+                high = BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else self.max
+                return min(low + (high - low) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
+
+
+class _NullTimer:
+    """Shared no-op context manager returned when metrics are disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """
+    Registry of stage histograms, counters and gauges.
+
+    Parameters:
+        enabled (bool): When False, `time()` returns a shared no-op context manager.
+        prefix (str): Prefix of every exported metric name.
+    """
+
+    def __init__(self, enabled=True, prefix="image_service"):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def time(self, stage):
+        """Context manager timing `stage`."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return self._time(stage)
+
+    @contextmanager
+    def _time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        """Record a duration for `stage` and for the current request."""
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = StageHistogram()
+            histogram.observe(seconds)
+        timings = getattr(self._local, "timings", None)
+        if timings is not None:
+            timings.append((stage, seconds))
+
+    def inc(self, name, labels=(), value=1):
+        """Increment the counter `name` with the given label pairs."""
+        if not self.enabled:
+            return
+        key = (name, tuple(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, fn):
+        """Register a gauge whose value is read from `fn()` at export time."""
+        self.gauges[name] = fn
+
+    def begin_request(self):
+        self._local.timings = []
+
+    def end_request(self):
+        """Timings of the current request, as (stage, seconds) pairs."""
+        timings = getattr(self._local, "timings", None) or []
+        self._local.timings = None
+        return timings
+
+    @staticmethod
+    def server_timing(timings):
+        """Format request timings as a Server-Timing header value."""
+        return ", ".join(f"{stage.replace(' ', '_')};dur={seconds * 1000:.2f}" for stage, seconds in timings)
+
+    def render_prometheus(self):
+        """All metrics in Prometheus text exposition format."""
+        lines = []
+        name = f"{self.prefix}_stage_seconds"
+        lines.append(f"# HELP {name} Latency of the service stages.")
+        lines.append(f"# TYPE {name} summary")
+        with self._lock:
+            stages = sorted(self.stages.items())
+            counters = sorted(self.counters.items())
+        for stage, histogram in stages:
+            for q in QUANTILES:
+                lines.append(f'{name}{{stage="{stage}",quantile="{q}"}} {histogram.quantile(q):.6g}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum:.6g}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+
+        typed = set()
+        for (counter, labels), value in counters:
+            metric = f"{self.prefix}_{counter}"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} counter")
+                typed.add(metric)
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"{metric}{{{label_text}}} {value}" if label_text else f"{metric} {value}")
+
+        for gauge, fn in sorted(self.gauges.items()):
+            metric = f"{self.prefix}_{gauge}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {fn()}")
+        return "\n".join(lines) + "\n"
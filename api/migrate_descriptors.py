@@ -0,0 +1,83 @@
+"""
+Convert stored image documents to the packed descriptor format, in place.
+
+Usage (from the api folder, with the same .env as images.py):
+
+    python migrate_descriptors.py [--dtype float32|float16] [--drop-legacy] [--batch-size 500] [--dry-run]
+
+Documents that already have a packed blob are skipped, so the command can be
+re-run safely. Values that overflow float16 (raw histogram counts usually do)
+are stored as float32 for that document.
+
+--drop-legacy removes the nested 'characteristics' arrays once the packed blob
+is written; only use it when no client still reads them.
+"""
+import argparse
+import os
+import time
+
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+
+from descriptor_store import PACKED_FIELD, pack_descriptors
+from search_index import flatten_descriptor
+
+
+def migrate(collection, dtype="float32", drop_legacy=False, batch_size=500, dry_run=False):
+    """
+    Pack the descriptors of every legacy document of `collection`.
+
+    :return: Dict of counters (converted, float32_fallback, skipped).
+    """
+    stats = {"converted": 0, "float32_fallback": 0, "skipped": 0}
+    query = {PACKED_FIELD: {"$exists": False}, "characteristics": {"$exists": True}}
+    ops = []
+
+    def flush():
+        if ops and not dry_run:
+            collection.bulk_write(ops, ordered=False)
+        ops.clear()
+
+    for doc in collection.find(query, {"characteristics": 1}):
+        characteristics = doc["characteristics"]
+        if flatten_descriptor(characteristics) is None:
+            stats["skipped"] += 1
+            continue
+
+        try:
+            blob = pack_descriptors(characteristics, dtype)
+        except ValueError:
+            blob = pack_descriptors(characteristics, "float32")
+            stats["float32_fallback"] += 1
+
+        update = {"$set": {PACKED_FIELD: blob}}
+        if drop_legacy:
+            update["$unset"] = {"characteristics": ""}
+        ops.append(UpdateOne({"_id": doc["_id"]}, update))
+        stats["converted"] += 1
+
+        if len(ops) >= batch_size:
+            flush()
+    flush()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert image descriptors to the packed binary format.")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    parser.add_argument("--drop-legacy", action="store_true", help="Unset the nested 'characteristics' arrays")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true", help="Count the documents without writing")
+    args = parser.parse_args()
+
+    load_dotenv()
+    client = MongoClient(os.getenv('MONGO_URI'))
+    collection = client[os.getenv('DATABASE_NAME')][os.getenv('COLLECTION_NAME')]
+
+    start = time.perf_counter()
+    stats = migrate(collection, args.dtype, args.drop_legacy, args.batch_size, args.dry_run)
+    print(f"{stats} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+Perceptual hashes used to find re-uploads and lightly edited copies.
+
+Every image gets two 64 bit hashes, stored as 16 hex digit strings:
+
+    phash  sign of the 8x8 low-frequency DCT coefficients of a 32x32 thumbnail
+           against their median (robust to rescaling, recompression, small edits)
+    dhash  sign of the horizontal gradients of a 9x8 thumbnail (cheap, used to
+           confirm exact duplicates)
+
+Near duplicates are looked up by Hamming distance on the pHash with
+multi-index hashing: the hash is split into four 16 bit chunks, each kept in a
+sorted table. Two hashes within distance r share at least one chunk within
+distance r // 4, so only the buckets of those chunk variants are verified.
+"""
+import cv2
+import numpy as np
+
+
+# Document field (and descriptor stage) holding {"phash": hex, "dhash": hex}
+HASH_FIELD = "perceptual_hash"
+
+CHUNKS = 4
+CHUNK_BITS = 16
+# Beyond this per-chunk radius the variants outnumber a linear scan
+MAX_CHUNK_RADIUS = 2
+
+_CHUNK_VALUES = np.arange(2 ** CHUNK_BITS, dtype=np.uint32)
+# XOR masks of every chunk variant within a given radius
+FLIP_MASKS = [_CHUNK_VALUES[np.bitwise_count(_CHUNK_VALUES) <= r] for r in range(MAX_CHUNK_RADIUS + 1)]
+
+
+def _gray(image):
+    return image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def _pack_bits(bits):
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def phash(image):
+    """64 bit DCT hash of a BGR or grayscale image."""
+    small = cv2.resize(_gray(image), (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    coefficients = cv2.dct(small)[:8, :8].ravel()
+    # The DC term only carries the mean brightness
+    return _pack_bits(coefficients > np.median(coefficients[1:]))
+
+
+def dhash(image):
+    """64 bit difference hash of a BGR or grayscale image."""
+    small = cv2.resize(_gray(image), (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return _pack_bits(small[:, 1:] > small[:, :-1])
+
+
+def image_hashes(image):
+    """Both hashes of an image, as stored in the HASH_FIELD of its document."""
+    gray = _gray(image)
+    return {"phash": f"{phash(gray):016x}", "dhash": f"{dhash(gray):016x}"}
+
+
+def parse_hashes(value):
+    """(phash, dhash) integers of a stored hash dict, or None if missing or malformed."""
+    if not isinstance(value, dict):
+        return None
+    try:
+        return int(value["phash"], 16), int(value["dhash"], 16)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def split_hashes(descriptor):
+    """Split a descriptor dict into (numeric descriptors, hash dict or None)."""
+    if not isinstance(descriptor, dict) or HASH_FIELD not in descriptor:
+        return descriptor, None
+    return {name: values for name, values in descriptor.items() if name != HASH_FIELD}, descriptor[HASH_FIELD]
+
+
+def hamming(hashes, value):
+    """Hamming distances between an array of uint64 hashes and one hash."""
+    return np.bitwise_count(np.asarray(hashes, dtype=np.uint64) ^ np.uint64(value)).astype(np.int64)
+
+
+class HashIndex:
+    """
+    Multi-index hashing table over 64 bit hashes.
+
+    Parameters:
+        rows (np.ndarray): Row of every hash in the descriptor index.
+        hashes (np.ndarray): uint64 hashes.
+    """
+
+    def __init__(self, rows, hashes):
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.tables = []
+        for m in range(CHUNKS):
+            chunk = ((self.hashes >> np.uint64(m * CHUNK_BITS)) & np.uint64(0xFFFF)).astype(np.uint16)
+            order = np.argsort(chunk, kind="stable")
+            self.tables.append((chunk[order], order))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _candidates(self, value, radius):
+        chunk_radius = radius // CHUNKS
+        if chunk_radius > MAX_CHUNK_RADIUS:
+            return np.arange(len(self.rows))
+        positions = []
+        for m, (chunks, order) in enumerate(self.tables):
+            # Same dtype as the table, so searchsorted does not convert it
+            keys = (np.uint32((value >> (m * CHUNK_BITS)) & 0xFFFF) ^ FLIP_MASKS[chunk_radius]).astype(np.uint16)
+            starts = np.searchsorted(chunks, keys, side="left")
+            stops = np.searchsorted(chunks, keys, side="right")
+            positions.extend(order[start:stop] for start, stop in zip(starts, stops) if stop > start)
+        if not positions:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(positions))
+
+    def lookup(self, value, radius):
+        """
+        Rows whose hash is within `radius` bits of `value`.
+
+        Returns:
+            tuple: (rows, distances), ordered by distance then row.
+        """
+        if not len(self.rows):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        candidates = self._candidates(int(value), radius)
+        distances = hamming(self.hashes[candidates], value)
+        keep = distances <= radius
+        rows, distances = self.rows[candidates[keep]], distances[keep]
+        order = np.lexsort((rows, distances))
+        return rows[order], distances[order]
@@ -0,0 +1,156 @@
+"""
+In-process caches for repeated queries.
+
+Level one maps the content hash of an uploaded image to its query descriptor,
+level two maps (descriptor hash, weights version, corpus version, search
+options) to the top N result list. Both are LRU caches bounded by an
+approximate memory budget.
+"""
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from search_index import FAMILY_NAMES, flatten_descriptor
+
+
+def estimate_size(value):
+    """Approximate memory footprint of a cached value in bytes."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes + 112
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache bounded by an approximate memory budget.
+
+    Parameters:
+        max_bytes (int): Memory budget; least recently used entries are evicted beyond it.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class QueryCache:
+    """
+    Two-level query cache: image content -> descriptor, and query -> results.
+
+    The result level is keyed by the weights and corpus versions, and is
+    cleared as soon as the corpus version changes so stale results never
+    occupy the budget.
+
+    Parameters:
+        max_bytes (int): Total memory budget, split evenly between both levels.
+    """
+
+    def __init__(self, max_bytes):
+        self.descriptors = LRUCache(max_bytes // 2)
+        self.results = LRUCache(max_bytes // 2)
+        self._corpus_version = None
+
+    def get_descriptor(self, key):
+        return self.descriptors.get(key)
+
+    def put_descriptor(self, key, descriptor):
+        self.descriptors.put(key, descriptor)
+
+    def results_key(self, descriptor, weights, corpus_version, *options):
+        if corpus_version != self._corpus_version:
+            self.results.clear()
+            self._corpus_version = corpus_version
+        return (descriptor_hash(descriptor), weights_version(**weights), corpus_version) + tuple(options)
+
+    def get_results(self, key):
+        return self.results.get(key)
+
+    def put_results(self, key, results):
+        self.results.put(key, results)
+
+    def clear(self):
+        self.descriptors.clear()
+        self.results.clear()
+
+    def stats(self):
+        return {"descriptors": self.descriptors.stats(), "results": self.results.stats()}
+
+
+def content_hash(data, *salt):
+    """Hash of uploaded image bytes, salted with whatever changes the descriptors."""
+    h = hashlib.sha256(data)
+    for value in salt:
+        h.update(repr(value).encode("utf-8"))
+    return h.hexdigest()
+
+
+def descriptor_hash(descriptor):
+    """Hash of a query descriptor, independent of how it is nested."""
+    flat = flatten_descriptor(descriptor)
+    h = hashlib.sha256()
+    for name in FAMILY_NAMES:
+        h.update(flat[name].tobytes())
+    return h.hexdigest()
+
+
+def weights_version(w1, w2, w3, frame_weights, color_weights):
+    """Version of a set of weights; changes whenever any weight changes."""
+    values = (w1, w2, w3, *frame_weights, *color_weights)
+    return hashlib.sha256(np.asarray(values, dtype=np.float64).tobytes()).hexdigest()[:16]
@@ -0,0 +1,712 @@
+"""
+Resident in-process descriptor index used by the search endpoints.
+
+Every descriptor family is kept as a contiguous float32 matrix (one row per
+image) so a query is scored against the whole corpus in one batched pass
+instead of decoding and looping over every Mongo document on each request.
+"""
+import contextlib
+import functools
+import threading
+import time
+
+import numpy as np
+
+from descriptor_store import PACKED_FIELD, read_descriptors
+from perceptual_hash import HASH_FIELD, HashIndex, hamming, parse_hashes
+
+
+# (name, width) of every descriptor family produced by calculate_img_descriptors
+DESCRIPTOR_FAMILIES = (
+    ("hu_moments", 7),
+    ("edge_histogram", 256),
+    ("color_histogram", 768),
+    ("average_color", 3),
+    ("dominant_colors", 15),
+    ("texture_descriptors", 4),
+)
+FAMILY_NAMES = tuple(name for name, _ in DESCRIPTOR_FAMILIES)
+FAMILY_WIDTHS = dict(DESCRIPTOR_FAMILIES)
+
+# Rows scored per block, keeps the float32 temporaries small on big corpora
+CHUNK_ROWS = 8192
+
+# Compact families scored by the first pass of the cascade mode (29 of the 1053 values)
+CASCADE_FAMILIES = ("hu_moments", "average_color", "dominant_colors", "texture_descriptors")
+# Candidates kept by the first pass and re-ranked with the exact score
+CASCADE_K = 200
+
+# Only these fields are needed to build the index (either descriptor format)
+INDEX_PROJECTION = {"filename": 1, "category": 1, "characteristics": 1, PACKED_FIELD: 1, HASH_FIELD: 1}
+
+# Bumped (to the current UTC datetime) by every writer that changes the descriptors of an
+# existing document in place, so a refresh re-fetches it
+UPDATED_FIELD = "updated_at"
+
+# Hamming distance (pHash bits) under which two images count as near duplicates
+DUPLICATE_RADIUS = 6
+
+
+def flatten_family(values, width):
+    """Flatten a (possibly nested) descriptor family into a fixed-width float32 row.
+
+    Missing values (e.g. empty Hu moments when no contour was found) are zero padded.
+    """
+    row = np.zeros(width, dtype=np.float32)
+    if values is None:
+        return row
+    flat = np.ravel(np.asarray(values, dtype=np.float32))
+    n = min(width, flat.size)
+    row[:n] = flat[:n]
+    return row
+
+
+def flatten_descriptor(descriptor):
+    """Turn a descriptor dict into {family: float32 row}, or None if it is unusable."""
+    if not isinstance(descriptor, dict) or "error" in descriptor:
+        return None
+    if not all(name in descriptor for name in FAMILY_NAMES):
+        return None
+    return {name: flatten_family(descriptor[name], width) for name, width in DESCRIPTOR_FAMILIES}
+
+
+def combine_distances(d, w1, w2, w3, frame_weights, color_weights):
+    """
+    Combine per-family distances into the global score, exactly like simple_search.
+
+    Works on scalars as well as on numpy arrays of distances.
+    """
+    frame_dist = (
+        frame_weights[0] * d["hu_moments"] +
+        frame_weights[1] * d["edge_histogram"]
+    )
+    color_dist = (
+        color_weights[0] * d["color_histogram"] +
+        color_weights[1] * d["average_color"] +
+        color_weights[2] * d["dominant_colors"]
+    )
+    texture_dist = d["texture_descriptors"]
+    return (w1 * frame_dist + w2 * color_dist + w3 * texture_dist) / 3
+
+
+def family_coefficients(w1, w2, w3, frame_weights, color_weights):
+    """Multiplier applied to each family distance in the global score."""
+    return {
+        name: combine_distances({other: float(other == name) for other in FAMILY_NAMES},
+                                w1, w2, w3, frame_weights, color_weights)
+        for name in FAMILY_NAMES
+    }
+
+
+def euclidean_rows(matrix, q, rows=None, chunk=CHUNK_ROWS):
+    """Euclidean distance between `q` and every row of `matrix` (or only `rows`)."""
+    n = matrix.shape[0] if rows is None else len(rows)
+    out = np.empty(n, dtype=np.float64)
+    for start in range(0, n, chunk):
+        stop = min(start + chunk, n)
+        block = matrix[start:stop] if rows is None else matrix[rows[start:stop]]
+        diff = block - q
+        out[start:stop] = np.einsum("ij,ij->i", diff, diff, dtype=np.float64)
+    return np.sqrt(out, out=out)
+
+
+def top_n_rows(scores, top_n):
+    """Indices of the `top_n` smallest scores, ordered by score then by row."""
+    n = scores.shape[0]
+    if n == 0 or top_n <= 0:
+        return np.empty(0, dtype=np.int64)
+    if top_n < n:
+        candidates = np.argpartition(scores, top_n - 1)[:top_n]
+    else:
+        candidates = np.arange(n)
+    # lexsort keeps ties in collection order like the stable sort in simple_search
+    return candidates[np.lexsort((candidates, scores[candidates]))]
+
+
+class IndexState:
+    """
+    Immutable content of the index; replaced as a whole on refresh.
+
+    `hashes` holds the (phash, dhash) of every row as uint64 and `hashed`
+    flags the rows that have them (documents stored before the hashes were
+    introduced do not).
+    """
+
+    def __init__(self, keys, filenames, categories, matrices, hashes=None, hashed=None):
+        self.keys = keys
+        self.filenames = filenames
+        self.categories = categories
+        self.matrices = matrices
+        self.hashes = np.zeros((len(keys), 2), dtype=np.uint64) if hashes is None else hashes
+        self.hashed = np.zeros(len(keys), dtype=bool) if hashed is None else hashed
+
+    @functools.cached_property
+    def row_of(self):
+        return {key: row for row, key in enumerate(self.keys)}
+
+    @functools.cached_property
+    def row_of_filename(self):
+        return {filename: row for row, filename in reversed(list(enumerate(self.filenames.tolist())))}
+
+    @functools.cached_property
+    def squared_norms(self):
+        """Squared L2 norm of every row, per family (float64)."""
+        return {name: np.einsum("ij,ij->i", m, m, dtype=np.float64) for name, m in self.matrices.items()}
+
+    @functools.cached_property
+    def partitions(self):
+        """Rows of every category, in collection order."""
+        rows = {}
+        for row, category in enumerate(self.categories.tolist()):
+            rows.setdefault(category, []).append(row)
+        return {category: np.array(r, dtype=np.int64) for category, r in rows.items()}
+
+    def category_rows(self, categories):
+        """Sorted rows of the given categories, or None (every row) when no category is given."""
+        if not categories:
+            return None
+        parts = [self.partitions[category] for category in categories if category in self.partitions]
+        if not parts:
+            return np.empty(0, dtype=np.int64)
+        return parts[0] if len(parts) == 1 else np.sort(np.concatenate(parts))
+
+    @functools.cached_property
+    def family_norms(self):
+        """L2 norm of every row, as an (n, families) float64 matrix in FAMILY_NAMES order."""
+        squared = self.squared_norms
+        return np.sqrt(np.column_stack([squared[name] for name in FAMILY_NAMES])).reshape(len(self), len(FAMILY_NAMES))
+
+    @functools.cached_property
+    def hash_index(self):
+        """Multi-index hashing table over the pHash of the hashed rows."""
+        rows = np.flatnonzero(self.hashed)
+        return HashIndex(rows, self.hashes[rows, 0])
+
+    def near_duplicates(self, hashes, radius=DUPLICATE_RADIUS):
+        """
+        Rows whose pHash is within `radius` bits of the given (phash, dhash).
+
+        Returns:
+            tuple: (rows, pHash distances, exact flags), ordered by distance then row.
+                   A row is an exact duplicate when both hashes are equal.
+        """
+        rows, distances = self.hash_index.lookup(hashes[0], radius)
+        exact = (distances == 0) & (self.hashes[rows, 1] == np.uint64(hashes[1]))
+        return rows, distances, exact
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def empty(cls):
+        return cls([], np.empty(0, dtype=object), np.empty(0, dtype=object),
+                   {name: np.empty((0, width), dtype=np.float32) for name, width in DESCRIPTOR_FAMILIES})
+
+    def select(self, mask):
+        """New state holding only the rows where `mask` is True."""
+        state = IndexState([key for key, keep in zip(self.keys, mask) if keep],
+                           self.filenames[mask], self.categories[mask],
+                           {name: np.ascontiguousarray(m[mask]) for name, m in self.matrices.items()},
+                           self.hashes[mask], self.hashed[mask])
+        if "squared_norms" in self.__dict__:
+            state.squared_norms = {name: norms[mask] for name, norms in self.squared_norms.items()}
+        if "partitions" in self.__dict__:
+            mask = np.asarray(mask, dtype=bool)
+            new_row = np.cumsum(mask) - 1
+            partitions = {category: new_row[rows[mask[rows]]] for category, rows in self.partitions.items()}
+            state.partitions = {category: rows for category, rows in partitions.items() if len(rows)}
+        return state
+
+    def concat(self, other):
+        """New state holding the rows of this state followed by the rows of `other`."""
+        if not len(other):
+            return self
+        state = IndexState(list(self.keys) + list(other.keys),
+                           np.concatenate([self.filenames, other.filenames]),
+                           np.concatenate([self.categories, other.categories]),
+                           {name: np.concatenate([self.matrices[name], other.matrices[name]])
+                            for name in FAMILY_NAMES},
+                           np.concatenate([self.hashes, other.hashes]),
+                           np.concatenate([self.hashed, other.hashed]))
+        if "squared_norms" in self.__dict__:
+            # Incremental refresh: only the added rows need their norms computed
+            state.squared_norms = {name: np.concatenate([self.squared_norms[name], other.squared_norms[name]])
+                                   for name in FAMILY_NAMES}
+        if "partitions" in self.__dict__:
+            partitions = dict(self.partitions)
+            for category, rows in other.partitions.items():
+                rows = rows + len(self)
+                partitions[category] = np.concatenate([partitions[category], rows]) if category in partitions else rows
+            state.partitions = partitions
+        return state
+
+
+def build_state(docs):
+    """
+    Build an index state from image documents.
+
+    Returns:
+        tuple: (IndexState, set of every _id seen, including unusable documents)
+    """
+    keys, filenames, categories, hashes = [], [], [], []
+    rows = {name: [] for name in FAMILY_NAMES}
+    known = set()
+    for doc in docs:
+        known.add(doc["_id"])
+        flat = flatten_descriptor(read_descriptors(doc))
+        if flat is None:
+            continue
+        keys.append(doc["_id"])
+        filenames.append(doc.get("filename"))
+        categories.append(doc.get("category"))
+        hashes.append(parse_hashes(doc.get(HASH_FIELD)))
+        for name in FAMILY_NAMES:
+            rows[name].append(flat[name])
+
+    if not keys:
+        return IndexState.empty(), known
+
+    matrices = {name: np.ascontiguousarray(np.vstack(rows[name]), dtype=np.float32)
+                for name in FAMILY_NAMES}
+    hashed = np.array([h is not None for h in hashes], dtype=bool)
+    hash_matrix = np.array([h or (0, 0) for h in hashes], dtype=np.uint64).reshape(len(keys), 2)
+    state = IndexState(keys, np.array(filenames, dtype=object), np.array(categories, dtype=object), matrices,
+                       hash_matrix, hashed)
+    # Per-family norms and category partitions are computed at load time; norms feed batch
+    # search and relevance feedback, partitions the category-scoped searches
+    state.squared_norms
+    state.partitions
+    return state, known
+
+
+class DescriptorIndex:
+    """
+    Resident descriptor index backed by a Mongo collection.
+
+    The collection is only read through find / find_one / estimated_document_count,
+    so a mongomock collection works as well as a real one.
+
+    When a DescriptorSnapshot is given, the index is served from the memory-mapped
+    snapshot instead and a refresh only re-opens it after it was appended to or
+    compacted.
+
+    Parameters:
+        collection: Mongo collection holding the image documents.
+        refresh_interval (float): Minimum number of seconds between two change checks.
+        snapshot (DescriptorSnapshot): Optional read-only snapshot to serve from.
+        timer: Optional callable, stage name -> context manager timing that stage.
+    """
+
+    def __init__(self, collection, refresh_interval=1.0, snapshot=None, timer=None):
+        self.collection = collection
+        self.refresh_interval = refresh_interval
+        self.snapshot = snapshot
+        self.timer = timer or (lambda stage: contextlib.nullcontext())
+        self.version = 0
+        self._state = IndexState.empty()
+        self._known = set()  # every _id seen, including documents without usable descriptors
+        self._signature = None
+        self._newest = None  # newest _id already applied
+        self._updated_since = None  # newest UPDATED_FIELD value already applied
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._state)
+
+    @property
+    def state(self):
+        """Current immutable snapshot of the index."""
+        return self._state
+
+    def _collection_signature(self):
+        newest = self.collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        updated = self.collection.find_one({UPDATED_FIELD: {"$exists": True}}, {UPDATED_FIELD: 1},
+                                           sort=[(UPDATED_FIELD, -1)])
+        return (self.collection.estimated_document_count(), newest["_id"] if newest else None,
+                updated[UPDATED_FIELD] if updated else None)
+
+    def invalidate(self):
+        """Force the next refresh to re-check the collection."""
+        with self._lock:
+            self._signature = None
+            self._last_check = 0.0
+
+    def refresh(self, force=False):
+        """
+        Bring the index in sync with the collection.
+
+        A cheap (count, newest _id, newest updated_at) signature is checked
+        first. When it changed, only the documents past the newest known _id and
+        the ones whose UPDATED_FIELD moved past the last refresh are fetched.
+        The full _id list is only scanned when the count shows deletions, and
+        removed documents are dropped. `force=True` rebuilds the whole index from the collection,
+        which also picks up in-place edits made without bumping UPDATED_FIELD.
+
+        Returns:
+            bool: True if the index content changed.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_check < self.refresh_interval:
+            return False
+
+        if self.snapshot is not None:
+            return self._refresh_from_snapshot(now, force)
+
+        with self._lock:
+            self._last_check = now
+            signature = self._collection_signature()
+            if not force and signature == self._signature:
+                return False
+
+            if force or not self._known:
+                new_state, known = build_state(self.collection.find({}, INDEX_PROJECTION))
+            else:
+                added, removed = [], set()
+                if signature[1] is not None and signature[1] != self._newest:
+                    query = {"_id": {"$gt": self._newest}} if self._newest is not None else {}
+                    added = [doc["_id"] for doc in self.collection.find(query, {"_id": 1})
+                             if doc["_id"] not in self._known]
+                if len(self._known) + len(added) != signature[0]:
+                    # Deletions (or inserts below the newest _id): reconcile against every _id
+                    ids = [doc["_id"] for doc in self.collection.find({}, {"_id": 1})]
+                    id_set = set(ids)
+                    added = [i for i in ids if i not in self._known]
+                    removed = self._known - id_set
+                changed = set()
+                if self._updated_since is not None:
+                    changed = {doc["_id"] for doc in self.collection.find(
+                        {UPDATED_FIELD: {"$gte": self._updated_since}}, {"_id": 1})} & self._known
+                elif signature[2] is not None:
+                    # First marker seen since the last build: every marked document may be newer
+                    changed = {doc["_id"] for doc in self.collection.find(
+                        {UPDATED_FIELD: {"$exists": True}}, {"_id": 1})} & self._known
+                changed -= removed
+                if not added and not removed and not changed:
+                    self._signature = signature
+                    self._newest = signature[1]
+                    self._updated_since = signature[2]
+                    return False
+                new_state = self._apply_changes(self._state, added + list(changed), removed | changed)
+                known = (self._known - removed) | set(added)
+
+            self._state = new_state
+            self._known = known
+            self._signature = signature
+            self._newest = signature[1]
+            self._updated_since = signature[2]
+            self.version += 1
+            return True
+
+    def _refresh_from_snapshot(self, now, force):
+        with self._lock:
+            self._last_check = now
+            if self.version and not force and not self.snapshot.changed():
+                return False
+            if self.version:
+                try:
+                    self.snapshot.open()
+                except (OSError, ValueError):
+                    # Caught mid-write by the snapshot writer, keep serving the current state
+                    return False
+            self._state = self.snapshot.to_state()
+            self.version += 1
+            return True
+
+    def _apply_changes(self, state, added, removed):
+        state = state.select(np.array([key not in removed for key in state.keys], dtype=bool))
+        if added:
+            docs = []
+            for start in range(0, len(added), 1000):
+                docs.extend(self.collection.find({"_id": {"$in": added[start:start + 1000]}}, INDEX_PROJECTION))
+            state = state.concat(build_state(docs)[0])
+        return state
+
+    def family_distances(self, query_descriptor, rows=None, families=FAMILY_NAMES, state=None):
+        """Euclidean distance per descriptor family between the query and indexed images."""
+        if state is None:
+            state = self._state
+        query = flatten_descriptor(query_descriptor)
+        if query is None:
+            raise ValueError("Query descriptor is missing descriptor families")
+        return {name: euclidean_rows(state.matrices[name], query[name], rows) for name in families}
+
+    def scores(self, query_descriptor, rows=None, w1=0.1, w2=0.8, w3=0.1,
+               frame_weights=(0.7, 0.3), color_weights=(0.4, 0.1, 0.5), state=None):
+        """simple_search scores of the query against all indexed images (or only `rows`)."""
+        d = self.family_distances(query_descriptor, rows, state=state)
+        return combine_distances(d, w1, w2, w3, frame_weights, color_weights)
+
+    def results(self, rows, scores, state=None):
+        """Format indexed rows as search results."""
+        if state is None:
+            state = self._state
+        return [
+            {"filename": state.filenames[row], "score": float(score), "category": state.categories[row]}
+            for row, score in zip(rows, scores)
+        ]
+
+    def search(self, query_descriptor, top_n=5, w1=0.1, w2=0.8, w3=0.1,
+               frame_weights=(0.7, 0.3), color_weights=(0.4, 0.1, 0.5), categories=None):
+        """
+        Vectorized equivalent of simple_search over the resident index.
+
+        Parameters:
+            categories: Optional categories; only their partitions are scored.
+
+        Returns:
+            list: Top N similar images as dictionaries with 'filename', 'score' and 'category'.
+        """
+        state, rows, scores = self.search_rows(query_descriptor, top_n, w1=w1, w2=w2, w3=w3,
+                                               frame_weights=frame_weights, color_weights=color_weights,
+                                               categories=categories)
+        return self.results(rows, scores, state=state)
+
+    def search_rows(self, query_descriptor, top_n=5, w1=0.1, w2=0.8, w3=0.1,
+                    frame_weights=(0.7, 0.3), color_weights=(0.4, 0.1, 0.5), categories=None, state=None):
+        """
+        Exact top N rows for a query.
+
+        Returns:
+            tuple: (state, rows, scores) of the top N images.
+        """
+        if state is None:
+            state = self._state
+        partition = state.category_rows(categories)
+        with self.timer("score"):
+            scores = self.scores(query_descriptor, rows=partition, w1=w1, w2=w2, w3=w3,
+                                 frame_weights=frame_weights, color_weights=color_weights, state=state)
+        with self.timer("top_n"):
+            best = top_n_rows(scores, top_n)
+        rows = best if partition is None else partition[best]
+        return state, rows, scores[best]
+
+    def duplicate_rows(self, hashes, radius=DUPLICATE_RADIUS, categories=None, state=None):
+        """
+        Near duplicates of an image given its (phash, dhash).
+
+        Returns:
+            tuple: (state, rows, pHash distances, exact flags), closest first.
+        """
+        if state is None:
+            state = self._state
+        with self.timer("duplicates"):
+            rows, distances, exact = state.near_duplicates(hashes, radius)
+            partition = state.category_rows(categories)
+            if partition is not None:
+                keep = np.isin(rows, partition)
+                rows, distances, exact = rows[keep], distances[keep], exact[keep]
+        return state, rows, distances, exact
+
+    def exact_duplicate_rows(self, query_descriptor, categories=None, state=None, **weights):
+        """
+        Indexed exact duplicates of the query (equal pHash and dHash), scored exactly.
+
+        Only these rows are scored, so a search for an image that is already
+        stored can skip the full corpus pass.
+
+        Returns:
+            tuple: (state, rows, scores), empty when the query has no hash or no duplicate.
+        """
+        if state is None:
+            state = self._state
+        hashes = parse_hashes(query_descriptor.get(HASH_FIELD)) if isinstance(query_descriptor, dict) else None
+        if hashes is None:
+            return state, np.empty(0, dtype=np.int64), np.empty(0)
+        state, rows, _, exact = self.duplicate_rows(hashes, radius=0, categories=categories, state=state)
+        rows = rows[exact]
+        if not rows.size:
+            return state, rows, np.empty(0)
+        scores = self.scores(query_descriptor, rows=rows, state=state, **weights)
+        best = top_n_rows(scores, len(rows))
+        return state, rows[best], scores[best]
+
+    def cascade_rows(self, query_descriptor, top_n=5, cascade_k=None, w1=0.1, w2=0.8, w3=0.1,
+                     frame_weights=(0.7, 0.3), color_weights=(0.4, 0.1, 0.5), state=None, categories=None):
+        """
+        Two-stage search: the weighted distance over the compact families only
+        keeps the `cascade_k` best candidates, which are re-ranked with the
+        exact score. The color and edge histograms are only read for those.
+
+        Returns:
+            tuple: (state, rows, exact scores) of the top N images.
+        """
+        if state is None:
+            state = self._state
+        weights = dict(w1=w1, w2=w2, w3=w3, frame_weights=frame_weights, color_weights=color_weights)
+        partition = state.category_rows(categories)
+        size = len(state) if partition is None else len(partition)
+        cascade_k = max(cascade_k or CASCADE_K, top_n)
+        if cascade_k >= size:
+            scores = self.scores(query_descriptor, rows=partition, state=state, **weights)
+            best = top_n_rows(scores, top_n)
+            return state, best if partition is None else partition[best], scores[best]
+
+        coefficients = family_coefficients(**weights)
+        d = self.family_distances(query_descriptor, rows=partition, families=CASCADE_FAMILIES, state=state)
+        partial = sum(coefficients[name] * d[name] for name in CASCADE_FAMILIES)
+        # Sorted, so ties of the exact pass are broken by collection order like search()
+        candidates = np.sort(top_n_rows(partial, cascade_k))
+        if partition is not None:
+            candidates = partition[candidates]
+
+        scores = self.scores(query_descriptor, rows=candidates, state=state, **weights)
+        best = top_n_rows(scores, top_n)
+        return state, candidates[best], scores[best]
+
+    def cascade_search(self, query_descriptor, top_n=5, cascade_k=None, categories=None, **weights):
+        """Cascade equivalent of search(): compact-family prefilter, then exact rerank."""
+        with self.timer("cascade"):
+            state, rows, scores = self.cascade_rows(query_descriptor, top_n, cascade_k,
+                                                    categories=categories, **weights)
+        return self.results(rows, scores, state=state)
+
+    def search_batch(self, query_descriptors, top_n=5, w1=0.1, w2=0.8, w3=0.1,
+                     frame_weights=(0.7, 0.3), color_weights=(0.4, 0.1, 0.5)):
+        """
+        Score many queries against the index with matrix operations.
+
+        Per family, the Q x N squared distances are expanded as
+        ||a||^2 + ||b||^2 - 2ab, so the work is one BLAS matrix product per
+        family and row block. A running top N is kept per query.
+
+        Parameters:
+            query_descriptors (list): Descriptor dicts of the query images.
+
+        Returns:
+            list: One top N result list per query (None for unusable descriptors).
+        """
+        state = self._state
+        flats = [flatten_descriptor(q) for q in query_descriptors]
+        valid = [i for i, flat in enumerate(flats) if flat is not None]
+        output = [None] * len(flats)
+        if not valid or not len(state) or top_n <= 0:
+            for i in valid:
+                output[i] = []
+            return output
+
+        queries = {name: np.stack([flats[i][name] for i in valid]).astype(np.float64) for name in FAMILY_NAMES}
+        query_norms = {name: np.einsum("ij,ij->i", q, q) for name, q in queries.items()}
+        row_norms = state.squared_norms
+
+        n, nq = len(state), len(valid)
+        best_scores = np.empty((nq, 0))
+        best_rows = np.empty((nq, 0), dtype=np.int64)
+        for start in range(0, n, CHUNK_ROWS):
+            stop = min(start + CHUNK_ROWS, n)
+            d = {}
+            for name in FAMILY_NAMES:
+                block = state.matrices[name][start:stop].astype(np.float64)
+                d2 = query_norms[name][:, None] + row_norms[name][None, start:stop] - 2 * queries[name] @ block.T
+                d[name] = np.sqrt(np.maximum(d2, 0, out=d2), out=d2)
+            scores = combine_distances(d, w1, w2, w3, frame_weights, color_weights)
+
+            best_scores = np.hstack([best_scores, scores])
+            best_rows = np.hstack([best_rows, np.broadcast_to(np.arange(start, stop), scores.shape)])
+            if best_scores.shape[1] > top_n:
+                keep = np.argpartition(best_scores, top_n - 1, axis=1)[:, :top_n]
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+
+        order = np.lexsort((best_rows, best_scores), axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        for j, i in enumerate(valid):
+            output[i] = self.results(best_rows[j], best_scores[j], state=state)
+        return output
+
+    def stats(self):
+        return {
+            "size": len(self._state),
+            "version": self.version,
+            "source": "snapshot" if self.snapshot is not None else "mongodb",
+            "partitions": self.partition_sizes(),
+            "hashed": int(self._state.hashed.sum()),
+        }
+
+    def partition_sizes(self):
+        """Number of indexed images per category (uncategorized images under 'null')."""
+        return {("null" if category is None else str(category)): len(rows)
+                for category, rows in self._state.partitions.items()}
+
+
+def collapse_duplicate_rows(state, rows, scores, radius=DUPLICATE_RADIUS):
+    """
+    Fold ranked rows that are near duplicates of a better ranked row into it.
+
+    Rows without hashes are never folded.
+
+    Returns:
+        tuple: (kept rows, their scores, list of folded rows per kept row).
+    """
+    kept, folded = [], []
+    leaders = []  # (position in kept, pHash) of the kept rows that have hashes
+    for i, row in enumerate(rows):
+        if state.hashed[row] and leaders:
+            distances = hamming([phash for _, phash in leaders], state.hashes[row, 0])
+            within = np.flatnonzero(distances <= radius)
+            if within.size:
+                # Folded into the best ranked row it duplicates
+                folded[leaders[within[0]][0]].append(row)
+                continue
+        if state.hashed[row]:
+            leaders.append((len(kept), state.hashes[row, 0]))
+        kept.append(i)
+        folded.append([])
+    kept = np.array(kept, dtype=np.int64)
+    return rows[kept], scores[kept], folded
+
+
+def evaluate_recall(index, searchers, queries=50, top_k=10, seed=0, **weights):
+    """
+    Recall@k and latency of approximate searchers against the exhaustive ranking.
+
+    Queries are sampled from the indexed images themselves.
+
+    Parameters:
+        index (DescriptorIndex): Index providing the exact scores.
+        searchers (list): (config dict, fn(state, query descriptor, top_k) -> rows) pairs.
+        queries (int): Number of sampled query images.
+        top_k (int): Depth of the compared rankings.
+
+    Returns:
+        dict: Exact latency and, for every searcher, its config with recall and latency.
+    """
+    state = index.state
+    if len(state) == 0:
+        return {"queries": 0, "exact_ms": None, "configs": []}
+
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(state), min(queries, len(state)), replace=False)
+    query_descriptors = [{name: state.matrices[name][row] for name in FAMILY_NAMES} for row in sample]
+
+    start = time.perf_counter()
+    exact = []
+    for q in query_descriptors:
+        scores = index.scores(q, state=state, **weights)
+        exact.append(set(top_n_rows(scores, top_k).tolist()))
+    exact_ms = (time.perf_counter() - start) * 1000 / len(sample)
+
+    report = []
+    for config, search in searchers:
+        start = time.perf_counter()
+        hits = 0
+        for q, truth in zip(query_descriptors, exact):
+            rows = search(state, q, top_k)
+            hits += len(truth.intersection(np.asarray(rows).tolist()))
+        report.append({
+            **config,
+            f"recall@{top_k}": hits / (len(sample) * min(top_k, len(state))),
+            "latency_ms": (time.perf_counter() - start) * 1000 / len(sample),
+        })
+
+    return {"queries": len(sample), "exact_ms": exact_ms, "configs": report}
+
+
+def cascade_recall_report(index, cascade_ks, queries=50, top_k=10, seed=0, **weights):
+    """Recall@k and latency of the cascade mode for every candidate count in `cascade_ks`."""
+    def searcher(cascade_k):
+        return lambda state, q, k: index.cascade_rows(q, k, cascade_k, state=state, **weights)[1]
+
+    return evaluate_recall(index, [({"cascade_k": k}, searcher(k)) for k in cascade_ks],
+                           queries=queries, top_k=top_k, seed=seed, **weights)
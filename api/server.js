@@ -34,6 +34,8 @@ const imageSchema = new mongoose.Schema({
   filename: { type: String, required: true },
   category : {type : String },
   uploadDate: { type: Date, default: Date.now },
+  descriptor_version: { type: String }, // Descriptor mode of the images service that computed the characteristics
+  perceptual_hash: { phash: String, dhash: String }, // 64 bit hex hashes used for near-duplicate lookups
   characteristics: {
     color_histogram: [[Number]], // Array of arrays with numerical values for histogram bins
     dominant_colors: [[Number]], // Array of arrays with RGB values for dominant colors
@@ -110,7 +112,7 @@ app.post("/upload", upload.array("images"), async (req, res) => {
     }
 
     // Parse the JSON response from the ImagesService
-    const { results } = await response.json();
+    const { results, descriptor_version } = await response.json();
 
     // Store characteristics for each file
     const imageDocs = {};
@@ -119,12 +121,17 @@ app.post("/upload", upload.array("images"), async (req, res) => {
     });
 
     // Save all image metadata and characteristics to MongoDB
-    const mongoDocs = Object.entries(imageDocs).map(([filename, characteristics]) => ({
-      filename,
-      category : category,
-      characteristics: characteristics
-      
-    }));
+    const mongoDocs = Object.entries(imageDocs).map(([filename, result]) => {
+      // The perceptual hash is not a search descriptor, it gets its own field
+      const { perceptual_hash, ...characteristics } = result || {};
+      return {
+        filename,
+        category : category,
+        characteristics: characteristics,
+        descriptor_version: descriptor_version,
+        perceptual_hash: perceptual_hash
+      };
+    });
     try {
       const savedDocs = await Image.insertMany(mongoDocs);
       console.log("Documents successfully saved:", savedDocs);
@@ -0,0 +1,60 @@
+import os
+import sys
+
+import cv2
+import mongomock
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from descriptors import calculate_img_descriptors  # noqa: E402
+from ingest import image_update  # noqa: E402
+
+
+def synthetic_image(seed, side=96):
+    """Random rectangles and circles on a random background, different for every seed."""
+    rng = np.random.default_rng(seed)
+    image = np.full((side, side, 3), rng.integers(0, 256, 3), dtype=np.uint8)
+    for _ in range(6):
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        x, y = (int(v) for v in rng.integers(0, side, 2))
+        if rng.random() < 0.5:
+            cv2.rectangle(image, (x, y), (x + int(rng.integers(8, 40)), y + int(rng.integers(8, 40))), color, -1)
+        else:
+            cv2.circle(image, (x, y), int(rng.integers(4, 24)), color, -1)
+    return image
+
+
+@pytest.fixture(scope="session")
+def descriptors():
+    """Descriptors of 40 synthetic images."""
+    return [calculate_img_descriptors(synthetic_image(seed)) for seed in range(40)]
+
+
+@pytest.fixture
+def collection(descriptors):
+    """mongomock collection holding one document per synthetic image, in both storage formats."""
+    collection = mongomock.MongoClient().db.images
+    for i, descriptor in enumerate(descriptors):
+        collection.update_one({"filename": f"img_{i}.png"}, image_update(descriptor, f"category_{i % 3}"),
+                              upsert=True)
+    return collection
+
+
+@pytest.fixture(scope="session")
+def images_module():
+    """The Flask app module, bound to an in-memory collection."""
+    import pymongo
+
+    os.environ.setdefault("DATABASE_NAME", "test")
+    os.environ.setdefault("COLLECTION_NAME", "images")
+    os.environ["DESCRIPTOR_WORKERS"] = "1"
+    client_class = pymongo.MongoClient
+    pymongo.MongoClient = mongomock.MongoClient
+    try:
+        import images
+        images.create_app()
+    finally:
+        pymongo.MongoClient = client_class
+    return images
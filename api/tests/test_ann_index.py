@@ -0,0 +1,59 @@
+from ann_index import AnnIndex
+from search_index import DescriptorIndex
+
+
+def test_exact_results_until_trained_then_approximate(collection, descriptors):
+    index = DescriptorIndex(collection)
+    index.refresh(force=True)
+    ann = AnnIndex(index, nlist=4, nprobe=4, rerank=40)
+
+    query = descriptors[0]
+    # The first query starts the background build and is answered exactly meanwhile
+    assert ann.search(query, top_n=5) == index.search(query, top_n=5)
+
+    trained = ann.sync(wait=True)
+    assert ann.ready and trained.state is index.state
+    assert ann.stats()["size"] == len(descriptors)
+    # Probing every list and reranking the whole corpus is exact
+    assert ann.search(query, top_n=5) == index.search(query, top_n=5)
+    assert {r["category"] for r in ann.search(query, top_n=10, categories=("category_2",))} == {"category_2"}
+
+
+def test_rebuilds_after_refresh(collection, descriptors):
+    index = DescriptorIndex(collection, refresh_interval=0)
+    index.refresh()
+    ann = AnnIndex(index, nlist=4)
+    first = ann.sync(wait=True)
+
+    collection.delete_one({"filename": "img_0.png"})
+    index.refresh()
+    assert not ann.ready
+    second = ann.sync(wait=True)
+    assert second is not first and second.state is index.state
+    assert len(second.codes) == len(descriptors) - 1
+
+
+def test_failed_build_is_reported_and_retried_later(collection, descriptors, monkeypatch, caplog):
+    index = DescriptorIndex(collection)
+    index.refresh(force=True)
+    ann = AnnIndex(index, nlist=4, retry_interval=3600)
+    calls = []
+
+    def failing_build(*args):
+        calls.append(args)
+        raise MemoryError("out of memory")
+
+    monkeypatch.setattr(ann, "build", failing_build)
+    assert ann.sync(wait=True) is None
+    assert ann.search(descriptors[0], top_n=5) == index.search(descriptors[0], top_n=5)
+    ann.sync(wait=True)
+    # One attempt until the retry interval elapsed, queries are answered exactly meanwhile
+    assert len(calls) == 1
+    stats = ann.stats()
+    assert (stats["failures"], stats["last_error"], stats["building"]) == (1, "MemoryError: out of memory", False)
+    assert "IVF-PQ build failed" in caplog.text
+
+    monkeypatch.undo()
+    ann._retry_at = 0.0
+    assert ann.sync(wait=True).state is index.state
+    assert ann.stats()["last_error"] is None and ann.stats()["failures"] == 1
@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from search_index import DescriptorIndex
+
+
+@pytest.fixture
+def client(images_module, collection, monkeypatch):
+    monkeypatch.setattr(images_module, "search_index", DescriptorIndex(collection, refresh_interval=0))
+    return images_module.app.test_client()
+
+
+def test_batch_search_descriptors(client, descriptors):
+    response = client.post("/search/batch", json={"descriptors": [descriptors[3], {"bogus": 1}], "top_n": 2})
+    assert response.status_code == 200
+    first, second = response.json["results"]
+    assert first["query"] == 0 and first["results"][0]["filename"] == "img_3.png"
+    assert len(first["results"]) == 2
+    assert second == {"query": 1, "error": "Invalid descriptors"}
+
+
+def test_batch_search_form_descriptors(client, descriptors):
+    response = client.post("/search/batch", data={"descriptors": json.dumps([descriptors[7]]), "top_n": "1"})
+    assert response.status_code == 200
+    assert [r["filename"] for r in response.json["results"][0]["results"]] == ["img_7.png"]
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"json": {"descriptors": []}},
+    {"json": {"descriptors": {"a": 1}}},
+    {"json": {"descriptors": [{}], "top_n": "x"}},
+    {"json": {"descriptors": [{}], "top_n": 0}},
+    {"json": {"descriptors": [{}], "top_n": [1]}},
+    {"data": {"descriptors": "not json"}},
+    {"data": {"descriptors": "[]"}},
+    {"data": {"descriptors": "[{}]", "top_n": "x"}},
+    {"json": {}},
+    {"json": [1, 2]},
+])
+def test_batch_search_rejects_invalid_requests(client, kwargs):
+    response = client.post("/search/batch", **kwargs)
+    assert response.status_code == 400
+    assert "error" in response.json
@@ -0,0 +1,74 @@
+import io
+import json
+import os
+import signal
+import subprocess
+import sys
+
+import cv2
+import pytest
+
+from conftest import synthetic_image
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def upload(seed):
+    return io.BytesIO(cv2.imencode(".png", synthetic_image(seed))[1].tobytes()), f"img_{seed}.png"
+
+
+@pytest.fixture
+def pool_images(images_module, monkeypatch):
+    """The app module with a 2-worker descriptor pool."""
+    monkeypatch.setattr(images_module, "DESCRIPTOR_WORKERS", 2)
+    yield images_module
+    pool = images_module._descriptor_pool
+    if pool is not None:
+        images_module.reset_descriptor_pool(pool)
+
+
+def sequential(images_module, seeds):
+    """Results of the in-process path, as they come out of a JSON response."""
+    return {f"img_{seed}.png": json.loads(json.dumps(
+        images_module.describe_image_bytes(f"img_{seed}.png", upload(seed)[0].getvalue())[1])) for seed in seeds}
+
+
+def test_pool_results_match_sequential(pool_images):
+    client = pool_images.app.test_client()
+    response = client.post("/calculate-descriptors", data={"images": [upload(seed) for seed in range(4)]})
+    assert response.status_code == 200
+    assert list(response.json["results"]) == [f"img_{seed}.png" for seed in range(4)]
+    assert response.json["results"] == sequential(pool_images, range(4))
+
+
+def test_pool_streams_ndjson(pool_images):
+    client = pool_images.app.test_client()
+    response = client.post("/calculate-descriptors", data={
+        "images": [upload(seed) for seed in range(3)] + [(io.BytesIO(b"junk"), "junk.png")], "stream": "1",
+    })
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    results = {line["filename"]: line["result"] for line in lines}
+    assert results.pop("junk.png") == {"error": "Invalid image format"}
+    assert results == sequential(pool_images, range(3))
+
+
+def test_broken_pool_is_replaced(pool_images):
+    payloads = [(f"img_{seed}.png", upload(seed)[0].getvalue()) for seed in range(3)]
+    list(pool_images.describe_images(payloads))
+    pool = pool_images.get_descriptor_pool()
+    for pid in list(pool._processes):
+        os.kill(pid, signal.SIGKILL)
+
+    results = dict(pool_images.describe_images(payloads))
+    assert sorted(results) == sorted(filename for filename, _ in payloads)
+    assert not any("error" in result for result in results.values())
+    assert pool_images.get_descriptor_pool() is not pool
+
+
+def test_import_has_no_side_effects():
+    # Pool workers re-import the app module as their __main__: it must not connect or start threads
+    code = "import threading, images; print(images.client is None, threading.active_count())"
+    output = subprocess.run([sys.executable, "-c", code], cwd=API_DIR, capture_output=True, text=True,
+                            env=dict(os.environ, DATABASE_NAME="test", COLLECTION_NAME="images"), check=True)
+    assert output.stdout.split() == ["True", "1"]
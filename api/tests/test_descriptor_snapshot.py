@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from descriptor_snapshot import (
+    DescriptorSnapshot, append_snapshot, compact_snapshot, export_snapshot, write_snapshot
+)
+from ingest import image_update
+from search_index import FAMILY_NAMES, DescriptorIndex, IndexState
+
+
+def indexed_state(collection):
+    index = DescriptorIndex(collection)
+    index.refresh(force=True)
+    return index.state
+
+
+def assert_same_state(state, expected):
+    assert [str(key) for key in state.keys] == [str(key) for key in expected.keys]
+    assert state.filenames.tolist() == expected.filenames.tolist()
+    assert state.categories.tolist() == expected.categories.tolist()
+    np.testing.assert_array_equal(state.hashes, expected.hashes)
+    np.testing.assert_array_equal(state.hashed, expected.hashed)
+    for name in FAMILY_NAMES:
+        np.testing.assert_array_equal(state.matrices[name], expected.matrices[name])
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "descriptors.snapshot")
+
+
+def test_write_round_trip(collection, path):
+    expected = indexed_state(collection)
+    write_snapshot(path, expected)
+
+    state = DescriptorSnapshot(path).to_state()
+    assert_same_state(state, expected)
+    assert all(isinstance(state.matrices[name], np.memmap) for name in FAMILY_NAMES)
+
+
+def test_empty_round_trip(path):
+    write_snapshot(path, IndexState.empty())
+    assert len(DescriptorSnapshot(path).to_state()) == 0
+
+
+def test_append_round_trip(collection, descriptors, path):
+    export_snapshot(path, collection)
+    snapshot = DescriptorSnapshot(path)
+
+    for i in range(3):
+        collection.update_one({"filename": f"new_{i}.png"}, image_update(descriptors[i], "category_new"), upsert=True)
+    assert append_snapshot(path, collection) == {"appended": 3, "deleted": 0, "updated": 0, "compacted": False}
+
+    assert snapshot.changed()
+    snapshot.open()
+    assert_same_state(snapshot.to_state(), indexed_state(collection))
+
+
+def test_append_compacts_deletions(collection, path):
+    export_snapshot(path, collection)
+    collection.delete_many({"filename": {"$in": ["img_0.png", "img_5.png"]}})
+
+    assert append_snapshot(path, collection)["compacted"]
+    state = DescriptorSnapshot(path).to_state()
+    # Served straight from the mapping: no tombstones were left behind
+    assert all(isinstance(state.matrices[name], np.memmap) for name in FAMILY_NAMES)
+    assert_same_state(state, indexed_state(collection))
+
+
+def test_append_refreshes_documents_updated_in_place(collection, descriptors, path):
+    export_snapshot(path, collection)
+    assert append_snapshot(path, collection)["updated"] == 0
+
+    # Re-ingesting a file rewrites its descriptors and bumps its UPDATED_FIELD
+    collection.update_one({"filename": "img_2.png"}, image_update(descriptors[9], "category_2"))
+    result = append_snapshot(path, collection)
+    assert result["updated"] == 1 and result["compacted"]
+
+    index = DescriptorIndex(collection, snapshot=DescriptorSnapshot(path))
+    index.refresh(force=True)
+    assert {r["filename"] for r in index.search(descriptors[9], top_n=2)} == {"img_2.png", "img_9.png"}
+    assert append_snapshot(path, collection)["updated"] == 0
+
+
+def test_append_beyond_capacity_compacts(collection, descriptors, path):
+    write_snapshot(path, indexed_state(collection), capacity=len(descriptors))
+    collection.update_one({"filename": "extra.png"}, image_update(descriptors[0], "category_0"), upsert=True)
+
+    assert append_snapshot(path, collection)["compacted"]
+    assert_same_state(DescriptorSnapshot(path).to_state(), indexed_state(collection))
+
+
+def test_compact_round_trip(collection, path):
+    export_snapshot(path, collection)
+    compact_snapshot(path)
+    assert_same_state(DescriptorSnapshot(path).to_state(), indexed_state(collection))
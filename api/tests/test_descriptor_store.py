@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from descriptor_store import PACKED_FIELD, pack_descriptors, read_descriptors, unpack_descriptors
+from perceptual_hash import split_hashes
+
+
+def numeric(descriptor):
+    return split_hashes(descriptor)[0]
+
+
+def test_float32_round_trip(descriptors):
+    descriptor = numeric(descriptors[0])
+    unpacked = unpack_descriptors(pack_descriptors(descriptor))
+
+    assert list(unpacked) == list(descriptor)
+    for name, values in descriptor.items():
+        expected = np.asarray(values, dtype=np.float64)
+        assert unpacked[name].dtype == np.float32
+        assert unpacked[name].shape == expected.shape
+        np.testing.assert_allclose(unpacked[name], expected, rtol=1e-6)
+
+
+def test_float16_round_trip():
+    descriptor = {"hu_moments": [0.25, -1.5, 3.0], "dominant_colors": [[1, 2, 3], [250, 128, 0]], "empty": []}
+    unpacked = unpack_descriptors(pack_descriptors(descriptor, "float16"))
+
+    assert unpacked["hu_moments"].dtype == np.float16
+    assert unpacked["dominant_colors"].shape == (2, 3)
+    assert unpacked["empty"].shape == (0,)
+    np.testing.assert_array_equal(unpacked["dominant_colors"], descriptor["dominant_colors"])
+
+
+def test_float16_overflow_is_rejected():
+    with pytest.raises(ValueError):
+        pack_descriptors({"color_histogram": [1e6]}, "float16")
+
+
+def test_unpacked_arrays_are_read_only(descriptors):
+    unpacked = unpack_descriptors(pack_descriptors(numeric(descriptors[0])))
+    with pytest.raises(ValueError):
+        unpacked["texture_descriptors"][0] = 1
+
+
+@pytest.mark.parametrize("blob", [b"XXXX" + bytes(12), b"IDSC\x09\x01\x00\x00" + bytes(8)])
+def test_invalid_blobs_are_rejected(blob):
+    with pytest.raises(ValueError):
+        unpack_descriptors(blob)
+
+
+def test_read_descriptors_prefers_packed_field():
+    packed = {"texture_descriptors": [1.0, 2.0]}
+    doc = {PACKED_FIELD: pack_descriptors(packed), "characteristics": {"texture_descriptors": [9.0, 9.0]}}
+    np.testing.assert_array_equal(read_descriptors(doc)["texture_descriptors"], [1.0, 2.0])
+    assert read_descriptors({"characteristics": packed}) is packed
+    assert read_descriptors({}) is None
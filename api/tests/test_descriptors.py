@@ -0,0 +1,189 @@
+import contextlib
+import itertools
+
+import cv2
+import numpy as np
+import pytest
+
+import descriptors
+from conftest import synthetic_image
+from descriptors import (
+    DESCRIPTOR_STAGES, DOMINANT_COLOR_TIERS, NATIVE_DESCRIPTOR_VERSION, DescriptorMode,
+    DescriptorPipeline, _matched_color_errors, calculate_dominant_colors, calculate_img_descriptors
+)
+from perceptual_hash import HASH_FIELD, image_hashes
+
+IMAGES = {
+    "synthetic": synthetic_image(0),
+    "noise": (np.random.default_rng(0).random((60, 80, 3)) * 255).astype(np.uint8),
+    "solid": np.full((50, 50, 3), (10, 200, 30), dtype=np.uint8),
+    "two_colors": np.dstack([np.repeat([[0], [255]], 20, axis=0).repeat(20, axis=1)] * 3).astype(np.uint8),
+    "tiny": np.array([[[0, 0, 255], [0, 255, 0]]], dtype=np.uint8),
+}
+
+
+@pytest.mark.parametrize("tier", DOMINANT_COLOR_TIERS)
+@pytest.mark.parametrize("name", IMAGES)
+@pytest.mark.parametrize("k", [1, 5, 8])
+def test_every_tier_returns_k_colors(tier, name, k):
+    colors = calculate_dominant_colors(IMAGES[name], k=k, tier=tier)
+    assert np.asarray(colors).shape == (k, 3)
+    assert np.asarray(colors).min() >= 0 and np.asarray(colors).max() <= 255
+
+
+@pytest.mark.parametrize("tier", DOMINANT_COLOR_TIERS)
+@pytest.mark.parametrize("name", ["synthetic", "noise"])
+def test_every_tier_is_deterministic(tier, name):
+    first = calculate_dominant_colors(IMAGES[name], k=5, tier=tier)
+    assert all(calculate_dominant_colors(IMAGES[name], k=5, tier=tier) == first for _ in range(3))
+
+
+@pytest.mark.parametrize("tier", DOMINANT_COLOR_TIERS)
+def test_solid_image_repeats_its_color(tier):
+    # BGR (10, 200, 30) is RGB (30, 200, 10)
+    assert calculate_dominant_colors(IMAGES["solid"], k=5, tier=tier) == [[30, 200, 10]] * 5
+
+
+def test_matched_color_errors_finds_the_best_permutation():
+    rng = np.random.default_rng(1)
+    reference, colors = rng.random((6, 3)) * 255, rng.random((6, 3)) * 255
+    d = np.sqrt(((reference[:, None] - colors[None]) ** 2).sum(axis=2))
+    best = min(itertools.permutations(range(6)), key=lambda p: d[np.arange(6), p].sum())
+    assert _matched_color_errors(reference, colors).sum() == pytest.approx(d[np.arange(6), best].sum())
+
+
+@pytest.mark.parametrize("mode, version", [
+    (DescriptorMode(dominant_colors_tier="exact"), NATIVE_DESCRIPTOR_VERSION),
+    (DescriptorMode(dominant_colors_tier="high"), "2-native-chigh"),
+    (DescriptorMode(512, dominant_colors_tier="exact"), "2-s512"),
+    (DescriptorMode(normalize_histograms=True, dominant_colors_tier="exact"), "2-native-n"),
+    (DescriptorMode(512, True, "fast"), "2-s512-n-cfast"),
+])
+def test_mode_version(mode, version):
+    assert mode.version == version
+
+
+def test_every_tier_has_its_own_version():
+    versions = {DescriptorMode(512, dominant_colors_tier=tier).version for tier in DOMINANT_COLOR_TIERS}
+    assert len(versions) == len(DOMINANT_COLOR_TIERS)
+
+
+def test_unknown_tier_is_rejected():
+    with pytest.raises(ValueError):
+        DescriptorMode(dominant_colors_tier="best")
+
+
+def test_mode_from_env(monkeypatch):
+    monkeypatch.setenv("DESCRIPTOR_MAX_SIDE", "256")
+    monkeypatch.setenv("DESCRIPTOR_NORMALIZE", "true")
+    monkeypatch.setattr(descriptors, "DOMINANT_COLORS_TIER", "balanced")
+    mode = DescriptorMode.from_env()
+    assert (mode.max_side, mode.normalize_histograms, mode.dominant_colors_tier) == (256, True, "balanced")
+
+
+@pytest.mark.parametrize("tier", DOMINANT_COLOR_TIERS)
+def test_mode_tier_reaches_the_pipeline(tier):
+    image = synthetic_image(3)
+    descriptor = calculate_img_descriptors(image, ["dominant_colors"], mode=DescriptorMode(dominant_colors_tier=tier))
+    assert descriptor["dominant_colors"] == calculate_dominant_colors(image, k=5, tier=tier)
+
+
+def large_jpeg(width=1600, height=1200):
+    image = cv2.resize(synthetic_image(5), (width, height), interpolation=cv2.INTER_LINEAR)
+    return cv2.imencode(".jpg", image)[1].tobytes()
+
+
+@pytest.fixture
+def decode_flags(monkeypatch):
+    """Flags cv2.imdecode is called with."""
+    flags, imdecode = [], cv2.imdecode
+
+    def recording_imdecode(buf, flag):
+        flags.append(flag)
+        return imdecode(buf, flag)
+
+    monkeypatch.setattr(cv2, "imdecode", recording_imdecode)
+    return flags
+
+
+@pytest.mark.parametrize("max_side, flag", [
+    (200, cv2.IMREAD_REDUCED_COLOR_8),
+    (300, cv2.IMREAD_REDUCED_COLOR_4),
+    (800, cv2.IMREAD_REDUCED_COLOR_2),
+    (1000, cv2.IMREAD_COLOR),
+])
+def test_large_jpeg_is_decoded_reduced(decode_flags, max_side, flag):
+    image = DescriptorMode(max_side).decode(large_jpeg())
+    assert decode_flags == [flag]
+    assert max(image.shape[:2]) == max_side
+
+
+def test_reduced_decoding_matches_full_decoding():
+    data, mode = large_jpeg(), DescriptorMode(200)
+    full = mode.prepare(cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR))
+    reduced = mode.decode(data)
+    assert reduced.shape == full.shape
+    assert np.abs(reduced.astype(int) - full.astype(int)).mean() < 8
+
+
+def test_png_and_native_mode_decode_full_size(decode_flags):
+    png = cv2.imencode(".png", synthetic_image(5, side=400))[1].tobytes()
+    assert max(DescriptorMode(100).decode(png).shape[:2]) == 100
+    assert DescriptorMode().decode(large_jpeg()).shape[:2] == (1200, 1600)
+    assert decode_flags == [cv2.IMREAD_COLOR, cv2.IMREAD_COLOR]
+
+
+def test_invalid_bytes_decode_to_none():
+    assert DescriptorMode(100).decode(b"\xff\xd8 not a jpeg") is None
+    assert DescriptorMode().decode(b"junk") is None
+
+
+def unshared_descriptors(image):
+    """The descriptors computed one function at a time, before the stage pipeline shared intermediates."""
+    histogram = [cv2.calcHist([image], [i], None, [256], [0, 256]).flatten().tolist() for i in range(3)]
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    texture = []
+    for theta in [0, np.pi / 4, np.pi / 2, 3 * np.pi / 4]:
+        kernel = cv2.getGaborKernel((21, 21), 5.0, theta, 10.0, 0.5, 0, ktype=cv2.CV_32F)
+        texture.append(np.mean(cv2.filter2D(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), cv2.CV_8UC3, kernel)))
+    contours, _ = cv2.findContours(gray, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    hu_moments = cv2.HuMoments(cv2.moments(max(contours, key=cv2.contourArea))).flatten().tolist() if contours else []
+    edges = cv2.Canny(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), 100, 200)
+    return {
+        "color_histogram": histogram,
+        "dominant_colors": calculate_dominant_colors(image, k=5),
+        "texture_descriptors": texture,
+        "hu_moments": hu_moments,
+        "average_color": list(map(int, cv2.mean(image)[:3])),
+        "edge_histogram": cv2.calcHist([edges], [0], None, [256], [0, 256]).flatten().tolist(),
+        HASH_FIELD: image_hashes(gray),
+    }
+
+
+@pytest.mark.parametrize("name", ["synthetic", "noise", "solid", "tiny"])
+def test_pipeline_output_is_unchanged(name):
+    descriptor = calculate_img_descriptors(IMAGES[name], mode=DescriptorMode())
+    assert list(descriptor) == list(DESCRIPTOR_STAGES)
+    assert descriptor == unshared_descriptors(IMAGES[name])
+
+
+def test_stage_subsets_match_the_full_output():
+    image = IMAGES["synthetic"]
+    full = calculate_img_descriptors(image, mode=DescriptorMode())
+    for stages in (["edge_histogram"], ["hu_moments", "color_histogram"], []):
+        subset = calculate_img_descriptors(image, stages, mode=DescriptorMode())
+        assert subset == {name: full[name] for name in DESCRIPTOR_STAGES if name in stages}
+    with pytest.raises(ValueError):
+        DescriptorPipeline(["sift"])
+
+
+def test_pipeline_times_every_stage():
+    timed = []
+
+    @contextlib.contextmanager
+    def timer(stage):
+        timed.append(stage)
+        yield
+
+    calculate_img_descriptors(IMAGES["synthetic"], timer=timer, mode=DescriptorMode())
+    assert timed == list(DESCRIPTOR_STAGES)
@@ -0,0 +1,106 @@
+import io
+import json
+
+import cv2
+import numpy as np
+import pytest
+
+from conftest import synthetic_image
+from feedback import feedback_weights, resolve_norms
+from ingest import image_update
+from search_index import DescriptorIndex
+
+WEIGHTS = (0.1, 0.8, 0.1, (0.7, 0.3), (0.4, 0.1, 0.5))
+
+
+def legacy_query_point_movement(w1, w2, w3, frame_weights, color_weights, relevant, irrelevant,
+                                alpha=1, beta=0.001, gamma=0.001):
+    """The weight update computed from whole image documents, as the search endpoint first did it."""
+    def mean(docs, fn):
+        return sum(fn(d["characteristics"]) for d in docs) / len(docs)
+
+    def norm(name):
+        return lambda c: np.linalg.norm(np.ravel(c[name]))
+
+    def frame(c):
+        return frame_weights[0] * norm("hu_moments")(c) + frame_weights[1] * norm("edge_histogram")(c)
+
+    def color(c):
+        return (color_weights[0] * norm("color_histogram")(c) + color_weights[1] * norm("average_color")(c)
+                + color_weights[2] * norm("dominant_colors")(c))
+
+    def move(weight, fn):
+        return alpha * weight + beta * mean(relevant, fn) - gamma * mean(irrelevant, fn)
+
+    return (
+        move(w1, frame), move(w2, color), move(w3, norm("texture_descriptors")),
+        (move(frame_weights[0], norm("hu_moments")), move(frame_weights[1], norm("edge_histogram"))),
+        (move(color_weights[0], norm("color_histogram")), move(color_weights[1], norm("average_color")),
+         move(color_weights[2], norm("dominant_colors"))),
+    )
+
+
+def assert_same_weights(weights, expected):
+    # Indexed descriptors are float32
+    np.testing.assert_allclose(np.hstack([np.ravel(w) for w in weights]),
+                               np.hstack([np.ravel(w) for w in expected]), rtol=1e-6)
+
+
+def documents(collection, filenames):
+    return [collection.find_one({"filename": filename}, {"filename": 1, "characteristics": 1})
+            for filename in filenames]
+
+
+RELEVANT = ["img_1.png", "img_4.png", "img_9.png"]
+IRRELEVANT = ["img_2.png", "img_30.png"]
+
+
+def test_query_point_movement2_matches_the_legacy_update(images_module, collection):
+    relevant, irrelevant = documents(collection, RELEVANT), documents(collection, IRRELEVANT)
+    assert_same_weights(images_module.query_point_movement2(*WEIGHTS, relevant, irrelevant),
+                        legacy_query_point_movement(*WEIGHTS, relevant, irrelevant))
+
+
+def test_resolved_norms_match_the_legacy_update(collection, descriptors):
+    index = DescriptorIndex(collection)
+    index.refresh(force=True)
+    # Images missing from the resident index are fetched from the collection
+    collection.update_one({"filename": "late.png"}, image_update(descriptors[17], "category_0"), upsert=True)
+    late_id = collection.find_one({"filename": "late.png"})["_id"]
+
+    relevant_refs = ["img_1.png", {"filename": "img_4.png"}, str(collection.find_one({"filename": "img_9.png"})["_id"]),
+                     {"_id": {"$oid": str(late_id)}}]
+    irrelevant_refs = documents(collection, ["img_2.png"]) + ["img_30.png"]
+    relevant_norms, unresolved = resolve_norms(index, collection, relevant_refs)
+    assert unresolved == []
+    irrelevant_norms, unresolved = resolve_norms(index, collection, irrelevant_refs)
+    assert unresolved == []
+
+    expected = legacy_query_point_movement(*WEIGHTS, documents(collection, RELEVANT + ["late.png"]),
+                                           documents(collection, IRRELEVANT))
+    assert_same_weights(feedback_weights(*WEIGHTS, relevant_norms, irrelevant_norms), expected)
+
+
+def test_unknown_references_are_unresolved(collection):
+    index = DescriptorIndex(collection)
+    index.refresh(force=True)
+    norms, unresolved = resolve_norms(index, collection, ["img_1.png", "missing.png", {"filename": "gone.png"}])
+    assert len(norms) == 1
+    assert unresolved == ["missing.png", {"filename": "gone.png"}]
+    with pytest.raises(ValueError):
+        resolve_norms(index, collection, [42])
+
+
+def test_search_rejects_feedback_on_unknown_images(images_module, collection, monkeypatch):
+    monkeypatch.setattr(images_module, "search_index", DescriptorIndex(collection, refresh_interval=0))
+    session = "feedback-404-test"
+    before = images_module.load_weights(session)
+    data = cv2.imencode(".png", synthetic_image(100))[1].tobytes()
+    response = images_module.app.test_client().post("/search", data={
+        "image": (io.BytesIO(data), "query.png"),
+        "session": session,
+        "characteristics": json.dumps({"relevant": ["img_1.png", "missing.png"], "irrelevant": [{"filename": "gone.png"}]}),
+    })
+    assert response.status_code == 404
+    assert response.json["unresolved"] == {"relevant": ["missing.png"], "irrelevant": ["gone.png"]}
+    assert images_module.load_weights(session) == before
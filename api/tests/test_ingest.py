@@ -0,0 +1,102 @@
+import json
+import os
+
+import cv2
+import mongomock
+import pytest
+
+from conftest import synthetic_image
+from descriptor_store import read_descriptors
+from ingest import category_of, ingest, read_checkpoint, stored_filename
+
+IMAGES = ["cats/a.png", "cats/b.png", "dogs/c.png", "dogs/puppies/d.png", "e.png"]
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """Image tree with two categories, a nested folder, an uncategorized image and a broken one."""
+    root = tmp_path / "images"
+    for seed, relpath in enumerate(IMAGES):
+        path = root / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        cv2.imwrite(str(path), synthetic_image(seed, side=48))
+    (root / "dogs" / "broken.jpg").write_bytes(b"not an image")
+    (root / "dogs" / "notes.txt").write_text("skipped")
+    return root
+
+
+class FailingCollection:
+    """Collection whose bulk_write fails after `batches` successful calls, like a crash mid-run."""
+
+    def __init__(self, collection, batches):
+        self.collection = collection
+        self.batches = batches
+
+    def bulk_write(self, ops, ordered=True):
+        if self.batches == 0:
+            raise RuntimeError("interrupted")
+        self.batches -= 1
+        return self.collection.bulk_write(ops, ordered=ordered)
+
+
+def stored(collection):
+    return {doc["filename"]: doc for doc in collection.find()}
+
+
+def test_stored_filename_and_category():
+    assert stored_filename(os.path.join("cats", "a.png")) == "cats__a.png"
+    assert category_of(os.path.join("dogs", "puppies", "d.png")) == "dogs"
+    assert category_of("e.png") is None and category_of("e.png", "misc") == "misc"
+
+
+def test_ingest_tree(tree, tmp_path):
+    collection = mongomock.MongoClient().db.images
+    checkpoint = tmp_path / "run.ingest-checkpoint"
+    stats = ingest(collection, str(tree), str(checkpoint), workers=1, batch_size=2, default_category="misc",
+                   copy_to=str(tmp_path / "copies"), report_interval=3600)
+    assert (stats["written"], stats["failed"], stats["skipped"]) == (5, 1, 0)
+
+    docs = stored(collection)
+    assert {name: doc["category"] for name, doc in docs.items()} == {
+        "cats__a.png": "cats", "cats__b.png": "cats", "dogs__c.png": "dogs",
+        "dogs__puppies__d.png": "dogs", "e.png": "misc",
+    }
+    assert all(read_descriptors(doc) is not None for doc in docs.values())
+    assert sorted(os.listdir(tmp_path / "copies")) == sorted(docs)
+    assert read_checkpoint(str(checkpoint)) == {
+        **{os.path.join(*p.split("/")): "ok" for p in IMAGES}, os.path.join("dogs", "broken.jpg"): "error",
+    }
+
+
+def test_interrupted_ingest_resumes(tree, tmp_path):
+    collection = mongomock.MongoClient().db.images
+    checkpoint = str(tmp_path / "run.ingest-checkpoint")
+    with pytest.raises(RuntimeError):
+        ingest(FailingCollection(collection, batches=1), str(tree), checkpoint, workers=1, batch_size=2,
+               report_interval=3600)
+    # Only the stored batch is checkpointed
+    assert len(read_checkpoint(checkpoint)) == 2 and len(stored(collection)) == 2
+    with open(checkpoint, "a", encoding="utf-8") as f:
+        f.write('{"path": "torn')
+
+    stats = ingest(collection, str(tree), checkpoint, workers=1, batch_size=2, report_interval=3600)
+    assert (stats["written"], stats["failed"], stats["skipped"]) == (3, 1, 2)
+    assert len(stored(collection)) == 5
+
+    # Nothing left to do, unless failed images are retried
+    stats = ingest(collection, str(tree), checkpoint, workers=1, report_interval=3600)
+    assert (stats["written"], stats["failed"], stats["skipped"]) == (0, 0, 6)
+    cv2.imwrite(str(tree / "dogs" / "broken.jpg"), synthetic_image(9, side=48))
+    stats = ingest(collection, str(tree), checkpoint, workers=1, retry_failed=True, report_interval=3600)
+    assert (stats["written"], stats["failed"], stats["skipped"]) == (1, 0, 5)
+    assert stored(collection)["dogs__broken.jpg"]["category"] == "dogs"
+    assert json.loads(open(checkpoint, encoding="utf-8").read().splitlines()[-1])["status"] == "ok"
+
+
+def test_parallel_ingest_matches_sequential(tree, tmp_path):
+    sequential, parallel = mongomock.MongoClient().db.a, mongomock.MongoClient().db.b
+    ingest(sequential, str(tree), str(tmp_path / "a"), workers=1, report_interval=3600)
+    stats = ingest(parallel, str(tree), str(tmp_path / "b"), workers=2, batch_size=2, report_interval=3600)
+    assert (stats["written"], stats["failed"]) == (5, 1)
+    assert {name: doc["characteristics"] for name, doc in stored(parallel).items()} == \
+           {name: doc["characteristics"] for name, doc in stored(sequential).items()}
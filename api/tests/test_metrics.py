@@ -0,0 +1,86 @@
+import io
+import re
+
+import cv2
+import numpy as np
+import pytest
+
+from conftest import synthetic_image
+from descriptors import DESCRIPTOR_STAGES
+from metrics import Metrics, StageHistogram
+from query_cache import QueryCache
+from search_index import DescriptorIndex
+
+
+def test_histogram_quantiles():
+    histogram = StageHistogram()
+    values = np.random.default_rng(0).uniform(0.001, 0.1, 5000)
+    for value in values:
+        histogram.observe(value)
+    assert histogram.count == len(values) and histogram.sum == pytest.approx(values.sum())
+    for q in (0.5, 0.95, 0.99):
+        # 10 buckets per decade: estimates fall within one bucket width
+        assert histogram.quantile(q) == pytest.approx(np.quantile(values, q), rel=0.26)
+    assert histogram.quantile(1.0) <= histogram.max
+    assert StageHistogram().quantile(0.5) == 0.0
+
+
+def test_request_timings_and_exposition():
+    metrics = Metrics()
+    metrics.begin_request()
+    with metrics.time("decode"):
+        pass
+    metrics.observe("search exact", 0.0125)
+    metrics.inc("requests_total", (("endpoint", "/search"), ("status", 200)))
+    metrics.gauge("corpus_size", lambda: 42)
+    timings = metrics.end_request()
+    assert [stage for stage, _ in timings] == ["decode", "search exact"]
+    assert Metrics.server_timing(timings[1:]) == "search_exact;dur=12.50"
+
+    text = metrics.render_prometheus()
+    assert 'image_service_stage_seconds{stage="decode",quantile="0.99"}' in text
+    assert 'image_service_stage_seconds_count{stage="search exact"} 1' in text
+    assert 'image_service_requests_total{endpoint="/search",status="200"} 1' in text
+    assert "image_service_corpus_size 42" in text
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics(enabled=False)
+    metrics.begin_request()
+    with metrics.time("decode"):
+        pass
+    metrics.inc("requests_total")
+    assert metrics.time("decode") is metrics.time("search")
+    assert metrics.end_request() == [] and metrics.stages == {} and metrics.counters == {}
+
+
+@pytest.fixture
+def client(images_module, collection, monkeypatch):
+    monkeypatch.setattr(images_module, "search_index", DescriptorIndex(collection, refresh_interval=0))
+    monkeypatch.setattr(images_module, "query_cache", QueryCache(2 ** 24))
+    return images_module.app.test_client()
+
+
+def server_timing(response):
+    return dict(re.findall(r"([\w.:/-]+);dur=([\d.]+)", response.headers["Server-Timing"]))
+
+
+def test_search_reports_its_stages(client):
+    data = cv2.imencode(".png", synthetic_image(100))[1].tobytes()
+    response = client.post("/search", data={"image": (io.BytesIO(data), "query.png")})
+    assert response.status_code == 200
+    timings = server_timing(response)
+    assert {"decode", "index_refresh", "total"} <= set(timings)
+    assert {f"descriptor.{stage}" for stage in DESCRIPTOR_STAGES} <= set(timings)
+    assert float(timings["total"]) >= max(float(v) for k, v in timings.items() if k != "total")
+
+
+def test_metrics_endpoint(client):
+    client.get("/index")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    assert re.search(r'image_service_requests_total\{endpoint="/index",status="200"\} \d+', text)
+    assert 'image_service_stage_seconds_count{stage="request:/index"}' in text
+    assert re.search(r"image_service_corpus_size \d+", text)
@@ -0,0 +1,56 @@
+import cv2
+import numpy as np
+import pytest
+
+from conftest import synthetic_image
+from perceptual_hash import HashIndex, hamming, image_hashes, parse_hashes, split_hashes
+
+
+def brute_force(hashes, value, radius):
+    distances = hamming(hashes, value)
+    rows = np.flatnonzero(distances <= radius)
+    order = np.lexsort((rows, distances[rows]))
+    return rows[order], distances[rows][order]
+
+
+@pytest.mark.parametrize("radius", [0, 3, 6, 11, 20])
+def test_lookup_matches_linear_scan(radius):
+    rng = np.random.default_rng(radius)
+    hashes = rng.integers(0, 2 ** 63, 3000, dtype=np.uint64) * np.uint64(2) + rng.integers(0, 2, 3000, dtype=np.uint64)
+    # Near copies of a few hashes, a couple of bits apart
+    for i in range(0, 200, 10):
+        flips = rng.choice(64, int(rng.integers(1, 12)), replace=False)
+        hashes[i + 1] = hashes[i] ^ np.uint64(sum(1 << int(b) for b in flips))
+    index = HashIndex(np.arange(len(hashes)), hashes)
+
+    for value in hashes[:200:10]:
+        rows, distances = index.lookup(int(value), radius)
+        expected_rows, expected_distances = brute_force(hashes, int(value), radius)
+        np.testing.assert_array_equal(rows, expected_rows)
+        np.testing.assert_array_equal(distances, expected_distances)
+
+
+def test_lookup_on_empty_index():
+    rows, distances = HashIndex([], []).lookup(0, 6)
+    assert rows.size == 0 and distances.size == 0
+
+
+def test_edited_copies_stay_close():
+    image = synthetic_image(3, side=256)
+    phash, _ = parse_hashes(image_hashes(image))
+    resized = cv2.resize(image, (180, 180), interpolation=cv2.INTER_AREA)
+    recompressed = cv2.imdecode(cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 60])[1], cv2.IMREAD_COLOR)
+    other, _ = parse_hashes(image_hashes(synthetic_image(4, side=256)))
+
+    for copy in (resized, recompressed):
+        assert hamming([parse_hashes(image_hashes(copy))[0]], phash)[0] <= 6
+    assert hamming([other], phash)[0] > 6
+
+
+def test_parse_and_split_hashes():
+    assert parse_hashes({"phash": "00000000000000ff", "dhash": "ff00000000000000"}) == (255, 255 << 56)
+    assert parse_hashes({"phash": "zz"}) is None
+    assert parse_hashes(None) is None
+
+    numeric, hashes = split_hashes({"texture_descriptors": [1.0], "perceptual_hash": {"phash": "0", "dhash": "0"}})
+    assert numeric == {"texture_descriptors": [1.0]} and hashes == {"phash": "0", "dhash": "0"}
@@ -0,0 +1,83 @@
+import io
+
+import cv2
+import pytest
+
+from conftest import synthetic_image
+from ingest import image_update
+from query_cache import LRUCache, QueryCache, content_hash, weights_version
+from search_index import DescriptorIndex
+
+QUERY_SEED = 100  # not in the corpus
+WEIGHTS = {"w1": 0.1, "w2": 0.8, "w3": 0.1, "frame_weights": (0.7, 0.3), "color_weights": (0.4, 0.1, 0.5)}
+
+
+def test_lru_cache_evicts_beyond_its_budget():
+    cache = LRUCache(max_bytes=400)
+    for i in range(20):
+        cache.put(i, i)
+    assert cache.current_bytes <= 400 and cache.evictions > 0
+    assert cache.get(0) is None and cache.get(19) == 19
+
+
+def test_results_key_follows_weights_and_corpus_version(descriptors):
+    cache = QueryCache(2 ** 20)
+    key = cache.results_key(descriptors[0], WEIGHTS, 1, 10)
+    cache.put_results(key, ["result"])
+    assert cache.results_key(descriptors[0], dict(WEIGHTS), 1, 10) == key
+    assert cache.results_key(descriptors[0], {**WEIGHTS, "w1": 0.2}, 1, 10) != key
+    assert cache.results_key(descriptors[0], WEIGHTS, 1, 5) != key
+    assert cache.get_results(key) == ["result"]
+
+    # A new corpus version drops every cached result
+    assert cache.results_key(descriptors[0], WEIGHTS, 2, 10) != key
+    assert len(cache.results) == 0
+
+
+def test_weights_version_and_content_hash():
+    assert weights_version(**WEIGHTS) == weights_version(**{**WEIGHTS, "frame_weights": [0.7, 0.3]})
+    assert weights_version(**WEIGHTS) != weights_version(**{**WEIGHTS, "color_weights": (0.4, 0.2, 0.4)})
+    assert content_hash(b"image", "1") != content_hash(b"image", "2-s512")
+
+
+@pytest.fixture
+def search(images_module, collection, monkeypatch):
+    """POST /search of a synthetic image, over a fresh index and cache."""
+    monkeypatch.setattr(images_module, "search_index", DescriptorIndex(collection, refresh_interval=0))
+    monkeypatch.setattr(images_module, "query_cache", QueryCache(2 ** 24))
+    client = images_module.app.test_client()
+    data = cv2.imencode(".png", synthetic_image(QUERY_SEED))[1].tobytes()
+
+    def post(**form):
+        response = client.post("/search", data={"image": (io.BytesIO(data), "query.png"), **form})
+        assert response.status_code == 200
+        return response.json
+
+    return post
+
+
+def test_repeated_query_hits_both_levels(images_module, search):
+    first = search()
+    second = search()
+    assert second == first
+    stats = images_module.query_cache.stats()
+    assert stats["descriptors"]["hits"] == 1 and stats["results"]["hits"] == 1
+
+
+def test_index_change_invalidates_results(images_module, collection, descriptors, search):
+    search()
+    # An image identical to the query enters the corpus: it must top the next results
+    query = images_module.calculate_img_descriptors(synthetic_image(QUERY_SEED))
+    collection.update_one({"filename": "query_copy.png"}, image_update(query, "category_0"), upsert=True)
+    results = search()
+    assert results[0]["filename"] == "query_copy.png"
+    assert images_module.query_cache.stats()["results"]["hits"] == 0
+
+
+def test_weight_change_invalidates_results(images_module, search):
+    session = "query-cache-test"
+    before = search(session=session)
+    images_module.weight_store.update(session, lambda current: (0.9, 0.05, 0.05, *current[3:]))
+    after = search(session=session)
+    assert images_module.query_cache.stats()["results"]["hits"] == 0
+    assert [r["score"] for r in after] != [r["score"] for r in before]
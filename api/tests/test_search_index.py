@@ -0,0 +1,165 @@
+import mongomock
+import numpy as np
+import pytest
+from bson import ObjectId
+
+from conftest import synthetic_image
+from descriptors import calculate_img_descriptors
+from search_index import DescriptorIndex, UPDATED_FIELD, cascade_recall_report
+from ingest import image_update
+
+WEIGHTS = [
+    {},
+    {"w1": 0.5, "w2": 0.2, "w3": 0.3, "frame_weights": (0.2, 0.8), "color_weights": (0.1, 0.6, 0.3)},
+]
+
+
+def legacy_documents(collection):
+    return [{"filename": doc["filename"], "characteristics": doc["characteristics"]}
+            for doc in collection.find({}, {"filename": 1, "characteristics": 1})]
+
+
+def assert_same_results(results, expected):
+    assert [r["filename"] for r in results] == [r["filename"] for r in expected]
+    np.testing.assert_allclose([r["score"] for r in results], [r["score"] for r in expected], rtol=1e-4)
+
+
+@pytest.mark.parametrize("weights", WEIGHTS)
+def test_search_matches_simple_search(images_module, collection, descriptors, weights):
+    index = DescriptorIndex(collection)
+    index.refresh(force=True)
+    docs = legacy_documents(collection)
+
+    for query in descriptors[:5] + descriptors[-3:]:
+        expected = images_module.simple_search(query, docs, top_n=10, **weights)
+        assert_same_results(index.search(query, top_n=10, **weights), expected)
+
+
+@pytest.mark.parametrize("weights", WEIGHTS)
+def test_search_batch_matches_simple_search(images_module, collection, descriptors, weights):
+    index = DescriptorIndex(collection)
+    index.refresh(force=True)
+    docs = legacy_documents(collection)
+
+    queries = descriptors[:8] + [{"error": "Invalid image format"}]
+    batch = index.search_batch(queries, top_n=10, **weights)
+    assert batch[-1] is None
+    for query, results in zip(queries, batch):
+        if results is not None:
+            assert_same_results(results, images_module.simple_search(query, docs, top_n=10, **weights))
+
+
+def test_category_search_stays_in_partition(collection, descriptors):
+    index = DescriptorIndex(collection)
+    index.refresh(force=True)
+
+    results = index.search(descriptors[0], top_n=40, categories=("category_1",))
+    assert len(results) == sum(1 for i in range(len(descriptors)) if i % 3 == 1)
+    assert {r["category"] for r in results} == {"category_1"}
+
+
+def test_refresh_applies_inserts_deletes_and_updates(collection, descriptors):
+    index = DescriptorIndex(collection, refresh_interval=0)
+    assert index.refresh()
+    assert not index.refresh()
+
+    collection.delete_one({"filename": "img_1.png"})
+    collection.update_one({"filename": "new.png"}, image_update(descriptors[1], "category_0"), upsert=True)
+    assert index.refresh()
+    assert len(index) == len(descriptors)
+    assert "img_1.png" not in set(index.state.filenames)
+
+    # In-place update of an indexed document, flagged by its UPDATED_FIELD
+    collection.update_one({"filename": "img_2.png"}, image_update(descriptors[5], "category_2"))
+    assert index.refresh()
+    top = index.search(descriptors[5], top_n=2)
+    assert {r["filename"] for r in top} == {"img_2.png", "img_5.png"}
+
+
+class RecordingCollection:
+    """Collection proxy recording the filters of the find() calls."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.filters = []
+
+    def find(self, filter=None, *args, **kwargs):
+        self.filters.append(filter)
+        return self.collection.find(filter, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+def test_inserts_do_not_scan_every_id(collection, descriptors):
+    recording = RecordingCollection(collection)
+    index = DescriptorIndex(recording, refresh_interval=0)
+    index.refresh()
+
+    recording.filters.clear()
+    collection.update_one({"filename": "new.png"}, image_update(descriptors[1], "category_0"), upsert=True)
+    assert index.refresh()
+    assert {} not in recording.filters
+    assert len(index) == len(descriptors) + 1
+    assert index.search(descriptors[1], top_n=2)[1]["score"] == pytest.approx(0, abs=1e-6)
+
+    # Deletions show in the count and fall back to the full _id scan
+    recording.filters.clear()
+    collection.delete_one({"filename": "img_4.png"})
+    assert index.refresh()
+    assert {} in recording.filters
+    assert "img_4.png" not in set(index.state.filenames)
+
+    # So do inserts below the newest _id
+    collection.insert_one({"_id": ObjectId.from_datetime(ObjectId().generation_time.replace(year=2000)),
+                           "filename": "old.png", **image_update(descriptors[4], "category_1")["$set"]})
+    assert index.refresh()
+    assert "old.png" in set(index.state.filenames)
+    assert len(index) == len(descriptors) + 1
+
+
+def test_forced_refresh_rebuilds(collection, descriptors):
+    index = DescriptorIndex(collection, refresh_interval=0)
+    index.refresh()
+
+    # Edits that do not bump UPDATED_FIELD are only picked up by a rebuild
+    update = image_update(descriptors[7], "category_0")
+    del update["$set"][UPDATED_FIELD]
+    collection.update_one({"filename": "img_3.png"}, update)
+    assert index.refresh(force=True)
+    assert index.search(descriptors[7], top_n=2)[1]["score"] == pytest.approx(0, abs=1e-6)
+
+
+@pytest.fixture(scope="module")
+def clustered_collection():
+    """15 synthetic images with 4 noisy variants each: every image has 3 near duplicates."""
+    collection = mongomock.MongoClient().db.images
+    rng = np.random.default_rng(0)
+    for base in range(15):
+        image = synthetic_image(base)
+        for variant in range(4):
+            noisy = np.clip(image.astype(int) + rng.integers(-12, 13, image.shape), 0, 255).astype(np.uint8)
+            collection.update_one({"filename": f"img_{base}_{variant}.png"},
+                                  image_update(calculate_img_descriptors(noisy), f"category_{base % 3}"), upsert=True)
+    return collection
+
+
+def test_cascade_recall(clustered_collection):
+    index = DescriptorIndex(clustered_collection)
+    index.refresh(force=True)
+    report = cascade_recall_report(index, [8, 16, len(index)], queries=len(index), top_k=4)
+    recalls = [config["recall@4"] for config in report["configs"]]
+    assert recalls == sorted(recalls)
+    assert recalls[0] >= 0.95
+    assert recalls[-1] == 1.0
+
+
+@pytest.mark.parametrize("weights", WEIGHTS)
+def test_cascade_covering_the_corpus_is_exact(collection, descriptors, weights):
+    index = DescriptorIndex(collection)
+    index.refresh(force=True)
+    for query in descriptors[:5]:
+        assert_same_results(index.cascade_search(query, top_n=5, cascade_k=len(index), **weights),
+                            index.search(query, top_n=5, **weights))
+        results = index.cascade_search(query, top_n=5, cascade_k=8, categories=("category_1",), **weights)
+        assert {r["category"] for r in results} == {"category_1"}
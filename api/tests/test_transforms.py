@@ -0,0 +1,99 @@
+import io
+import json
+
+import cv2
+import numpy as np
+import pytest
+
+from transforms import decode_image, encode_image, parse_transform_spec, transform_array
+
+
+def smooth_image(width=120, height=90):
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    channels = [127 + 100 * np.sin(x / 9 + c) * np.cos(y / 13 - c) for c in range(3)]
+    return np.clip(np.dstack(channels), 0, 255).astype(np.uint8)
+
+
+def sequential(image, crop_coords=None, resize_dims=None, flip=None, rotate_angle=None):
+    """One OpenCV pass per operation, the behaviour transform_array fuses."""
+    if crop_coords:
+        x, y, w, h = crop_coords
+        image = image[y:y + h, x:x + w]
+    if resize_dims:
+        image = cv2.resize(image, resize_dims, interpolation=cv2.INTER_LINEAR)
+    if flip is not None:
+        image = cv2.flip(image, flip)
+    if rotate_angle:
+        h, w = image.shape[:2]
+        matrix = cv2.getRotationMatrix2D((w // 2, h // 2), rotate_angle, 1.0)
+        image = cv2.warpAffine(image, matrix, (w, h))
+    return image
+
+
+@pytest.mark.parametrize("crop_coords", [None, (10, 5, 80, 60)])
+@pytest.mark.parametrize("resize_dims", [None, (64, 48), (200, 150)])
+@pytest.mark.parametrize("flip", [None, 0, 1, -1])
+def test_fused_resize_and_flip_match_sequential(crop_coords, resize_dims, flip):
+    image = smooth_image()
+    fused = transform_array(image, crop_coords, resize_dims, flip)
+    expected = sequential(image, crop_coords, resize_dims, flip)
+    assert fused.shape == expected.shape
+    assert np.abs(fused.astype(int) - expected.astype(int)).max() <= 1
+
+
+@pytest.mark.parametrize("resize_dims", [None, (80, 60)])
+@pytest.mark.parametrize("flip", [None, 1])
+@pytest.mark.parametrize("rotate_angle", [90, 30, -45])
+def test_fused_rotation_matches_sequential(resize_dims, flip, rotate_angle):
+    image = smooth_image()
+    fused = transform_array(image, (4, 4, 100, 80), resize_dims, flip, rotate_angle)
+    expected = sequential(image, (4, 4, 100, 80), resize_dims, flip, rotate_angle)
+    assert fused.shape == expected.shape
+    # The sequential path interpolates twice; compare away from the rotated borders
+    h, w = fused.shape[:2]
+    inner = (slice(h // 4, 3 * h // 4), slice(w // 4, 3 * w // 4))
+    assert np.abs(fused[inner].astype(int) - expected[inner].astype(int)).mean() < 2
+
+
+def test_crop_outside_the_image_is_rejected():
+    with pytest.raises(ValueError):
+        transform_array(smooth_image(), (500, 500, 10, 10))
+
+
+def test_encode_decode_round_trip():
+    image = smooth_image()
+    data, mimetype = encode_image(image, "png")
+    assert mimetype == "image/png"
+    np.testing.assert_array_equal(decode_image(data), image)
+    with pytest.raises(ValueError):
+        decode_image(b"not an image")
+
+
+def test_parse_transform_spec():
+    spec = parse_transform_spec({"crop_coords": "1,2,3,4", "resize_dims": "10,20", "flip": "-1",
+                                 "rotate_angle": "15", "format": "WEBP", "quality": "80"})
+    assert spec == {"crop_coords": (1, 2, 3, 4), "resize_dims": (10, 20), "flip": -1, "rotate_angle": 15.0,
+                    "format": "webp", "quality": 80}
+    for source in ({"flip": "2"}, {"quality": "0"}, {"format": "gif"}, {"crop_coords": "1,2,3"}):
+        with pytest.raises(ValueError):
+            parse_transform_spec(source)
+
+
+@pytest.mark.parametrize("source", [{"rotate_angle": [1]}, {"flip": {"a": 1}}, {"quality": [80]},
+                                    {"crop_coords": {"x": 1}}, {"resize_dims": 5}])
+def test_parse_transform_spec_rejects_non_scalars(source):
+    with pytest.raises(ValueError):
+        parse_transform_spec(source)
+
+
+def test_transform_endpoints_reject_malformed_specs(images_module):
+    client = images_module.app.test_client()
+
+    def upload():
+        return io.BytesIO(encode_image(smooth_image(), "png")[0]), "image.png"
+
+    response = client.post("/transform/batch", data={"images": [upload()], "specs": json.dumps([{"rotate_angle": [1]}])})
+    assert response.status_code == 400
+    assert response.json["message"].startswith("Invalid specs")
+    response = client.post("/transform", data={"image": upload(), "quality": "high"})
+    assert response.status_code == 400
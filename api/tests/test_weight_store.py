@@ -0,0 +1,113 @@
+import time
+
+import mongomock
+import pytest
+
+from weight_store import DEFAULT_WEIGHTS, WeightStore, weights_to_doc
+
+STORED = (5.0, 0.5, 0.4, (0.7, 0.3), (0.4, 0.1, 0.5))
+
+
+def bump(weights):
+    return (weights[0] + 1,) + tuple(weights[1:])
+
+
+@pytest.fixture
+def weights_collection():
+    collection = mongomock.MongoClient().db.weights
+    collection.insert_one(dict(weights_to_doc(STORED), type="weights", updated_at=time.time()))
+    collection.insert_one(dict(weights_to_doc(STORED), type="session", session="s", updated_at=time.time()))
+    return collection
+
+
+def test_updates_are_flushed(weights_collection):
+    store = WeightStore(weights_collection).load()
+    assert store.get() == STORED
+
+    store.update(None, bump)
+    store.update("other", bump)
+    assert store.flush() == 2
+    assert weights_collection.find_one({"type": "weights"})["w1"] == 6.0
+    # New sessions start from the current global weights
+    assert weights_collection.find_one({"type": "session", "session": "other"})["w1"] == 7.0
+    assert store.flush() == 0
+
+
+def test_updates_before_load_are_replayed(weights_collection):
+    store = WeightStore(weights_collection)
+    assert store.update(None, bump)[0] == DEFAULT_WEIGHTS[0] + 1
+    store.update("s", bump)
+    store.update("new", bump)
+    # Nothing is written before the stored weights are known
+    assert store.flush() == 0
+
+    store.load()
+    assert store.get()[0] == 6.0
+    assert store.get("s")[0] == 6.0
+    # New sessions start from the (updated) global weights
+    assert store.get("new")[0] == 7.0
+
+    store.flush()
+    assert weights_collection.find_one({"type": "weights"})["w1"] == 6.0
+    assert weights_collection.find_one({"type": "session", "session": "s"})["w1"] == 6.0
+
+
+def test_sessions_are_isolated(weights_collection):
+    store = WeightStore(weights_collection).load()
+    store.update("a", bump)
+    assert store.get("a")[0] == 6.0
+    assert store.get("b") == STORED
+    assert store.get() == STORED
+
+
+def test_global_updates_can_be_disabled(weights_collection):
+    store = WeightStore(weights_collection, global_updates=False).load()
+    assert store.update(None, bump)[0] == 6.0
+    assert store.get() == STORED
+    assert store.flush() == 0
+
+
+def test_idle_sessions_expire(weights_collection):
+    store = WeightStore(weights_collection, session_ttl=0).load()
+    store.update("a", bump)
+    time.sleep(0.01)
+    store.flush()
+    assert store.stats()["sessions"] == 0
+    assert weights_collection.count_documents({"type": "session"}) == 0
+
+
+def test_processes_add_up_their_updates(weights_collection):
+    # Two processes sharing the weights collection
+    first, second = WeightStore(weights_collection).load(), WeightStore(weights_collection).load()
+    first.update(None, bump)
+    second.update(None, bump)
+    second.update(None, bump)
+    first.flush()
+    second.flush()
+    assert weights_collection.find_one({"type": "weights"})["w1"] == 8.0
+    assert second.get()[0] == 8.0
+
+    # The first process picks up the other updates on its next flush, keeping its own unflushed ones
+    first.update(None, bump)
+    first.flush()
+    assert first.get()[0] == 9.0
+    second.flush()
+    assert second.get()[0] == 9.0
+
+
+def test_sessions_are_shared_between_processes(weights_collection):
+    first, second = WeightStore(weights_collection).load(), WeightStore(weights_collection).load()
+    # Looked up (and not found) before it exists
+    assert second.get("new") == STORED
+
+    first.update("new", bump)
+    first.flush()
+    second.update("s", bump)
+    second.flush()
+
+    assert second.get("new")[0] == 6.0
+    second.update("new", bump)
+    second.flush()
+    first.flush()
+    assert first.get("new")[0] == 7.0
+    assert weights_collection.find_one({"type": "session", "session": "new"})["w1"] == 7.0
@@ -0,0 +1,226 @@
+"""
+In-memory image transforms.
+
+Crop, resize, flip and rotate are composed into a single 2x3 affine matrix and
+applied with one cv2.warpAffine, instead of one full-image pass (and one new
+array) per operation. Cheap cases keep their dedicated path: a crop alone is a
+slice view, a flip alone is cv2.flip and a resize alone is cv2.resize.
+"""
+import io
+import json
+import zipfile
+
+import cv2
+import numpy as np
+
+
+OUTPUT_FORMATS = {
+    "jpg": (".jpg", "image/jpeg"),
+    "jpeg": (".jpg", "image/jpeg"),
+    "png": (".png", "image/png"),
+    "webp": (".webp", "image/webp"),
+}
+DEFAULT_FORMAT = "jpg"
+
+
+def decode_image(data):
+    """
+    Decode image bytes into a BGR array.
+
+    :raises ValueError: If the bytes are not a supported image.
+    """
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Invalid image file")
+    return image
+
+
+def encode_image(image, fmt=DEFAULT_FORMAT, quality=None):
+    """
+    Encode an image in memory.
+
+    :param fmt: 'jpg', 'png' or 'webp'.
+    :param quality: 1-100 for jpg / webp (ignored for png, which is lossless).
+    :return: Tuple (bytes, mimetype).
+    """
+    fmt = (fmt or DEFAULT_FORMAT).lower()
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported format '{fmt}', expected one of {sorted(OUTPUT_FORMATS)}")
+    extension, mimetype = OUTPUT_FORMATS[fmt]
+
+    params = []
+    if quality is not None:
+        if not 1 <= quality <= 100:
+            raise ValueError("quality must be between 1 and 100")
+        if extension == ".jpg":
+            params = [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+        elif extension == ".webp":
+            params = [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+
+    ok, buffer = cv2.imencode(extension, image, params)
+    if not ok:
+        raise ValueError(f"Could not encode image as {fmt}")
+    return buffer.tobytes(), mimetype
+
+
+def _crop(image, crop_coords):
+    """Crop as a view, clipped to the image like numpy slicing."""
+    x, y, w, h = crop_coords
+    return image[y:y + h, x:x + w]
+
+
+def transform_matrix(size, resize_dims=None, flip=None, rotate_angle=None):
+    """
+    Compose resize, flip and rotate into one forward affine matrix.
+
+    Every step maps pixel centres exactly like its sequential counterpart:
+    cv2.resize (dst = (src + 0.5) * scale - 0.5), cv2.flip and a rotation
+    about (w // 2, h // 2) that keeps the image size.
+
+    :param size: (width, height) of the (cropped) source image.
+    :return: Tuple (3x3 matrix, output (width, height)).
+    """
+    w, h = size
+    matrix = np.eye(3)
+
+    if resize_dims:
+        new_w, new_h = resize_dims
+        sx, sy = new_w / w, new_h / h
+        matrix = np.array([[sx, 0, 0.5 * sx - 0.5],
+                           [0, sy, 0.5 * sy - 0.5],
+                           [0, 0, 1]]) @ matrix
+        w, h = new_w, new_h
+
+    if flip is not None:
+        step = np.eye(3)
+        if flip != 0:
+            # Horizontal (1) or both (-1)
+            step[0, 0], step[0, 2] = -1, w - 1
+        if flip <= 0:
+            # Vertical (0) or both (-1)
+            step[1, 1], step[1, 2] = -1, h - 1
+        matrix = step @ matrix
+
+    if rotate_angle:
+        rotation = cv2.getRotationMatrix2D((w // 2, h // 2), rotate_angle, 1.0)
+        matrix = np.vstack([rotation, [0, 0, 1]]) @ matrix
+
+    return matrix, (w, h)
+
+
+def transform_array(image, crop_coords=None, resize_dims=None, flip=None, rotate_angle=None):
+    """
+    Transform an image array using cropping, resizing, flipping, and rotation.
+
+    The operations are applied in that order, with the same semantics as
+    applying them one after the other, but in a single pass.
+
+    :param image: BGR image array.
+    :param crop_coords: Tuple (x, y, w, h) for cropping (x, y are the top-left corner, w is width, h is height).
+    :param resize_dims: Tuple (width, height) for resizing.
+    :param flip: Integer indicating flip mode (0 for vertical, 1 for horizontal, -1 for both axes).
+    :param rotate_angle: Angle in degrees to rotate the image.
+    :return: Transformed image array.
+    """
+    if crop_coords:
+        image = _crop(image, crop_coords)
+        if image.size == 0:
+            raise ValueError("Crop is outside the image")
+
+    if rotate_angle or (resize_dims and flip is not None):
+        h, w = image.shape[:2]
+        matrix, out_size = transform_matrix((w, h), resize_dims, flip, rotate_angle)
+        # Without rotation every sample falls inside the source, where cv2.resize clamps to the edge
+        border = cv2.BORDER_CONSTANT if rotate_angle else cv2.BORDER_REPLICATE
+        return cv2.warpAffine(image, matrix[:2], out_size, flags=cv2.INTER_LINEAR, borderMode=border)
+
+    if resize_dims:
+        return cv2.resize(image, tuple(resize_dims), interpolation=cv2.INTER_LINEAR)
+    if flip is not None:
+        return cv2.flip(image, flip)
+    return image
+
+
+def _int_tuple(value, length, name):
+    if isinstance(value, str):
+        value = value.split(',')
+    try:
+        values = tuple(int(v) for v in value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be {length} comma separated integers")
+    if len(values) != length:
+        raise ValueError(f"{name} must be {length} comma separated integers")
+    return values
+
+
+def _number(value, cast, name):
+    # JSON specs may carry lists or objects where a scalar is expected
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be a{'n integer' if cast is int else ' number'}")
+
+
+def parse_transform_spec(source):
+    """
+    Read a transform spec from request form fields or a JSON object.
+
+    Keys: crop_coords ("x,y,w,h"), resize_dims ("width,height"), flip (0, 1, -1),
+    rotate_angle (degrees), format (jpg, png, webp) and quality (1-100).
+
+    :raises ValueError: On a malformed value.
+    """
+    spec = {"crop_coords": None, "resize_dims": None, "flip": None, "rotate_angle": None,
+            "format": DEFAULT_FORMAT, "quality": None}
+
+    if source.get('crop_coords') not in (None, ''):
+        spec["crop_coords"] = _int_tuple(source['crop_coords'], 4, 'crop_coords')
+        if min(spec["crop_coords"]) < 0:
+            raise ValueError("crop_coords must not be negative")
+    if source.get('resize_dims') not in (None, ''):
+        spec["resize_dims"] = _int_tuple(source['resize_dims'], 2, 'resize_dims')
+        if min(spec["resize_dims"]) < 1:
+            raise ValueError("resize_dims must be positive")
+    if source.get('flip') not in (None, ''):
+        spec["flip"] = _number(source['flip'], int, 'flip')
+        if spec["flip"] not in (0, 1, -1):
+            raise ValueError("flip must be 0, 1 or -1")
+    if source.get('rotate_angle') not in (None, ''):
+        spec["rotate_angle"] = _number(source['rotate_angle'], float, 'rotate_angle')
+    if source.get('format') not in (None, ''):
+        spec["format"] = str(source['format']).lower()
+        if spec["format"] not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported format '{spec['format']}', expected one of {sorted(OUTPUT_FORMATS)}")
+    if source.get('quality') not in (None, ''):
+        spec["quality"] = _number(source['quality'], int, 'quality')
+        if not 1 <= spec["quality"] <= 100:
+            raise ValueError("quality must be between 1 and 100")
+    return spec
+
+
+def apply_spec(image, spec):
+    """
+    Transform and encode an image according to a parsed spec.
+
+    :return: Tuple (bytes, mimetype).
+    """
+    transformed = transform_array(image, spec["crop_coords"], spec["resize_dims"], spec["flip"], spec["rotate_angle"])
+    return encode_image(transformed, spec["format"], spec["quality"])
+
+
+def zip_outputs(outputs, errors=None):
+    """
+    Bundle transformed images into an in-memory zip archive.
+
+    :param outputs: List of (archive name, bytes).
+    :param errors: Optional list of per-item errors, stored as errors.json.
+    :return: Zip archive bytes.
+    """
+    buffer = io.BytesIO()
+    # Encoded images are already compressed
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for name, data in outputs:
+            archive.writestr(name, data)
+        if errors:
+            archive.writestr('errors.json', json.dumps(errors, indent=2))
+    return buffer.getvalue()
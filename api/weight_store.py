@@ -0,0 +1,359 @@
+"""
+In-process search weights with write-behind persistence.
+
+Every feedback session owns its own weights, so concurrent users no longer
+overwrite each other's updates; requests without a session share the global
+weights. Reads and updates only touch memory, except the first use of a
+session this process does not hold yet, which is looked up in MongoDB.
+
+A background flusher persists the changes to the `weights` collection in one
+ordered bulk_write per interval. Changes are written as `$inc` deltas against
+the value last read from MongoDB, so several processes (e.g. workers sharing a
+descriptor snapshot) can update the same document without overwriting each
+other; after every flush the process re-reads the global weights and the
+sessions written since the previous flush, picking up the feedback applied by
+the other processes.
+Sessions idle for longer than the TTL are expired.
+
+Documents of the weights collection:
+
+    {"type": "weights", w1, w2, w3, frame_weights, color_weights, updated_at}
+    {"type": "session", "session": <id>, w1, ..., updated_at}
+"""
+import atexit
+import threading
+import time
+
+from pymongo import DeleteMany, UpdateOne
+
+
+# Used when the collection holds no global weights yet
+DEFAULT_WEIGHTS = (0.1, 0.8, 0.1, (0.7, 0.3), (0.4, 0.1, 0.5))
+MAX_SESSION_ID_LENGTH = 128
+
+# Document paths of the flattened weights, in flatten_weights order
+WEIGHT_FIELDS = ("w1", "w2", "w3", "frame_weights.0", "frame_weights.1",
+                 "color_weights.0", "color_weights.1", "color_weights.2")
+
+
+def weights_from_doc(doc):
+    """Weights tuple (w1, w2, w3, frame_weights, color_weights) of a weights document."""
+    if not doc:
+        return DEFAULT_WEIGHTS
+    return (
+        doc.get("w1", 0.1),
+        doc.get("w2", 0.5),
+        doc.get("w3", 0.4),
+        tuple(doc.get("frame_weights", (0.7, 0.3))),
+        tuple(doc.get("color_weights", (0.4, 0.1, 0.5))),
+    )
+
+
+def weights_to_doc(weights):
+    w1, w2, w3, frame_weights, color_weights = weights
+    return {"w1": float(w1), "w2": float(w2), "w3": float(w3),
+            "frame_weights": [float(w) for w in frame_weights],
+            "color_weights": [float(w) for w in color_weights]}
+
+
+def flatten_weights(weights):
+    """The weights as a flat list of floats, in WEIGHT_FIELDS order."""
+    w1, w2, w3, frame_weights, color_weights = weights
+    return [float(w1), float(w2), float(w3)] + [float(w) for w in frame_weights] + [float(w) for w in color_weights]
+
+
+def unflatten_weights(values):
+    return values[0], values[1], values[2], tuple(values[3:5]), tuple(values[5:8])
+
+
+def rebase_weights(weights, base, stored):
+    """`stored` plus the local changes of `weights` since `base`."""
+    return unflatten_weights([s + w - b for s, w, b in zip(
+        flatten_weights(stored), flatten_weights(weights), flatten_weights(base))])
+
+
+class WeightStore:
+    """
+    Search weights per feedback session, held in memory.
+
+    Parameters:
+        collection: Mongo collection holding the weights documents.
+        session_ttl (float): Seconds without any search or feedback after which a
+            session expires (its document is removed by the next flush).
+        flush_interval (float): Seconds between two write-behind flushes.
+        global_updates (bool): Whether feedback without a session updates the global
+            weights. When False, the global weights are a read-only default.
+    """
+
+    def __init__(self, collection, session_ttl=3600.0, flush_interval=1.0, global_updates=True):
+        self.collection = collection
+        self.session_ttl = session_ttl
+        self.flush_interval = flush_interval
+        self.global_updates = global_updates
+        self.flushes = 0
+        self.flushed_documents = 0
+        self.expired = 0
+        self.loaded = False
+        self._global = DEFAULT_WEIGHTS
+        self._global_base = DEFAULT_WEIGHTS  # global weights as last read from / written to MongoDB
+        self._sessions = {}  # session id -> (weights, last used (monotonic), base weights)
+        self._missing = set()  # sessions looked up and not found since the last flush
+        self._synced_at = 0.0  # time.time() of the last read of the stored weights
+        self._dirty = set()  # None stands for the global weights
+        self._touched = set()  # sessions read since the last flush
+        self._pending = []  # (session, fn) updates made before load, replayed on the stored weights
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """
+        Read the global weights and the sessions that did not expire yet.
+
+        Updates made before the load were computed from the defaults; they are
+        replayed in order on top of the stored weights instead.
+        """
+        self._synced_at = time.time()
+        cutoff = self._synced_at - self.session_ttl
+        global_doc = self.collection.find_one({"type": "weights"})
+        session_docs = list(self.collection.find({"type": "session", "updated_at": {"$gte": cutoff}}))
+        now = time.monotonic()
+        with self._lock:
+            if self.loaded:
+                return self
+            self._global = self._global_base = weights_from_doc(global_doc)
+            for doc in session_docs:
+                used = now - (time.time() - doc["updated_at"])
+                entry = self._sessions.get(doc["session"])
+                weights = weights_from_doc(doc)
+                self._sessions[doc["session"]] = (weights, max(used, entry[1]) if entry else used, weights)
+            for session in {session for session, _ in self._pending if session is not None} - {
+                    doc["session"] for doc in session_docs}:
+                # New sessions start again from the stored global weights
+                self._sessions.pop(session, None)
+            pending, self._pending = self._pending, []
+            for session, fn in pending:
+                self._apply(session, fn)
+            self.loaded = True
+        return self
+
+    def start(self):
+        """
+        Start the background flusher thread; pending changes are flushed at exit.
+
+        The stored weights are loaded by the thread, so startup does not wait on
+        Mongo either; the defaults are served until they are loaded, and nothing
+        is flushed before, so the stored documents are never overwritten by
+        weights derived from the defaults.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="weights-flusher", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+        if not self.loaded:
+            self.load()
+        self.flush()
+
+    def _run(self):
+        while True:
+            try:
+                if not self.loaded:
+                    self.load()
+                self.flush()
+            except Exception:
+                # Mongo unavailable: changes stay dirty and are retried on the next interval
+                pass
+            if self._stop.wait(self.flush_interval):
+                break
+
+    @staticmethod
+    def valid_session(session):
+        return session is None or (isinstance(session, str) and 0 < len(session) <= MAX_SESSION_ID_LENGTH)
+
+    def _fetch_session(self, session):
+        """
+        Load a session this process does not hold yet (created by another process).
+
+        Sessions that are not stored either are only looked up again after the next flush.
+        """
+        if not self.loaded:
+            return
+        with self._lock:
+            if session in self._sessions or session in self._missing:
+                return
+        try:
+            doc = self.collection.find_one({"type": "session", "session": session,
+                                            "updated_at": {"$gte": time.time() - self.session_ttl}})
+        except Exception:
+            return
+        with self._lock:
+            if doc is None:
+                self._missing.add(session)
+            elif session not in self._sessions:
+                weights = weights_from_doc(doc)
+                self._sessions[session] = (weights, time.monotonic(), weights)
+
+    def get(self, session=None):
+        """Current weights of a session (the global weights for new or missing sessions)."""
+        if session is not None:
+            self._fetch_session(session)
+        with self._lock:
+            if session is None:
+                return self._global
+            entry = self._sessions.get(session)
+            if entry is None:
+                return self._global
+            self._sessions[session] = (entry[0], time.monotonic(), entry[2])
+            self._touched.add(session)
+            return entry[0]
+
+    def update(self, session, fn):
+        """
+        Atomically replace the weights of a session with `fn(current weights)`.
+
+        The update runs under the store lock, so concurrent feedback on the same
+        session is applied one after the other instead of being lost. Before the
+        stored weights are loaded, `fn` is also queued and replayed by `load`.
+
+        :return: The new weights.
+        """
+        if session is not None:
+            self._fetch_session(session)
+        with self._lock:
+            if not self.loaded and (session is not None or self.global_updates):
+                self._pending.append((session, fn))
+            return self._apply(session, fn)
+
+    def _apply(self, session, fn):
+        if session is None:
+            current = self._global
+        else:
+            entry = self._sessions.get(session)
+            # New sessions start from the global weights, which their document is created with
+            current, base = (entry[0], entry[2]) if entry is not None else (self._global, self._global)
+        weights = fn(current)
+        weights = (weights[0], weights[1], weights[2], tuple(weights[3]), tuple(weights[4]))
+        if session is None:
+            if self.global_updates:
+                self._global = weights
+                self._dirty.add(None)
+            else:
+                return weights
+        else:
+            self._sessions[session] = (weights, time.monotonic(), base)
+            self._dirty.add(session)
+        return weights
+
+    def expire(self):
+        """Forget sessions idle for longer than the TTL. :return: number of expired sessions."""
+        cutoff = time.monotonic() - self.session_ttl
+        with self._lock:
+            stale = [s for s, (_, used, _) in self._sessions.items() if used < cutoff]
+            for session in stale:
+                del self._sessions[session]
+                self._dirty.discard(session)
+                self._touched.discard(session)
+        self.expired += len(stale)
+        return len(stale)
+
+    def flush(self):
+        """
+        Persist every changed entry in one ordered bulk_write, then re-read the
+        stored global weights and recently written sessions.
+
+        Every changed document gets the `$inc` of its local change since it was
+        last read (created first with the base weights when it does not exist),
+        so concurrent updates from other processes are added up instead of
+        overwritten. Expired session documents are deleted in the same batch.
+
+        :return: Number of documents written (0 until the stored weights are loaded).
+        """
+        if not self.loaded:
+            return 0
+        with self._flush_lock:
+            expired = self.expire()
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+                touched, self._touched = self._touched - dirty, set()
+                self._missing = set()
+                writes = [(session,) + ((self._global, self._global_base) if session is None
+                                        else (self._sessions[session][0], self._sessions[session][2]))
+                          for session in dirty]
+
+            now = time.time()
+            ops = []
+            for session, weights, base in writes:
+                query = {"type": "weights"} if session is None else {"type": "session", "session": session}
+                delta = {field: w - b for field, w, b in zip(
+                    WEIGHT_FIELDS, flatten_weights(weights), flatten_weights(base)) if w != b}
+                ops.append(UpdateOne(query, {"$setOnInsert": weights_to_doc(base)}, upsert=True))
+                update = {"$set": {"updated_at": now}}
+                if delta:
+                    update["$inc"] = delta
+                ops.append(UpdateOne(query, update))
+            # Sessions that were only read keep their document alive
+            ops.extend(UpdateOne({"type": "session", "session": session}, {"$set": {"updated_at": now}})
+                       for session in touched)
+            if expired:
+                ops.append(DeleteMany({"type": "session", "updated_at": {"$lt": now - self.session_ttl}}))
+
+            if ops:
+                try:
+                    self.collection.bulk_write(ops, ordered=True)
+                except Exception:
+                    # Retried on the next flush (sessions that expired meanwhile are dropped)
+                    with self._lock:
+                        self._dirty.update(s for s, _, _ in writes if s is None or s in self._sessions)
+                    raise
+                with self._lock:
+                    # The written changes are now part of the stored documents
+                    for session, weights, _ in writes:
+                        if session is None:
+                            self._global_base = weights
+                        elif session in self._sessions:
+                            entry = self._sessions[session]
+                            self._sessions[session] = (entry[0], entry[1], weights)
+                self.flushes += 1
+                self.flushed_documents += len(writes)
+
+            self._sync()
+            return len(writes)
+
+    def _sync(self):
+        """
+        Re-read the global weights and the sessions written by any process since
+        the previous sync, keeping the local changes not flushed yet.
+        """
+        # One flush interval of margin for clock differences between hosts
+        since, self._synced_at = self._synced_at - self.flush_interval, time.time()
+        docs = list(self.collection.find({"$or": [{"type": "weights"},
+                                                  {"type": "session", "updated_at": {"$gte": since}}]}))
+        with self._lock:
+            for doc in docs:
+                stored = weights_from_doc(doc)
+                if doc["type"] == "weights":
+                    self._global = rebase_weights(self._global, self._global_base, stored)
+                    self._global_base = stored
+                elif doc["session"] in self._sessions:
+                    weights, used, base = self._sessions[doc["session"]]
+                    self._sessions[doc["session"]] = (rebase_weights(weights, base, stored), used, stored)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "loaded": self.loaded,
+                "sessions": len(self._sessions),
+                "dirty": len(self._dirty),
+                "flushes": self.flushes,
+                "flushed_documents": self.flushed_documents,
+                "expired": self.expired,
+                "session_ttl": self.session_ttl,
+                "flush_interval": self.flush_interval,
+            }